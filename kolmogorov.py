@@ -15,9 +15,90 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>."""
 
-import os, sys, getopt, curses, signal, subprocess, time, thread, imp
+import os, sys, getopt, curses, signal, time, thread, threading, imp, cPickle
+import collections, select, fcntl, errno, array, bisect, struct, termios, re, io, codecs, json
 
 VERSION = "0.051beta"
+# Directory where kolmogorov keeps its caches
+KOLMOGOROV_DIR = os.path.expanduser("~/.kolmogorov")
+# The tag cache maps absolute paths to the tag information read from them
+TAG_CACHE_FILE = os.path.join(KOLMOGOROV_DIR, "tag_cache")
+# The least recently used entries are dropped beyond this size
+TAG_CACHE_MAX_ENTRIES = 100000
+# The headers of the audio files are read in chunks of this size, see 
+# read_tag_header(...)
+TAG_READ_CHUNK = 4096
+# If the tags of a file aren't found in its first bytes, up to this many, 
+# mutagen reads them
+TAG_READ_LIMIT = 262144
+# The timing statistics are written here on exit and on SIGUSR1, see
+# write_stats(...)
+STATS_FILE = os.path.join(KOLMOGOROV_DIR, "stats")
+# Upper bounds of the buckets of the timing histograms, in seconds (the 
+# last bucket has no bound)
+STATS_BUCKETS = (0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0)
+# Number of threads reading tags in background when tag mode is enabled
+TAG_PREFETCH_WORKERS = 4
+# Number of pages above and below the visible one whose tags are read ahead
+TAG_PREFETCH_PAGES = 2
+# Number of processes reading the tags of the whole playlist before a sort
+# in tag mode
+TAG_SORT_PROCESSES = 4
+# The tags to be read before a sort are sent to the processes in batches 
+# of this size
+TAG_SORT_BATCH_SIZE = 64
+# Number of threads listing directories during a recursive scan
+SCAN_WORKERS = 1
+# While scanning, files are added to the playlist in batches of this size
+SCAN_BATCH_SIZE = 500
+# Minimum time between two repaints while scanning, in seconds
+SCAN_PAINT_INTERVAL = 0.25
+# Minimum time between two repaints of the screen, in seconds: keys and
+# events that arrive in the meantime are painted together
+PAINT_INTERVAL = 1.0 / 30
+# The timing statistics are repainted this often while they are shown, in
+# seconds
+STATS_PAINT_INTERVAL = 1.0
+# The modification times of the scanned directories are saved here, along
+# with the playlist, to rescan only what changed
+DIR_STATE_FILE = os.path.expanduser("~/.kolmogorov_playlist.dirs")
+# The last session (playlist, cursor, queue...) is saved here, see 
+# write_session(...)
+SESSION_FILE = os.path.join(KOLMOGOROV_DIR, "session")
+# The changes to the session since it was saved are appended here
+SESSION_JOURNAL_FILE = os.path.join(KOLMOGOROV_DIR, "session.journal")
+# The session journal is written this long after a change, in seconds: a 
+# crash loses at most this much
+SESSION_SYNC_INTERVAL = 2.0
+# Beyond this many records in the journal, the session is saved again 
+SESSION_JOURNAL_MAX_RECORDS = 1000
+# The entries of the tag cache stored since it was saved are appended to
+# its journal this often while kolmogorov runs, in seconds
+TAG_CACHE_SAVE_INTERVAL = 60.0
+# Beyond this many records in its journal, the tag cache is saved again
+TAG_CACHE_JOURNAL_MAX_RECORDS = 20000
+# The library: the files of the music roots and their tags, queried for
+# playlists (see open_library(...))
+LIBRARY_FILE = os.path.join(KOLMOGOROV_DIR, "library.db")
+# Time the directory watcher waits for changes to settle, in seconds
+WATCH_DELAY = 0.5
+# The player of the next song is started this many seconds before the
+# playing one ends
+PREWARM_TIME = 3.0
+# While a song plays, this many of the next songs are read ahead into the
+# page cache, so that they start at once from slow disks and network 
+# mounts (see read_ahead_thread(...))
+READ_AHEAD_SONGS = 2
+# No more than this many bytes are read ahead for the next songs (the 
+# start of a song if it's longer), in megabytes. 0 disables reading ahead
+READ_AHEAD_BUDGET = 64
+# Without posix_fadvise(...), files are read ahead in chunks of this many
+# bytes
+READ_AHEAD_CHUNK = 1048576
+# The advice of posix_fadvise(...) to read a file ahead (Linux value)
+POSIX_FADV_WILLNEED = 3
+# Seconds skipped by the left/right arrows (players in remote mode only)
+SEEK_STEP = 10
 # KNOWN_EXTENSIONS must be all lowercase
 KNOWN_EXTENSIONS = ["mp3", "mp2", "flac", "ogg", "wav", "aac", "mp4"]
 
@@ -25,31 +106,68 @@ KNOWN_EXTENSIONS = ["mp3", "mp2", "flac", "ogg", "wav", "aac", "mp4"]
 # command: a string, the command to invoke the player
 # options: a list of strings, each string is a option or a option's value
 # (order sensitive, obviously)
+# remote: None, or a dictionary describing the remote (or slave) mode of 
+# the player, where a single process plays all the songs, see below.
 # There is also a key for each known audio extension. 
 # The value is a boolean. If True, the player can play the format.
+#
+# The remote dictionary has keys:
+# options: a list of strings, the options added to enable remote mode
+# init: None or a string, the command sent once the player is started
+# load, pause, stop, seek: the commands to play a file (%s is the file
+# name, quoted by quote), pause/resume, stop and seek (%+d is the number 
+# of seconds)
+# quote: a function that quotes a file name for the load command
+# end: a string, the beginning of the line the player prints at the end 
+# of a song
+# error: None or a string, the beginning of the line the player prints
+# when a song can't be played
+# stop_ends: a boolean. If True, the player prints end after a stop.
+
+MPLAYER_REMOTE = {"options":["-slave", "-idle", "-msglevel", "global=6"], "init":None, \
+    "load":"loadfile %s\n", "pause":"pause\n", "stop":"stop\n", "seek":"seek %+d 0\n", \
+    "quote":lambda f: '"' + f.replace("\\", "\\\\").replace('"', '\\"') + '"', \
+    "end":"EOF code: 1", "error":None, "stop_ends":False}
+MPG123_REMOTE = {"options":["-R"], "init":"SILENCE\n", \
+    "load":"LOAD %s\n", "pause":"PAUSE\n", "stop":"STOP\n", "seek":"JUMP %+ds\n", \
+    "quote":lambda f: f, "end":"@P 0", "error":"@E ", "stop_ends":True}
 
 MPLAYER = {"command":"mplayer", \
-    "options":["-quiet", "-vo", "null", "-cache", "1024"], \
+    "options":["-quiet", "-vo", "null", "-cache", "1024"], "remote":MPLAYER_REMOTE, \
     "mp3":True, "mp2":True, "flac":True, "ogg":True, "wav":True, \
     "aac":True, "mp4":True}
-MPG123 = {"command":"mpg123", "options":["-q"], "mp3":True, "mp2":True, \
+MPG123 = {"command":"mpg123", "options":["-q"], "remote":MPG123_REMOTE, "mp3":True, "mp2":True, \
     "flac":False, "ogg":False, "wav":False, "aac":False, "mp4":False}
-MPG321 = {"command":"mpg321", "options":["-q"], "mp3":True, "mp2":True, \
+MPG321 = {"command":"mpg321", "options":["-q"], "remote":None, "mp3":True, "mp2":True, \
     "flac":False, "ogg":False, "wav":False, "aac":False, "mp4":False}
-OGG123 = {"command":"ogg123", "options":["-q"], "mp3":False, "mp2":False, \
+OGG123 = {"command":"ogg123", "options":["-q"], "remote":None, "mp3":False, "mp2":False, \
     "flac":False, "ogg":True, "wav":False, "aac":False, "mp4":False}
-FLAC123 = {"command":"flac123", "options":["-q"], "mp3":False, "mp2":False, \
+FLAC123 = {"command":"flac123", "options":["-q"], "remote":None, "mp3":False, "mp2":False, \
     "flac":True, "ogg":False, "wav":False, "aac":False, "mp4":False}
 
 KNOWN_PLAYERS = (MPLAYER, MPG123, MPG321, OGG123, FLAC123)
 
+# mutagen reads the tags that read_tag_header(...) can't
 TAG_SUPPORT = True
 try:
-    imp.find_module("mutagen")
-    #import mutagen, mutagen.mp3, mutagen.easyid3
+    import mutagen, mutagen.mp3, mutagen.easyid3
 except ImportError:
     TAG_SUPPORT = False
 
+# The library is a sqlite database
+LIBRARY_SUPPORT = True
+try:
+    imp.find_module("sqlite3")
+except ImportError:
+    LIBRARY_SUPPORT = False
+
+# scandir tells files from directories without a stat call for each entry
+SCANDIR_SUPPORT = True
+try:
+    imp.find_module("scandir")
+except ImportError:
+    SCANDIR_SUPPORT = False
+
 def usage():
     """Prints usage info.
     
@@ -62,9 +180,12 @@ def usage():
     print "flac123 and mplayer. It may be extended to support more players."
     print "\nUsage: \n\tkolmogorov [options] [/path/to/music/files]\n"
     print "  or\n\tkolmogorov [options] [/path/to/playlist.m3u]\n"
+    print "  or\n\tkolmogorov [options] -q QUERY\n"
     print " The path to music files is a directory. It may be omitted, if so,"
-    print " kolmogorov will try to load ~/.kolmogorov_playlist.m3u where the"
-    print " last playlist was saved on quit. If it doesn't exist, it will halt."
+    print " kolmogorov will resume the last session (playlist, cursor, queue and"
+    print " modes), saved in ~/.kolmogorov/session while playing, or else load"
+    print " ~/.kolmogorov_playlist.m3u where the last playlist was saved on quit."
+    print " If neither exists, it will halt."
     print "\nAvailable options are:"
     print "\t-p (--players)\tprint a list of known audio formats and players."
     print "\t-h (--help)\tprint this help and quit."
@@ -72,17 +193,40 @@ def usage():
     print "\t-r (--recursive)\tload recursively all subdirs too."
     print "\t-s (--sort)\tsort playlist (case insensitive)."
     print "\t-t (--tag)\tprints if there is tag support."
+    print "\t-j N (--jobs=N)\tlist N directories at a time when loading recursively."
+    print "\t-w (--watch)\twatch the directory for changes (Linux only)."
+    print "\t-a DIR (--add=DIR)\tadd DIR to the music roots of the library, and update it."
+    print "\t-u (--update)\tupdate the library: scan its roots, read the tags of new files."
+    print "\t-q QUERY (--query=QUERY)\tplay the files of the library matching QUERY, or"
+    print "\t\tthe saved playlist named QUERY. Queries look like:"
+    print "\t\tartist = Pink Floyd and year < 1980 order by year, album, track"
+    print "\t\tFields: artist, album, title, track, year, date, length, bitrate,"
+    print "\t\tmime, path, root, mtime. Operators: = != < > <= >= ~ (contains)."
+    print "\t-n NAME (--name=NAME)\tsave the query of -q as the playlist NAME."
+    print "\t-l (--library)\tprint the music roots and the saved playlists."
+    print "\t-b MB (--read-ahead=MB)\tread ahead up to MB megabytes of the next songs"
+    print "\t\twhile a song plays (default " + str(READ_AHEAD_BUDGET) + ", 0 disables it)."
     print "\t-V (--version)\tprint version and quit."
     print "\nAvailable commands in curses mode:"
     print " up/down arrows (or j-k), page-up/page-down, home/end move the cursor."
     print " <space>/<enter>\tplay song under cursor."
     print " +\tadd selected song to playing queue."
+    print " A\tadd the songs in the directory of the selected song to playing queue."
     print " -\tremove selected song from playing queue."
     print " S\tshow playing song."
-    print " s\tcase-insensitive sort of playlist."
+    print " /\tsearch the playlist as you type (enter to stop, escape to go back)."
+    print " n/N\tgo to the next/previous file matching the last search."
+    print " f\tshow only the files matching what you type (escape shows all of them)."
+    print " s\tcase-insensitive sort of playlist (by artist, album, track and title in tag mode,"
+    print " \tafter reading all the tags: escape cancels it)."
+    print " p\tpause or resume the playing song."
+    print " left/right arrows\tseek backward/forward (mplayer and mpg123 only)."
     print " c\tenable or disable continuos play mode."
     print " T\tswitch between tag information and filename."
     print " r\trefresh screen."
+    print " R\trescan the directory for new or removed files."
+    print " i\tshow or hide the timing statistics (written to ~/.kolmogorov/stats on quit"
+    print " \tand on SIGUSR1)."
     print " q\tquit."
 
 def is_m3u_playlist(filename):
@@ -109,44 +253,109 @@ def load_m3u(filename):
 
     If they are relative, the directory of the file is used as base_path,
     and returned (see below).
-    If they are absolute, it looks for a common prefix to all files in the
-    playlist. If it's found, it's returned as base_path. Otherwise, 
+    If they are absolute, it looks for a common directory to all files in
+    the playlist. If it's found, it's returned as base_path. Otherwise, 
     base_path is set to "".
 
-    Returns: (file_list, base_path)
+    The playlist is read line by line, blank lines are skipped.
+
+    Returns: (file_list, base_path, tag_info)
 
     file_list is a list of paths. The complete path to a file is always 
     given by os.path.join(base_path, file_list[index])
+
+    tag_info is a dictionary, the keys are the complete paths of the files
+    which have a #EXTINF line, the values the tag information found there
+    (see parse_extinf(...))
     """
     fp = open(filename, "rb")
     base_path = os.path.dirname(filename)
     file_list = []
+    tag_info = {}
+    info = None
     for line in fp:
         line = line.strip()
+        if not line:
+            continue
         if line[0] == '#':
+            if line[:8].upper() == "#EXTINF:":
+                info = parse_extinf(line)
             continue
-        if not os.path.isabs(line):
+        if line[0] != os.path.sep:
             line = os.path.join(base_path, line)
-        file_list = file_list + [line]
+        file_list.append(line)
+        if info is not None:
+            tag_info[line] = info
+            info = None
     fp.close()
     cp = os.path.commonprefix(file_list)
+    # the common prefix may end in the middle of a name
+    cp = cp[:cp.rfind(os.path.sep) + 1]
     if cp != "" and cp != os.path.sep:
         file_list = [af[len(cp):] for af in file_list]
     
-    return file_list, cp
+    return file_list, cp, tag_info
+
+def parse_extinf(line):
+    """Parses a #EXTINF line of a m3u playlist:
+    #EXTINF:length,artist - title
+
+    Returns: the tag information (see read_tag_info(...)), only artist,
+    title and length may be known. None if the line can't be parsed.
+    """
+    length, comma, label = line[len("#EXTINF:"):].partition(",")
+    if not comma:
+        return None
+    try:
+        length = float(length.split(None, 1)[0])
+    except (ValueError, IndexError):
+        length = -1
+    label = label.decode("utf-8", "replace").strip()
+    artist, separator, title = label.partition(" - ")
+    if not separator:
+        artist, title = None, label
+    if not len(title):
+        title = None
+    if length < 0:
+        length = None
+    return {"artist":artist, "album":None, "tracknumber":None, "title":title, "date":None, \
+        "mime":None, "bitrate":None, "length":length}
 
-def write_m3u(file_list, base_path, filename):
+def write_m3u(file_list, base_path, filename, tag_cache=None):
     """Writes a m3u playlist to file.
 
     Filenames are always absolute.
 
+    If tag_cache is given (see load_tag_cache(...)), a #EXTINF line is 
+    written before each file whose tags are known, so that they don't need
+    to be read again when the playlist is loaded.
+
+    The playlist is replaced atomically.
+
     Returns: None
     """
-    fp = open(filename, "wb")
+    fp = open(filename + ".tmp", "wb")
     fp.write("#EXTM3U\n")
     for f in file_list:
-        fp.write(os.path.join(base_path, f) + "\n")
+        f = os.path.join(base_path, f)
+        if tag_cache is not None and tag_cache["entries"].has_key(f):
+            info = tag_cache["entries"][f][3]
+            if info is not None and info["title"] is not None:
+                if info["length"] is not None:
+                    length = int(round(info["length"]))
+                else:
+                    length = -1
+                if info["artist"] is not None:
+                    label = info["artist"] + " - " + info["title"]
+                else:
+                    label = info["title"]
+                label = label.replace("\n", " ").replace("\r", " ")
+                if isinstance(label, unicode):
+                    label = label.encode("utf-8")
+                fp.write("#EXTINF:" + str(length) + "," + label + "\n")
+        fp.write(f + "\n")
     fp.close()
+    os.rename(filename + ".tmp", filename)
 
 def print_players():
     """Prints to screen the list of known players and known extensions.
@@ -182,11 +391,27 @@ def print_players():
         sys.stdout.write("\n")
     return None
 
+def find_in_path(command, path=None):
+    """Looks for command in the directories of path (by default, the PATH
+    environment variable), like the *NIX utility 'which'.
+
+    Returns: the path of the executable, None if it's not found.
+    """
+    if os.sep in command:
+        if os.path.isfile(command) and os.access(command, os.X_OK):
+            return command
+        return None
+    if path is None:
+        path = os.environ.get("PATH", os.defpath)
+    for directory in path.split(os.pathsep):
+        filename = os.path.join(directory or os.curdir, command)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
 def check_players(KNOWN_PLAYERS, KNOWN_EXTENSIONS):
     """ Checks if the supported and known players (mpg123, ogg123, 
-    flac123...) are in the user path.
-
-    Currently, it relies on the *NIX utility 'which'.
+    flac123...) are in the user path (see find_in_path(...)).
 
     Returns: 
     a python dictionary, usually called supported_dict that has a key for
@@ -195,12 +420,11 @@ def check_players(KNOWN_PLAYERS, KNOWN_EXTENSIONS):
     are the options to be passed to it.
     Eg. {"mp3":[["mpg123", "-q"]]}
     """
+    path = os.environ.get("PATH", os.defpath)
     support_dict = {}
     
     for player in KNOWN_PLAYERS:
-        s = subprocess.Popen(("which", player["command"]), stdin=subprocess.PIPE, \
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        if s.wait() != 0: # file not found
+        if find_in_path(player["command"], path) is None: # file not found
             continue
         for ext in [k for k in KNOWN_EXTENSIONS if player[k]]:
             if support_dict.has_key(ext):
@@ -208,7 +432,6 @@ def check_players(KNOWN_PLAYERS, KNOWN_EXTENSIONS):
                     player["options"]]
             else:
                 support_dict.update({ext:[[player["command"]] + player["options"]]})
-            
     return support_dict
 
 def is_file_supported(filename, supported_dict):
@@ -237,561 +460,4126 @@ def sanitize_string(astring):
             ret = ret + achar
     return ret
 
-def sort_playlist(primary_list, sec_list, aindex):
+class Playlist:
+    """A playlist: the paths of the files, relative to the base directory,
+    stored compactly for big libraries.
+
+    Each directory is stored once, in a list of directories; the file 
+    names are packed in a single buffer. A file is the index of its 
+    directory and the position of its name in the buffer, kept in arrays.
+    The paths are rebuilt when they are read.
+
+    It behaves like a list of paths: len(...), indexing, slicing, 
+    iteration, append(...) and extend(...). Slices and reordered copies 
+    (see take(...)) share the directories and the names with the playlist
+    they come from: both can grow, nothing is ever removed from them.
+    One thread can append while others read the entries already there.
+    Playlists are pickled as a few strings (see __getstate__()), which is
+    fast.
+    """
+    def __init__(self, paths=(), storage=None):
+        if storage is None:
+            # dirs: the directories (with a trailing separator, "" for the
+            # base directory), dir_index: directory -> index in dirs,
+            # names: the file names
+            storage = {"dirs":[], "dir_index":{}, "names":bytearray()}
+        self.storage = storage
+        self.entry_dirs = array.array("i")
+        self.name_starts = array.array("I")
+        self.name_lengths = array.array("H")
+        self.extend(paths)
+    
+    def __len__(self):
+        return len(self.entry_dirs)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(xrange(*index.indices(len(self.entry_dirs))))
+        if index < 0:
+            index = index + len(self.entry_dirs)
+        start = self.name_starts[index]
+        return self.storage["dirs"][self.entry_dirs[index]] + \
+            str(self.storage["names"][start:start + self.name_lengths[index]])
+    
+    def __iter__(self):
+        for i in xrange(len(self.entry_dirs)):
+            yield self[i]
+    
+    def append(self, path):
+        cut = path.rfind(os.sep) + 1
+        directory = path[:cut]
+        dir_index = self.storage["dir_index"].get(directory)
+        if dir_index is None:
+            dir_index = self.storage["dir_index"][directory] = len(self.storage["dirs"])
+            self.storage["dirs"].append(directory)
+        names = self.storage["names"]
+        self.name_starts.append(len(names))
+        self.name_lengths.append(len(path) - cut)
+        names.extend(path[cut:])
+        # last: the length of the playlist, so other threads never read 
+        # a half stored entry
+        self.entry_dirs.append(dir_index)
+    
+    def extend(self, paths):
+        for path in paths:
+            self.append(path)
+    
+    def __getstate__(self):
+        return (self.storage["dirs"], str(self.storage["names"]), self.entry_dirs.tostring(), \
+            self.name_starts.tostring(), self.name_lengths.tostring())
+    
+    def __setstate__(self, state):
+        dirs, names, entry_dirs, name_starts, name_lengths = state
+        self.storage = {"dirs":dirs, "dir_index":dict(zip(dirs, xrange(len(dirs)))), \
+            "names":bytearray(names)}
+        self.entry_dirs = array.array("i")
+        self.entry_dirs.fromstring(entry_dirs)
+        self.name_starts = array.array("I")
+        self.name_starts.fromstring(name_starts)
+        self.name_lengths = array.array("H")
+        self.name_lengths.fromstring(name_lengths)
+    
+    def copy(self):
+        """
+        Returns: a copy of the playlist, which doesn't grow with it.
+        """
+        playlist = Playlist(storage=self.storage)
+        playlist.entry_dirs = self.entry_dirs[:]
+        playlist.name_starts = self.name_starts[:]
+        playlist.name_lengths = self.name_lengths[:]
+        return playlist
+    
+    def take(self, indices):
+        """
+        Returns: a new playlist with the files with these indices, in this
+        order.
+        """
+        playlist = Playlist(storage=self.storage)
+        entry_dirs = self.entry_dirs
+        name_starts = self.name_starts
+        name_lengths = self.name_lengths
+        playlist.entry_dirs = array.array("i", [entry_dirs[i] for i in indices])
+        playlist.name_starts = array.array("I", [name_starts[i] for i in indices])
+        playlist.name_lengths = array.array("H", [name_lengths[i] for i in indices])
+        return playlist
+
+def take(alist, indices):
+    """
+    Returns: the list (or Playlist) of the items of alist with these 
+    indices, in this order.
+    """
+    if isinstance(alist, Playlist):
+        return alist.take(indices)
+    return [alist[i] for i in indices]
+
+def sort_playlist(primary_list, sec_list, aindex, keys=None):
     """Case-insensitive sorts the primary list.
     
     sec_list is ordered to reflect primary_list's new sorting.
     aindex is a index on a element in primary list. The method returns 
-    the index of the same element in the sorted list."""
+    the index of the same element in the sorted list.
 
+    If keys is given, keys[i] is the sort key of primary_list[i] (see
+    tag_sort_key(...)) instead of primary_list[i].lower(). Keys are 
+    computed once and the sort is stable: equal elements keep their 
+    order.
+
+    Returns: (sorted primary_list, sorted sec_list, the new aindex, 
+    new_index), new_index[i] is the new index of primary_list[i]."""
+
+    if keys is None:
+        keys = [name.lower() for name in primary_list]
+    order = sorted(xrange(len(primary_list)), key=keys.__getitem__)
+    new_index = [0]*len(order)
+    for i in xrange(len(order)):
+        new_index[order[i]] = i
     if aindex is not None:
-        avalue = primary_list[aindex]
-    tmp_dict = {}
-    for i in range(len(primary_list)):
-        tmp_dict.update({primary_list[i]:sec_list[i]})
-    primary_list.sort(cmp=lambda a, b: cmp(a.lower(), b.lower()))
-    return_sec_list = []
-    for i in range(len(primary_list)):
-        return_sec_list = return_sec_list + [tmp_dict[primary_list[i]]]
-    if aindex is not None:
-        ret_index = primary_list.index(avalue)
-    else:
-        ret_index = None
-    return primary_list, return_sec_list, ret_index
+        aindex = new_index[aindex]
+    return take(primary_list, order), take(sec_list, order), aindex, new_index
 
-def read_file_list(base_path, supported_dict, recursive=False):
-    """Reads the list of files in the directory base_path, filters the supported
-    files through supported_dict.
+def tag_sort_key(filename, info):
+    """
+    Returns: the sort key of filename by tags: artist, album, track 
+    number, title (see read_tag_info(...)), then the file name. Missing 
+    tags sort first.
+    """
+    if info is None:
+        return (u"", u"", 0, u"", filename.lower())
+    tracknumber = 0
+    if info["tracknumber"] is not None:
+        try:
+            tracknumber = int(info["tracknumber"].split("/")[0])
+        except ValueError:
+            pass
+    return ((info["artist"] or u"").lower(), (info["album"] or u"").lower(), tracknumber, \
+        (info["title"] or u"").lower(), filename.lower())
 
-    If recursive == True: load recursively all subdirs.
+def supported_extensions(supported_dict):
+    """
+    Returns: the set of the (lowercase) extensions which have a player in
+    supported_dict.
+    """
+    return frozenset([ext for ext in supported_dict.keys() if supported_dict[ext]])
 
-    Returns: the filtered list of filenames."""
+def list_directory(path, supported_exts):
+    """Lists the directory path. 
     
-    #_debug = True
-    #if _debug:
-    #    fp = open("/home/joseph/.kolmogorov.debug", "w")
-    #    fp.write("Recursive: " + str(recursive))
-    file_list = []
-    for root, dirs, files in os.walk(base_path):
-        #if _debug:
-        #    fp.write("R, D, F: "+ str(root) +" "+ str(dirs) +" "+ str(files) + "\n")
-        #    fp.write("file_list: "+str(file_list) + "\n")
-        if os.path.samefile(base_path, root):
-            file_list = file_list + files
-            if not recursive:
-                break
-        else:
-            temp_root = root
-            temp_top = ""
-            while(True):
-                base, top = os.path.split(os.path.normpath(temp_root))
-                temp_top = os.path.join(top, temp_top)
-                if os.path.samefile(base, base_path):
-                    file_list = file_list + [os.path.join(temp_top, af) for af in files]
-                    break
+    Files are filtered by extension through the set supported_exts (see
+    supported_extensions(...)). Links to directories are not listed as
+    subdirectories, as os.walk does.
+    If the directory can't be read, it is considered empty.
+
+    Returns: (files, subdirs), two lists of names.
+    """
+    files = []
+    subdirs = []
+    if SCANDIR_SUPPORT:
+        import scandir
+        try:
+            for entry in scandir.scandir(path):
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
                 else:
-                    temp_root = base
-    
-    file_list = [ af for af in file_list if is_file_supported(af, supported_dict) ]
-    
-    #if _debug:
-    #    fp.close()
-    return file_list
+                    files.append(entry.name)
+        except OSError:
+            return [], []
+    else:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return [], []
+        for name in names:
+            if os.path.isdir(os.path.join(path, name)):
+                if not os.path.islink(os.path.join(path, name)):
+                    subdirs.append(name)
+            else:
+                files.append(name)
+    supported_files = []
+    for name in files:
+        dot = name.rfind(".")
+        if dot > 0 and name[:dot].lstrip(".") and name[dot + 1:].lower() in supported_exts:
+            supported_files.append(name)
+    return supported_files, subdirs
 
-def select_and_update_tag_list(file_list, tag_list, text_index, \
-        n_of_lines_on_screen, base_dir, n_of_cols_on_screen):
-    """When tag-mode is enabled, each line shows tag information (where
-    available and supported) and some audio information.
+def dir_mtime(path):
+    """
+    Returns: the modification time of the directory path, None if it 
+    doesn't exist.
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
 
-    See the help for build_label_from_tag(...)
+def iter_file_list(base_path, supported_exts, recursive=False, n_of_workers=SCAN_WORKERS, \
+        dir_mtimes=None):
+    """Scans the directory base_path, yielding the supported files of each
+    directory as soon as it has been listed. 
 
-    Since reading this information from each file takes some time, we wish
-    to do it only for displayed files. The information about the remaining
-    files in file_list should be read when the list is scrolled by the user
-    and they become visible.
+    Directories are visited in the same order as os.walk(...) does. With
+    n_of_workers > 1, that many threads list the directories ahead of the
+    one being yielded, which pays off on network file systems.
 
-    There is an exception: if the user wants to sort the list we have to
-    build all of the lines' strings, before sorting :|.
+    If dir_mtimes is a dictionary, the modification time of each directory
+    listed is stored in it, the key is the path relative to base_path ("" 
+    for base_path itself). See rescan_library(...)
 
-    file_list is the list of relative paths to the audio files in the
-    playlist. When tagmode is off, each relative path is shown on its line.
+    Returns: a generator of lists of paths relative to base_path.
+    """
+    if not recursive:
+        if dir_mtimes is not None:
+            dir_mtimes[""] = dir_mtime(base_path)
+        yield list_directory(base_path, supported_exts)[0]
+        return
+    
+    if n_of_workers <= 1:
+        stack = [""]
+        while len(stack):
+            rel_path = stack.pop()
+            if dir_mtimes is not None:
+                dir_mtimes[rel_path] = dir_mtime(os.path.join(base_path, rel_path))
+            files, subdirs = list_directory(os.path.join(base_path, rel_path), supported_exts)
+            yield [os.path.join(rel_path, af) for af in files]
+            stack.extend([os.path.join(rel_path, ad) for ad in reversed(subdirs)])
+        return
     
-    The tag-info-label corresponding to a file file_list[i] is tag_list[i].
-    If it hasn't been built yet, tag_list[i] defaults to None.
+    import Queue
+    scan_dict = {"todo":Queue.LifoQueue(), "results":{}, "condition":threading.Condition(), \
+        "cancelled":False, "running":n_of_workers, "mtimes":dir_mtimes is not None}
+    scan_dict["todo"].put("")
+    for i in range(n_of_workers):
+        thread.start_new_thread(scan_thread, (scan_dict, base_path, supported_exts))
+    try:
+        stack = [""]
+        while len(stack):
+            rel_path = stack.pop()
+            scan_dict["condition"].acquire()
+            while not scan_dict["results"].has_key(rel_path):
+                scan_dict["condition"].wait()
+            files, subdirs, mtime = scan_dict["results"].pop(rel_path)
+            scan_dict["condition"].release()
+            if dir_mtimes is not None:
+                dir_mtimes[rel_path] = mtime
+            yield [os.path.join(rel_path, af) for af in files]
+            stack.extend([os.path.join(rel_path, ad) for ad in reversed(subdirs)])
+    finally:
+        scan_dict["cancelled"] = True
+        for i in range(n_of_workers):
+            scan_dict["todo"].put(None)
+        scan_dict["condition"].acquire()
+        while scan_dict["running"]:
+            scan_dict["condition"].wait()
+        scan_dict["condition"].release()
 
-    This method reads only information for the files in file_list in the 
-    range(text_index, text_index + n_of_lines_on_screen).
+def scan_thread(scan_dict, base_path, supported_exts):
+    """A directory listing thread, see iter_file_list(...).
+    Lists the directories in scan_dict["todo"] and stores what it finds in
+    scan_dict["results"]. Subdirectories are added to scan_dict["todo"].
 
-    
-    Returns: the updated tag_list.
+    Returns: when it gets None from scan_dict["todo"].
     """
-    
-    for i in range(text_index, min(text_index + n_of_lines_on_screen, len(file_list))):
-        if tag_list[i] is None:
-            tag_list[i] = build_label_from_tag(os.path.join(base_dir, file_list[i]), n_of_cols_on_screen)
-    return tag_list
+    while True:
+        rel_path = scan_dict["todo"].get()
+        if rel_path is None or scan_dict["cancelled"]:
+            scan_dict["condition"].acquire()
+            scan_dict["running"] = scan_dict["running"] - 1
+            scan_dict["condition"].notifyAll()
+            scan_dict["condition"].release()
+            return
+        mtime = None
+        if scan_dict["mtimes"]:
+            mtime = dir_mtime(os.path.join(base_path, rel_path))
+        files, subdirs = list_directory(os.path.join(base_path, rel_path), supported_exts)
+        for ad in reversed(subdirs):
+            scan_dict["todo"].put(os.path.join(rel_path, ad))
+        scan_dict["condition"].acquire()
+        scan_dict["results"][rel_path] = (files, subdirs, mtime)
+        scan_dict["condition"].notifyAll()
+        scan_dict["condition"].release()
 
-def build_label_from_tag(filename, n_of_cols):
+def load_dir_state(filename=DIR_STATE_FILE):
+    """Loads the state of the last directory scan, saved by 
+    save_dir_state(...).
+
+    Returns: None if there is no valid saved state, otherwise a dictionary
+    with keys:
+    base_dir: the directory scanned (an absolute path)
+    recursive: a boolean, if True subdirs were scanned too
+    dirs: a dictionary, the keys are the paths of the directories scanned
+    relative to base_dir, the values their modification times.
     """
-    The label is built with this format:
-    artist - album - tracknum - title   <white space>   type bitrate length
+    try:
+        fp = open(filename, "rb")
+        try:
+            dir_state = cPickle.load(fp)
+        finally:
+            fp.close()
+    except Exception:
+        return None
+    if not isinstance(dir_state, dict) or not dir_state.has_key("dirs"):
+        return None
+    return dir_state
 
-    This function uses the mutagen module to actually read tags and the
-    other info.
-    
+def save_dir_state(dir_state, filename=DIR_STATE_FILE):
+    """Saves the state of the last directory scan (see load_dir_state(...)).
+    If dir_state is None, the saved state is removed: the playlist saved 
+    with it doesn't come from a directory scan.
 
-    Returns: the label (a unicode string)
+    Returns: None
     """
     try:
-        mutagen.version
-    except NameError:
-        import mutagen, mutagen.mp3, mutagen.easyid3
+        if dir_state is None:
+            if os.path.exists(filename):
+                os.remove(filename)
+            return
+        fp = open(filename + ".tmp", "wb")
+        try:
+            cPickle.dump(dir_state, fp, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        os.rename(filename + ".tmp", filename)
+    except (IOError, OSError):
+        pass
 
-    if filename.lower().endswith(".mp3"):
-        audio = mutagen.mp3.MP3(filename, ID3=mutagen.easyid3.EasyID3)
-    else:
-        audio = mutagen.File(filename)
-    
-    if audio is not None and len(audio.keys()) \
-    and audio.has_key("title") and len(audio["title"][0]) and not audio["title"][0].isspace() \
-    and audio.has_key("artist") and len(audio["artist"][0]) and not audio["artist"][0].isspace():
-        tag_label = audio["artist"][0]
-        if audio.has_key("album") and len(audio["album"][0]) and not audio["album"][0].isspace():
-            tag_label = tag_label + " - " + audio["album"][0]
-        if audio.has_key("tracknumber") and len(audio["tracknumber"][0]) and not audio["tracknumber"][0].isspace():
-            track_num_splitted = audio["tracknumber"][0].split("/")
-            tracknumber = audio["tracknumber"][0]
-            if track_num_splitted[0].isdigit():
-                try:
-                    if int(track_num_splitted[0]) < 10 and int(track_num_splitted[0]) > 0 \
-                    and len(track_num_splitted[0]) == 1:
-                        tracknumber = "0" + track_num_splitted[0]
-                        if len(track_num_splitted) == 2:
-                            tracknumber = tracknumber + "/" + track_num_splitted[1]
-                except ValueError:
-                    pass
-            tag_label = tag_label + " - " + tracknumber
-        tag_label = tag_label + " - " + audio["title"][0]
-    else:
-        tag_label = filename.split(os.sep)[-1]
-    
-    info_label = None
-    if audio is not None:
-        #Now we build the audio info part of the string
-        info_label = ""
-        if audio.mime[0].index("/") > -1:
-            info_label = info_label + audio.mime[0].split("/")[1]
-        else:
-            info_label = info_label + audio.mime[0]
-        if hasattr(audio.info, "bitrate"):
-            info_label = info_label + "  " + " "*(audio.info.bitrate / 1000 < 100) + str(audio.info.bitrate / 1000) + "Kbps"
-        info_label = info_label + " " + " "*(audio.info.length / 60 < 10) + str(int(audio.info.length / 60)) + ":" 
-        info_label = info_label + "0"*(audio.info.length % 60 < 10) + str(int(audio.info.length % 60))
-        info_label = info_label + " "
-        
-        #put all together
-        if len(tag_label) + len(info_label) < n_of_cols:
-            tag_label = tag_label + (n_of_cols - len(tag_label) - len(info_label))*" " + info_label
-        else:
-            tag_label = tag_label[:n_of_cols - len(tag_label) - len(info_label) - 4] + "... " + info_label
+def rebase_file_list(file_list, base_path, new_base_path):
+    """Makes the paths in file_list, relative to base_path, relative to
+    new_base_path.
 
-    #try:
-    #    tag_label = unicode(tag_label)
-    #except UnicodeDecodeError:
-    #    tag_label = unicode(string.decode(tag_label))
-    
-    return sanitize_string(tag_label)
+    Returns: the new file list, None if some file is not in new_base_path.
+    """
+    prefix = os.path.join(new_base_path, "")
+    new_file_list = []
+    for af in file_list:
+        af = os.path.join(base_path, af)
+        if not af.startswith(prefix):
+            return None
+        new_file_list.append(af[len(prefix):])
+    return new_file_list
 
-def play_thread(play_status_dict, play_status_lock, display_status_dict, \
-    display_status_lock, base_dir, support_dict):
-    """ The playing thread. 
-    Starts songs and repaints the screen when the playing song changes.
-    
-    
-    Returns: This method _never_ returns.
+# the parts of the session written to the journal when they change
+SESSION_JOURNAL_KEYS = ("cursor", "tag_mode", "queue", "playing", "continue")
+
+def new_session(base_dir, file_list, dir_state=None):
+    """Builds a session: what kolmogorov needs to start again where it was
+    left (see write_session(...)).
+
+    Returns: a dictionary with keys:
+    generation: identifies the saved session and its journal
+    base_dir, file_list: the playlist (see load_m3u(...))
+    dir_state: the state of the directory scan (see load_dir_state(...)),
+    None if the playlist doesn't come from a scan
+    cursor: (first line on the screen, cursor line on the screen)
+    tag_mode: True if tag mode is on
+    queue: the list of the queued indices (see new_play_queue(...))
+    playing: the index of the playing song, None if there isn't one
+    continue: True if the continuous mode is on
     """
-    play_process = None
-    while True:
-        play_status_lock.acquire()
-        
-        if play_status_dict["todo"] == "start_song":
-            filename = play_status_dict["queue_file"].pop(0)
-            
-            if play_process is not None and play_process.poll() is None:
-                os.kill(play_process.pid, signal.SIGTERM)
-            
-            ext = os.path.splitext(filename.lower())[1]
-            if len(ext) and ext[0] == ".":
-                ext = ext[1:]
-            if support_dict.has_key(ext):
-                play_process = subprocess.Popen(support_dict[ext][0] + [filename], \
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
-                    stderr=subprocess.STDOUT)
-                play_status_dict["pp_pid"] = play_process.pid
-                
-            play_status_dict["todo"] = "do_nothing"
-        
-        elif play_status_dict["todo"] == "stop_song":
-            if play_process is not None and play_process.poll() is None:
-                os.kill(play_process.pid, signal.SIGTERM)
-            
-            play_process = None
-            play_status_dict["pp_pid"] = None
-            play_status_dict["todo"] = "do_nothing"
-        
-        elif play_status_dict["todo"] == "do_nothing":
-            pass
-        
-        play_status_lock.release()
-
-        if play_process is not None and play_process.poll() is not None:
-            play_status_lock.acquire()
-            if len(play_status_dict["queue_index"]) \
-            and len(play_status_dict["queue_file"]):
-                play_status_dict["todo"] = "start_song"
-                display_status_lock.acquire()
-                display_status_dict["abs_hilighted_line"] = \
-                    play_status_dict["queue_index"].pop(0)
-                play_status_lock.release()
-            elif display_status_dict["abs_hilighted_line"] + 1 < \
-            len(display_status_dict["file_list"]) and play_status_dict["continue"]:
-                play_status_dict["todo"] = "start_song"
-                play_status_dict["queue_file"].append(os.path.join(base_dir, \
-                    display_status_dict["file_list"][display_status_dict["abs_hilighted_line"]+1]))
-                play_status_lock.release()
-                display_status_lock.acquire()
-                display_status_dict["abs_hilighted_line"] = display_status_dict["abs_hilighted_line"] + 1
-            else:
-                play_process = None
-                play_status_dict["pp_pid"] = None
-                play_status_lock.release()
-                display_status_lock.acquire()
-                display_status_dict["abs_hilighted_line"] = None
-            
-            if display_status_dict["tag_mode"]:
-                paint_list = display_status_dict["tag_list"]
-            else:
-                paint_list = display_status_dict["file_list"]
-            
-            paint_screen(display_status_dict["stdscr"], paint_list, \
-                display_status_dict["current_cursor_line"], \
-                display_status_dict["current_text_line"], \
-                display_status_dict["abs_hilighted_line"], \
-                play_status_dict["queue_index"], display_status_dict["base_path"], \
-                play_status_dict["continue"])
-            
-            display_status_lock.release()
+    return {"generation":None, "base_dir":base_dir, "file_list":file_list, "dir_state":dir_state, \
+        "cursor":(0, 0), "tag_mode":False, "queue":[], "playing":None, "continue":True}
 
-        else:
-            time.sleep(0.4)
-        time.sleep(0.3)
+def write_session(session, filename=SESSION_FILE, journal_filename=SESSION_JOURNAL_FILE):
+    """Saves session (see new_session(...)), a binary snapshot replaced 
+    atomically, and starts its journal, empty: the changes made after the
+    snapshot are appended to it (see append_session_journal(...)).
 
-def paint_screen(stdscr, file_list, line_index, text_index, hl_abs_index, queue, title, continuous):
-    """Paints the screen.
-    
-    Returns: None
+    A journal belongs to the snapshot with its same generation: if 
+    kolmogorov dies between the two writes, the old journal is ignored.
+
+    Returns: the journal, a file open for writing, None if the session 
+    couldn't be saved.
     """
-    if len(file_list) > curses.LINES - 2:
-        percentual_str = str((100*(text_index + curses.LINES - 2))/(len(file_list))) + "%"
-    else:
-        percentual_str = "100%"
-    stdscr.border()
-    stdscr.addstr(0, (curses.COLS-len(title))/2, title)
-    stdscr.addstr(curses.LINES-1, 2, "kolmogorov " + VERSION)
-    stdscr.addstr(curses.LINES-1, 6 + len("kolmogorov " + VERSION) + (4 - len(percentual_str)), percentual_str)
-    if continuous:
-        stdscr.addstr(curses.LINES-1, 14 + len("kolmogorov " + VERSION), "CONT")
-    
-    max_i = min(len(file_list) - text_index, curses.LINES - 2)
-    for i in range(max_i):
-        if len(file_list[i + text_index]) > curses.COLS - 8:
-            filename = file_list[i + text_index][:curses.COLS-8]
-        else:
-            #print  file_list[i + text_index]
-            filename = file_list[i + text_index] + " "*(curses.COLS - 8 - len(file_list[i + text_index]))
-        if queue.count(i + text_index):
-            queue_index = str(1 + queue.index(i + text_index))
-            stdscr.addstr(i+1, 2 , " "*(len(queue_index)==1) + queue_index)
-        else:
-            stdscr.addstr(i+1, 2, "   ")
-        if hl_abs_index == i + text_index or i == line_index:
-            if hl_abs_index == i + text_index and i == line_index:
-                stdscr.addch(i+1, 5, curses.ACS_DIAMOND)
-                stdscr.addch(i+1, 6, " ")
-                stdscr.addstr(i+1, 7, filename, curses.A_STANDOUT + curses.A_BOLD)
-            elif hl_abs_index == i + text_index:
-                stdscr.addstr(i+1, 5, "  ")
-                stdscr.addstr(i+1, 7, filename, curses.A_STANDOUT) 
-            elif i == line_index:
-                stdscr.addch(i+1, 5, curses.ACS_DIAMOND)
-                stdscr.addch(i+1, 6, " ")
-                stdscr.addstr(i+1, 7, filename, curses.A_BOLD)
-        else:
-            stdscr.addstr(i + 1, 5, "  " + filename)
-    stdscr.refresh()
+    session["generation"] = (time.time(), os.getpid())
+    # the state of the playlist, not the playlist: the pickle doesn't 
+    # depend on the module name
+    saved = dict(session)
+    saved["file_list"] = session["file_list"].__getstate__()
+    tmp_filename = filename + ".tmp"
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        fp = open(tmp_filename, "wb")
+        try:
+            cPickle.dump(saved, fp, cPickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp_filename, filename)
+        journal = open(journal_filename, "wb")
+        cPickle.dump(session["generation"], journal, cPickle.HIGHEST_PROTOCOL)
+        journal.flush()
+        return journal
+    except (IOError, OSError):
+        return None
 
-def main(stdscr, file_list, base_dir, support_dict):
-    """The main method. It holds the main while cycle.
-    
-    Returns: This method _never_ returns. It calls sys.exit
-    
-    Notice that this is different from the __name__ == '__main__' section
-    In that section the options are processed, the file list is read, we 
-    decide which type of audio file we can play and with which programs.
+def append_session_journal(journal, records):
+    """Appends to the journal of a session (see write_session(...)) the 
+    records (key, value): the session had value in key. They reach the 
+    disk before it returns.
 
-    This is the player main method. Here keystrokes are processed.
+    Returns: True if they were written.
     """
-    tag_list = [None]*len(file_list)
-    display_status_dict = {"current_cursor_line":0, "current_text_line":0, "abs_hilighted_line":None, "stdscr":stdscr, \
-            "tag_mode":False, "file_list":file_list, "tag_list":tag_list, "base_path":base_dir}
-    display_status_lock = thread.allocate_lock()
-    
-    tot_lines = len(file_list)
-    
-    play_status_dict = {"queue_file":[], "queue_index":[], "todo":"do_nothing", "pp_pid":None, "continue":True}
-    play_status_lock = thread.allocate_lock()
-    
-    thread.start_new_thread(play_thread, (play_status_dict, play_status_lock, display_status_dict, display_status_lock, \
-        base_dir, support_dict))
+    try:
+        for record in records:
+            cPickle.dump(record, journal, cPickle.HIGHEST_PROTOCOL)
+        journal.flush()
+        os.fsync(journal.fileno())
+        return True
+    except (IOError, OSError):
+        return False
+
+def load_session(filename=SESSION_FILE, journal_filename=SESSION_JOURNAL_FILE):
+    """Loads the session saved by write_session(...), with the changes in
+    its journal. A record cut short by a crash ends the journal.
+
+    Returns: the session (see new_session(...)), None if there is no 
+    valid saved session.
+    """
+    try:
+        fp = open(filename, "rb")
+        try:
+            session = cPickle.load(fp)
+        finally:
+            fp.close()
+    except Exception:
+        return None
+    if not isinstance(session, dict) or not session.has_key("generation") \
+    or not session.has_key("file_list"):
+        return None
+    file_list = Playlist()
+    try:
+        file_list.__setstate__(session["file_list"])
+    except Exception:
+        return None
+    session["file_list"] = file_list
+    try:
+        fp = open(journal_filename, "rb")
+        try:
+            if cPickle.load(fp) == session["generation"]:
+                while True:
+                    key, value = cPickle.load(fp)
+                    if key in SESSION_JOURNAL_KEYS:
+                        session[key] = value
+        finally:
+            fp.close()
+    except Exception:
+        pass
+    return session
+
+def new_session_writer(session, tag_cache=None):
+    """Builds the state of the writer of session (see sync_session(...)).
+    tag_cache (see load_tag_cache(...)) is saved with it, from time to 
+    time.
+
+    Returns: a dictionary with keys:
+    session: session, as it was last written
+    journal: its journal (see write_session(...)), None if there isn't one
+    n_of_records: the number of records in the journal
+    file_list: the playlist saved with it
+    n_of_files: the length of the playlist when it was saved
+    tag_cache: tag_cache
+    tags_saved: when the tag cache was last saved
+    lock: a lock held while the session is written
+    changed: a threading.Event, set when the session may have changed (see
+    request_session_sync(...))
+    """
+    return {"session":session, "journal":None, "n_of_records":0, "file_list":None, "n_of_files":0, \
+        "tag_cache":tag_cache, "tags_saved":time.time(), "lock":thread.allocate_lock(), \
+        "changed":threading.Event()}
+
+def sync_session(writer, display_status_dict, display_status_lock, play_engine, final=False):
+    """Brings the saved session up to date with the user interface and the
+    playing thread (see new_session_writer(...)). 
+
+    The changes are appended to the journal. The whole session is saved 
+    again instead if the playlist changed, as long as it isn't being 
+    scanned, or if the journal grew beyond SESSION_JOURNAL_MAX_RECORDS 
+    records. If final is True the session is saved anyway, without the
+    playing song: kolmogorov is quitting. An empty playlist is never saved,
+    like the m3u playlist (see main(...)): the last session is kept.
+
+    The entries stored in the tag cache are saved too, every 
+    TAG_CACHE_SAVE_INTERVAL seconds (see append_tag_cache(...)).
 
-    # main loop: paint the screen, get a char, act accordigly, rinse, repeat
-    # may switch to non-blocking getch...
-    while(True):
+    Returns: None
+    """
+    writer["lock"].acquire()
+    try:
+        session = writer["session"]
         display_status_lock.acquire()
-        if display_status_dict["tag_mode"]:
-            display_status_dict["tag_list"] = select_and_update_tag_list(display_status_dict["file_list"], \
-                display_status_dict["tag_list"], display_status_dict["current_text_line"], curses.LINES - 2, \
-                base_dir, curses.COLS - 8)
-            paint_list = display_status_dict["tag_list"]
-        else:
-            paint_list = display_status_dict["file_list"]
-        paint_screen(display_status_dict["stdscr"], paint_list, \
-            display_status_dict["current_cursor_line"], display_status_dict["current_text_line"], \
-            display_status_dict["abs_hilighted_line"], play_status_dict["queue_index"], \
-            display_status_dict["base_path"], play_status_dict["continue"])
-        display_status_lock.release()
-        
-        ch = stdscr.getch()
-        
-        if ch == ord("q"):
-            play_status_lock.acquire()
-            if play_status_dict["pp_pid"]:
-                os.kill(play_status_dict["pp_pid"], signal.SIGTERM)
-            play_status_lock.release()
-            break
-        
-        elif ch == curses.KEY_DOWN or ch == ord("j"): 
-            if display_status_dict["current_cursor_line"] + 1 < min(curses.LINES - 2, tot_lines):
-                display_status_lock.acquire()
-                display_status_dict["current_cursor_line"] = display_status_dict["current_cursor_line"] + 1
-                display_status_lock.release()
-            elif display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"] + 1 < tot_lines:
-                display_status_lock.acquire()
-                display_status_dict["current_text_line"] = display_status_dict["current_text_line"] + 1
-                display_status_lock.release()
-        
-        elif ch == curses.KEY_UP or ch == ord("k"):
-            if display_status_dict["current_cursor_line"] > 0:
-                display_status_lock.acquire()
-                display_status_dict["current_cursor_line"] = display_status_dict["current_cursor_line"] - 1
-                display_status_lock.release()
-            elif display_status_dict["current_text_line"] > 0:
-                display_status_lock.acquire()
-                display_status_dict["current_text_line"] = display_status_dict["current_text_line"] - 1
-                display_status_lock.release()
-        
-        elif ch == curses.KEY_NPAGE:
-            step = curses.LINES - 4
-            if display_status_dict["current_text_line"] + step + curses.LINES - 2 < tot_lines:
-                display_status_lock.acquire()
-                display_status_dict["current_text_line"] = display_status_dict["current_text_line"] + step
-                display_status_dict["current_cursor_line"] = 0
-                display_status_lock.release()
-            elif tot_lines > curses.LINES - 2:
-                display_status_lock.acquire()
-                display_status_dict["current_text_line"] = tot_lines - curses.LINES + 2
-                display_status_dict["current_cursor_line"] = curses.LINES - 3
-                display_status_lock.release()
-            else:
-                display_status_lock.acquire()
-                display_status_dict["current_cursor_line"] = tot_lines - 1
-                display_status_lock.release()
-        
-        elif ch == curses.KEY_PPAGE:
-            step = curses.LINES - 4
-            if display_status_dict["current_text_line"] - step > 0:
-                display_status_lock.acquire()
-                display_status_dict["current_text_line"] = display_status_dict["current_text_line"] - step
-            else:
-                display_status_lock.acquire()
-                display_status_dict["current_text_line"] = 0
-            display_status_dict["current_cursor_line"] = 0
+        file_list = display_status_dict["file_list"]
+        state = play_engine["state"]
+        if state["file_list"] is not file_list:
+            # the playing thread isn't told about the new playlist yet
             display_status_lock.release()
-        
-        elif ch == curses.KEY_END:
-            display_status_lock.acquire()
-            display_status_dict["current_cursor_line"] = min(tot_lines, curses.LINES - 2) - 1
-            display_status_dict["current_text_line"] = max(tot_lines, curses.LINES - 2) - curses.LINES + 2
+            return
+        if not len(file_list):
+            # an empty or unreadable directory was scanned
             display_status_lock.release()
-        
-        elif ch == curses.KEY_HOME:
-            display_status_lock.acquire()
-            display_status_dict["current_cursor_line"] = 0
-            display_status_dict["current_text_line"] = 0
+            return
+        current = {"cursor":(display_status_dict["current_text_line"], \
+            display_status_dict["current_cursor_line"]), "tag_mode":display_status_dict["tag_mode"], \
+            "queue":list(state["queue"]["order"]), "playing":state["playing"], \
+            "continue":state["continue"]}
+        if final:
+            current["playing"] = None
+        list_changed = file_list is not writer["file_list"] or len(file_list) != writer["n_of_files"]
+        busy = display_status_dict["scanning"] or display_status_dict["rescanning"]
+        if list_changed and busy and not final:
+            # saved when the scan is over, the indices may be past the 
+            # end of the saved playlist until then
             display_status_lock.release()
+            return
+        if list_changed:
+            writer["file_list"] = file_list
+            writer["n_of_files"] = len(file_list)
+            session["file_list"] = file_list.copy()
+            dir_state = display_status_dict["dir_state"]
+            if dir_state is not None:
+                dir_state = dict(dir_state)
+                dir_state["dirs"] = dict(dir_state["dirs"])
+            session["dir_state"] = dir_state
+        display_status_lock.release()
         
-        elif ch == curses.KEY_ENTER or ch == ord(" "):
-            if display_status_dict["abs_hilighted_line"] == display_status_dict["current_text_line"] + \
-            display_status_dict["current_cursor_line"]:
-                display_status_lock.acquire()
-                display_status_dict["abs_hilighted_line"] = None
-                display_status_lock.release()
-                play_status_lock.acquire()
-                play_status_dict["todo"] = "stop_song"
-                play_status_lock.release()
-            else:
-                display_status_lock.acquire()
-                display_status_dict["abs_hilighted_line"] = display_status_dict["current_text_line"] + \
-                    display_status_dict["current_cursor_line"]
-                display_status_lock.release()
-                
-                play_status_lock.acquire()
-                if not len(play_status_dict["queue_index"]) \
-                        or play_status_dict["queue_index"][0] != \
-                        display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"]:
-                    play_status_dict["queue_file"].insert(0, \
-                        os.path.join(base_dir, display_status_dict["file_list"][display_status_dict["current_text_line"] \
-                        + display_status_dict["current_cursor_line"]]))
-                elif play_status_dict["queue_index"][0] == \
-                        display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"]:
-                    play_status_dict["queue_index"].pop(0)
-                #play_status_dict["queue_index"].insert(0, display_status_dict["abs_hilighted_line"])
-                play_status_dict["todo"] = "start_song"
-                play_status_lock.release()
-        
-        elif ch == ord("+"):
-            play_status_lock.acquire()
-            if not play_status_dict["queue_index"].count(display_status_dict["current_text_line"] + \
-                    display_status_dict["current_cursor_line"]):
-                play_status_dict["queue_index"].append(display_status_dict["current_text_line"] + \
-                    display_status_dict["current_cursor_line"])
-                play_status_dict["queue_file"].append(os.path.join(base_dir, \
-                    display_status_dict["file_list"][display_status_dict["current_text_line"] + \
-                    display_status_dict["current_cursor_line"]]))
-            play_status_lock.release()
-        
-        elif ch == ord("-"):
-            play_status_lock.acquire()
-            if play_status_dict["queue_index"].count(display_status_dict["current_text_line"] + \
-                    display_status_dict["current_cursor_line"]):
-                play_status_dict["queue_file"].pop(play_status_dict["queue_index"]\
-                    .index(display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"]))
-                play_status_dict["queue_index"].remove(display_status_dict["current_text_line"] + \
-                    display_status_dict["current_cursor_line"])
-            play_status_lock.release()
-        
-        elif ch == ord("c"):
-            play_status_lock.acquire()
-            play_status_dict["continue"] = not play_status_dict["continue"]
-            play_status_lock.release()
-        
-        elif ch == ord("S"):
-            if display_status_dict["abs_hilighted_line"] is not None and \
-                    display_status_dict["abs_hilighted_line"] < display_status_dict["current_text_line"] or \
-                    display_status_dict["abs_hilighted_line"] > display_status_dict["current_text_line"] + \
-                    curses.LINES + 2 - 5: # wtf shouldn't this be -1 ??
-                display_status_lock.acquire()
-                if len(display_status_dict["file_list"]) - display_status_dict["abs_hilighted_line"] >= curses.LINES -2:
-                    display_status_dict["current_text_line"] = display_status_dict["abs_hilighted_line"] - \
-                        1*(display_status_dict["abs_hilighted_line"] > 0)
-                    display_status_dict["current_cursor_line"] = 1 
-                else:
-                    display_status_dict["current_text_line"] = len(display_status_dict["file_list"]) - curses.LINES -2 +4
-                    display_status_dict["current_cursor_line"] = display_status_dict["abs_hilighted_line"] - \
-                        display_status_dict["current_text_line"]
-                display_status_lock.release()
-        
-        elif ch == ord("s"):
-            if not display_status_dict["tag_mode"]:
-                display_status_lock.acquire()
-                display_status_dict["file_list"], display_status_dict["tag_list"], \
-                    display_status_dict["abs_hilighted_line"] = \
-                    sort_playlist(display_status_dict["file_list"], display_status_dict["tag_list"], \
-                    display_status_dict["abs_hilighted_line"])
-                display_status_lock.release()
+        records = [(key, current[key]) for key in SESSION_JOURNAL_KEYS if current[key] != session[key]]
+        session.update(current)
+        if list_changed or final or writer["journal"] is None \
+        or writer["n_of_records"] + len(records) > SESSION_JOURNAL_MAX_RECORDS:
+            if writer["journal"] is not None:
+                writer["journal"].close()
+            start = time.time()
+            writer["journal"] = write_session(session)
+            writer["n_of_records"] = 0
+            record_time("session save", time.time() - start)
+        elif len(records):
+            if append_session_journal(writer["journal"], records):
+                writer["n_of_records"] = writer["n_of_records"] + len(records)
             else:
-                display_status_lock.acquire()
-                # First we need to read all tags, then we can sort.
-                display_status_dict["tag_list"] = select_and_update_tag_list(display_status_dict["file_list"], \
-                    display_status_dict["tag_list"], 0, len(display_status_dict["file_list"]), base_dir, curses.COLS -8)
-                
-                display_status_dict["tag_list"], display_status_dict["file_list"], \
-                    display_status_dict["abs_hilighted_line"] = \
-                    sort_playlist(display_status_dict["tag_list"], display_status_dict["file_list"], \
-                    display_status_dict["abs_hilighted_line"])
-                display_status_lock.release()
-
+                writer["journal"].close()
+                writer["journal"] = None
         
-        elif ch == ord("T") and TAG_SUPPORT:
-            display_status_lock.acquire()
-            display_status_dict["tag_mode"] = not display_status_dict["tag_mode"]
-            display_status_lock.release()
-        
-        elif ch == ord("r"):
-            display_status_lock.acquire()
-            stdscr.clearok(1)
-            display_status_lock.release()
-    # end of while
-    write_m3u(display_status_dict["file_list"], base_dir, os.path.expanduser("~/.kolmogorov_playlist.m3u"))
-    #fp = open(os.path.expanduser("~/.kolmogorov_playlist"), "w")
-    #cPickle.dump((base_dir, display_status_dict["file_list"]), fp)
-    #fp.close()
-    sys.exit(0)
+        tag_cache = writer["tag_cache"]
+        if tag_cache is not None and not final \
+        and time.time() - writer["tags_saved"] >= TAG_CACHE_SAVE_INTERVAL:
+            start = time.time()
+            append_tag_cache(tag_cache)
+            writer["tags_saved"] = time.time()
+            record_time("tag cache save", writer["tags_saved"] - start)
+    finally:
+        writer["lock"].release()
 
-if __name__ == '__main__':
-    recursive = False
-    sort = False
+def request_session_sync(writer):
+    """Tells the session thread that the session may have changed (see 
+    session_thread(...)).
 
-    try:
-        opts, args = getopt.getopt(sys.argv[1:], "hLVrstp", ("help", "license", "version", "recursive", "sort", "tag", "players"))
-    except getopt.GetoptError:
-        usage()
-        sys.exit(2)
+    Returns: None
+    """
+    writer["changed"].set()
 
-    for option, a  in opts:
-        if option in ("-h", "--help"):
-            usage()
-            sys.exit(9)
-        if option in ("-L", "--license"):
-            print __doc__
-            sys.exit(0)
-        if option in ("-V", "--version"):
-            print VERSION
-            sys.exit(10)
-        if option in ("-p", "--players"):
-            print_players()
-            sys.exit(10)
-        if option in ("-r", "--recursive"):
-            recursive = True
-        if option in ("-s", "--sort"):
-            sort = True
-        if option in ("-t", "--tag"):
-            print "Tag support (through mutagen): " + str(TAG_SUPPORT)
-            sys.exit(11)
+def session_thread(writer, display_status_dict, display_status_lock, play_engine):
+    """The session thread.
+    Sleeps until request_session_sync(...) is called, then, 
+    SESSION_SYNC_INTERVAL seconds later, writes the changes to the session
+    (see sync_session(...)). It never wakes up while kolmogorov is idle.
 
-    try:
-        subprocess.Popen(("which", ), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    except OSError:
-        print "Error: Kolmogorov requires the userland *NIX utility \"which\" to work."
-        print "Add which to your PATH or hack the code and manually set mp3/ogg support."
-        sys.exit(10)
+    Returns: This method _never_ returns.
+    """
+    while True:
+        # no timeout: threading waits with a timeout poll
+        writer["changed"].wait()
+        time.sleep(SESSION_SYNC_INTERVAL)
+        writer["changed"].clear()
+        sync_session(writer, display_status_dict, display_status_lock, play_engine)
 
-    s = subprocess.Popen(("which", "ls"), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    if s.wait() != 0:
-        print "Error: Kolmogorov requires the userland *NIX utility \"ls\" to work."
-        print "Add which to your PATH or hack the code."
-        sys.exit(10)
+def open_library(filename=LIBRARY_FILE):
+    """Opens the library, a sqlite database of the files in the music 
+    roots and of their tags (see update_library(...)), and creates its 
+    tables if they are not there:
+    roots: the music roots, absolute paths.
+    tracks: a row for each file, its absolute path, its root, mtime and 
+    size, the tag information read from it (see read_tag_info(...)): the
+    tags, the track number and the year as integers, mime, bitrate and
+    length.
+    playlists: the queries saved by name (see query_library(...)).
+
+    Tags are stored as unicode strings, compared case-insensitively (ASCII
+    only, as sqlite does). Paths, which may not be UTF-8, the names and 
+    the queries of the playlists are stored as blobs (see 
+    library_blob(...)). Tracks are indexed by path, root, artist (then 
+    album and track), album (then track), year and mtime.
+
+    Returns: the connection (see the sqlite3 module)
+    """
+    import sqlite3
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    library = sqlite3.connect(filename)
+    library.executescript("""
+        create table if not exists roots (path text primary key);
+        create table if not exists tracks (path text primary key, root text, mtime real, size integer, 
+            artist text collate nocase, album text collate nocase, tracknumber text, 
+            track integer, title text collate nocase, date text, year integer, 
+            mime text, bitrate integer, length real, tagged integer);
+        create index if not exists tracks_root on tracks (root);
+        create index if not exists tracks_artist on tracks (artist, album, track);
+        create index if not exists tracks_album on tracks (album, track);
+        create index if not exists tracks_year on tracks (year);
+        create index if not exists tracks_mtime on tracks (mtime);
+        create table if not exists playlists (name text primary key, query text);
+    """)
+    return library
+
+def library_blob(astring):
+    """sqlite3 refuses byte strings which are not ASCII as text: paths, 
+    which may be in any encoding, are stored as blobs, byte for byte.
+
+    Returns: astring (a byte string, or unicode, stored as UTF-8) as a blob
+    """
+    if isinstance(astring, unicode):
+        astring = astring.encode("utf-8")
+    return buffer(astring)
+
+def library_text(astring):
+    """
+    Returns: astring as a unicode string, to compare it to the tags in the
+    library. Byte strings are UTF-8, bad bytes are replaced.
+    """
+    if isinstance(astring, str):
+        return astring.decode("utf-8", "replace")
+    return astring
+
+def add_library_root(library, path):
+    """Adds the directory path to the music roots of the library. Its files
+    are added by update_library(...).
+
+    Returns: None
+    """
+    library.execute("insert or ignore into roots values (?)", (library_blob(path), ))
+    library.commit()
+
+def library_roots(library):
+    """
+    Returns: the list of the music roots of the library.
+    """
+    return [str(row[0]) for row in library.execute("select cast(path as blob) from roots order by path")]
+
+def library_row(filename, root, mtime, size, info):
+    """
+    Returns: the row of filename in the tracks table of the library (see
+    open_library(...)), info is its tag information (see 
+    read_tag_info(...)) or None.
+    """
+    filename, root = library_blob(filename), library_blob(root)
+    if info is None:
+        return (filename, root, mtime, size, None, None, None, None, None, None, None, None, None, \
+            None, 0)
+    track = year = None
+    if info["tracknumber"] is not None:
+        try:
+            track = int(info["tracknumber"].split("/")[0])
+        except ValueError:
+            pass
+    date = info.get("date")
+    if date is not None and date[:4].isdigit():
+        year = int(date[:4])
+    return (filename, root, mtime, size, info["artist"], info["album"], info["tracknumber"], track, \
+        info["title"], date, year, info["mime"], info["bitrate"], info["length"], 1)
+
+def update_library(library, supported_exts, n_of_workers=SCAN_WORKERS, \
+        n_of_processes=TAG_SORT_PROCESSES, tag_cache=None):
+    """Brings the library up to date with the files in its music roots: 
+    each root is scanned recursively (see iter_file_list(...)), listing 
+    n_of_workers directories at a time. Files filtered through 
+    supported_exts (see supported_extensions(...)) which are new or whose
+    mtime or size changed get their tags read, through tag_cache if given,
+    by n_of_processes processes (see read_tag_batch(...)). Files that 
+    don't exist anymore are dropped.
+
+    Returns: a list of tuples (root, files, updated, removed): the number
+    of files in each root, of the ones added or changed, of the ones 
+    dropped.
+    """
+    summary = []
+    for root in library_roots(library):
+        known = dict([(str(row[0]), (row[1], row[2])) for row in \
+            library.execute("select cast(path as blob), mtime, size from tracks where root = ?", \
+            (library_blob(root), ))])
+        n_of_files = 0
+        rows = []
+        unread = []
+        for files in iter_file_list(root, supported_exts, True, n_of_workers):
+            for af in files:
+                filename = os.path.join(root, af)
+                n_of_files = n_of_files + 1
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if known.pop(filename, None) == (st.st_mtime, st.st_size):
+                    continue
+                entry = tag_cache is not None and tag_cache["entries"].get(filename)
+                if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+                    rows.append(library_row(filename, root, st.st_mtime, st.st_size, entry[3]))
+                else:
+                    unread.append(filename)
+        
+        batches = [unread[i:i + TAG_SORT_BATCH_SIZE] for i in range(0, len(unread), TAG_SORT_BATCH_SIZE)]
+        pool = None
+        if len(batches) > 1 and n_of_processes > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(n_of_processes, len(batches)), init_tag_sort_process)
+            results = pool.imap_unordered(read_tag_batch, batches)
+        else:
+            results = (read_tag_batch(batch) for batch in batches)
+        start = time.time()
+        try:
+            for batch in results:
+                for filename, mtime, size, info in batch:
+                    if mtime is None:
+                        continue
+                    rows.append(library_row(filename, root, mtime, size, info))
+                    if tag_cache is not None:
+                        store_tag_info(tag_cache, filename, mtime, size, info)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        record_time("library tag read", time.time() - start)
+        
+        library.executemany("insert or replace into tracks values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+            rows)
+        library.executemany("delete from tracks where path = ?", [(library_blob(filename), ) \
+            for filename in known])
+        library.commit()
+        summary.append((root, n_of_files, len(rows), len(known)))
+    return summary
+
+# the fields of library queries and the conversion of their values (see
+# parse_library_query(...))
+LIBRARY_FIELDS = {"artist":library_text, "album":library_text, "title":library_text, "track":int, \
+    "year":int, "date":library_text, "length":float, "bitrate":int, "mime":library_text, \
+    "path":library_blob, "root":library_blob, "mtime":float}
+# the operators of library queries, ~ matches a part of the text
+LIBRARY_OPERATORS = ("=", "!=", "<", ">", "<=", ">=", "~")
+# the order of the files of a library query without order by: as 
+# tag_sort_key(...) sorts them
+LIBRARY_DEFAULT_ORDER = (("artist", False), ("album", False), ("track", False), ("title", False), \
+    ("path", False))
+
+def parse_library_query(query):
+    """Parses query, a library query:
+    [condition [and condition ...]] [order by field [desc][, field [desc] ...]]
+    A condition is field operator value. The fields are in LIBRARY_FIELDS,
+    the operators in LIBRARY_OPERATORS. The value may be quoted ("..." or 
+    '...'), if not, it's made of the words up to the next "and" or "order
+    by". Keywords and fields are case-insensitive, so are comparisons of 
+    text. Examples: 
+    artist = Pink Floyd order by year, album, track
+    year >= 1990 and year < 2000 and album ~ live
+
+    Raises ValueError if query is not valid.
+
+    Returns: (where, parameters, order), the SQL condition (None for all 
+    the files), its parameters, a list of (field, descending) tuples.
+    """
+    tokens = re.findall(r"\"[^\"]*\"|'[^']*'|!=|<=|>=|[=<>~,]|[^\s=<>!~,]+", query)
+    conditions = []
+    parameters = []
+    order = []
+    position = 0
+    while position < len(tokens):
+        if [token.lower() for token in tokens[position:position + 2]] == ["order", "by"]:
+            break
+        if len(conditions):
+            if tokens[position].lower() != "and":
+                raise ValueError("expected and or order by, not " + tokens[position])
+            position = position + 1
+        if position + 2 >= len(tokens):
+            raise ValueError("incomplete condition: " + " ".join(tokens[position:]))
+        field, operator = tokens[position].lower(), tokens[position + 1]
+        if not LIBRARY_FIELDS.has_key(field):
+            raise ValueError("unknown field " + tokens[position])
+        if operator not in LIBRARY_OPERATORS:
+            raise ValueError("unknown operator " + operator)
+        position = position + 2
+        if tokens[position][0] in "\"'":
+            value = tokens[position][1:-1]
+            position = position + 1
+        else:
+            words = []
+            while position < len(tokens) and tokens[position].lower() != "and" \
+            and [token.lower() for token in tokens[position:position + 2]] != ["order", "by"]:
+                words.append(tokens[position])
+                position = position + 1
+            value = " ".join(words)
+        if operator == "~":
+            value = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            if LIBRARY_FIELDS[field] is library_blob:
+                # like doesn't match blobs, their bytes are matched as text
+                conditions.append("cast(" + field + " as text) like cast(? as text) escape '\\'")
+                parameters.append(library_blob("%" + value + "%"))
+            else:
+                conditions.append(field + " like ? escape '\\'")
+                parameters.append(library_text("%" + value + "%"))
+            continue
+        try:
+            value = LIBRARY_FIELDS[field](value)
+        except ValueError:
+            raise ValueError(field + " is a number, not " + value)
+        if operator == "!=":
+            # files without the tag too
+            conditions.append("(" + field + " is null or " + field + " != ?)")
+        else:
+            conditions.append(field + " " + operator + " ?")
+        parameters.append(value)
+    
+    if position < len(tokens):
+        position = position + 2
+        while True:
+            if position >= len(tokens) or not LIBRARY_FIELDS.has_key(tokens[position].lower()):
+                raise ValueError("expected a field after order by")
+            descending = position + 1 < len(tokens) and tokens[position + 1].lower() == "desc"
+            order.append((tokens[position].lower(), descending))
+            position = position + 1 + descending
+            if position == len(tokens):
+                break
+            if tokens[position] != ",":
+                raise ValueError("expected , not " + tokens[position])
+            position = position + 1
+    if not len(order):
+        order = list(LIBRARY_DEFAULT_ORDER)
+    if len(conditions):
+        return " and ".join(conditions), parameters, order
+    return None, parameters, order
+
+def save_library_query(library, name, query):
+    """Saves query as the playlist name (see query_library(...)).
+
+    Raises ValueError if query is not valid.
+
+    Returns: None
+    """
+    parse_library_query(query)
+    library.execute("insert or replace into playlists values (?, ?)", (library_blob(name), \
+        library_blob(query)))
+    library.commit()
+
+def library_playlists(library):
+    """
+    Returns: the list of the playlists saved in the library, tuples (name,
+    query).
+    """
+    return [(str(name), str(query)) for name, query in \
+        library.execute("select cast(name as blob), cast(query as blob) from playlists order by name")]
+
+def query_library(library, query):
+    """Runs query, a library query (see parse_library_query(...)) or the 
+    name of a saved one (see save_library_query(...)), with a single
+    indexed select.
+
+    Raises ValueError if query is not valid.
+
+    Returns: (file_list, base_dir, tag_info): the files found relative to
+    base_dir, their common directory, and their tag information, a 
+    dictionary like the one of load_m3u(...), None for the files whose 
+    tags can't be read.
+    """
+    saved = library.execute("select cast(query as blob) from playlists where name = ?", \
+        (library_blob(query), )).fetchone()
+    if saved is not None:
+        query = str(saved[0])
+    where, parameters, order = parse_library_query(query)
+    sql = "select cast(path as blob), tagged, artist, album, tracknumber, title, date, mime, bitrate, length " + \
+        "from tracks"
+    if where is not None:
+        sql = sql + " where " + where
+    sql = sql + " order by " + ", ".join([field + (descending and " desc" or "") \
+        for field, descending in order])
+    start = time.time()
+    rows = library.execute(sql, parameters).fetchall()
+    record_time("library query", time.time() - start)
+    
+    if not len(rows):
+        return [], os.sep, {}
+    filenames = [str(row[0]) for row in rows]
+    prefix = os.path.commonprefix([filenames[0], filenames[-1]])
+    for filename in filenames:
+        if not filename.startswith(prefix):
+            prefix = os.path.commonprefix([prefix, filename])
+    base_dir = prefix[:prefix.rfind(os.sep)] or os.sep
+    cut = len(os.path.join(base_dir, ""))
+    tag_info = {}
+    for filename, (path, tagged, artist, album, tracknumber, title, date, mime, bitrate, length) \
+            in zip(filenames, rows):
+        if tagged:
+            tag_info[filename] = {"artist":artist, "album":album, "tracknumber":tracknumber, \
+                "title":title, "date":date, "mime":mime and str(mime), "bitrate":bitrate, "length":length}
+        else:
+            tag_info[filename] = None
+    return [filename[cut:] for filename in filenames], base_dir, tag_info
+
+def rescan_library(base_dir, file_list, dir_state, supported_exts, n_of_workers=SCAN_WORKERS, \
+        dirty=None):
+    """Finds the files added to or removed from base_dir since it was 
+    scanned. 
+    
+    Only the directories whose modification time changed are listed 
+    again, new subdirectories are scanned. dir_state (see 
+    load_dir_state(...)) is updated.
+
+    dirty, if given, is a list of directories (relative to base_dir) known
+    to be changed: only those are listed, whatever their modification time.
+
+    file_list is the list of files (relative to base_dir) in the playlist.
+
+    Returns: (added, removed), two lists of paths relative to base_dir.
+    """
+    dirs = dir_state["dirs"]
+    files_by_dir = {}
+    for af in file_list:
+        rel_dir, name = os.path.split(af)
+        if files_by_dir.has_key(rel_dir):
+            files_by_dir[rel_dir].add(name)
+        else:
+            files_by_dir[rel_dir] = set([name])
+    subdirs_by_dir = {}
+    for rel_dir in dirs.keys():
+        if rel_dir != "":
+            subdirs_by_dir.setdefault(os.path.dirname(rel_dir), set()).add(rel_dir)
+
+    def remove_tree(rel_dir, removed):
+        for rel_subdir in list(subdirs_by_dir.get(rel_dir, ())):
+            remove_tree(rel_subdir, removed)
+        removed.extend([os.path.join(rel_dir, af) for af in files_by_dir.pop(rel_dir, ())])
+        dirs.pop(rel_dir, None)
+    
+    added = []
+    removed = []
+    if dirty is None:
+        to_check = sorted(dirs.keys())
+    else:
+        to_check = sorted(dirty)
+    for rel_dir in to_check:
+        if not dirs.has_key(rel_dir):
+            # removed with its parent
+            continue
+        path = os.path.join(base_dir, rel_dir)
+        mtime = dir_mtime(path)
+        if mtime is None:
+            remove_tree(rel_dir, removed)
+            continue
+        if dirty is None and mtime == dirs[rel_dir]:
+            continue
+        dirs[rel_dir] = mtime
+        files, subdirs = list_directory(path, supported_exts)
+        old_files = files_by_dir.get(rel_dir, set())
+        removed.extend([os.path.join(rel_dir, af) for af in old_files.difference(files)])
+        added.extend([os.path.join(rel_dir, af) for af in files if af not in old_files])
+        if not dir_state["recursive"]:
+            continue
+        subdirs = [os.path.join(rel_dir, ad) for ad in subdirs]
+        for rel_subdir in subdirs_by_dir.get(rel_dir, set()).difference(subdirs):
+            remove_tree(rel_subdir, removed)
+        for rel_subdir in subdirs:
+            if dirs.has_key(rel_subdir):
+                continue
+            dir_mtimes = {}
+            for files in iter_file_list(os.path.join(base_dir, rel_subdir), supported_exts, True, \
+                    n_of_workers, dir_mtimes):
+                added.extend([os.path.join(rel_subdir, af) for af in files])
+            for rel_path, mtime in dir_mtimes.items():
+                dirs[os.path.join(rel_subdir, rel_path).rstrip(os.sep)] = mtime
+    return added, removed
+
+def merge_rescan(display_status_dict, play_engine, added, removed):
+    """Merges the result of rescan_library(...) into the playlist.
+
+    Added files are appended to the playlist. The cursor, the playing 
+    song and the queue keep pointing to the same files, unless they were
+    removed (see replace_playlist(...)).
+
+    Must be called with display_status_lock held.
+
+    Returns: None
+    """
+    clear_filter(display_status_dict)
+    file_list = display_status_dict["file_list"]
+    tag_list = display_status_dict["tag_list"]
+    removed = set(removed)
+    if len(removed):
+        kept = []
+        # new_index[i] is the new index of file_list[i], None if it was
+        # removed
+        new_index = []
+        for i in xrange(len(file_list)):
+            if file_list[i] in removed:
+                new_index.append(None)
+            else:
+                new_index.append(len(kept))
+                kept.append(i)
+        new_file_list = take(file_list, kept)
+        new_tag_list = take(tag_list, kept)
+        
+        cursor_index = display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"]
+        if cursor_index < len(file_list):
+            # the first file kept from the cursor on
+            while cursor_index < len(file_list) and new_index[cursor_index] is None:
+                cursor_index = cursor_index + 1
+            if cursor_index < len(file_list):
+                cursor_index = new_index[cursor_index]
+            cursor_index = min(cursor_index, max(len(new_file_list) - 1, 0))
+            display_status_dict["current_text_line"] = max(cursor_index - \
+                display_status_dict["current_cursor_line"], 0)
+            display_status_dict["current_cursor_line"] = cursor_index - \
+                display_status_dict["current_text_line"]
+        
+        replace_playlist(display_status_dict, play_engine, new_file_list, new_tag_list, new_index)
+        file_list = new_file_list
+        tag_list = new_tag_list
+    
+    if len(added):
+        listed = set(file_list)
+        added = [af for af in added if af not in listed]
+        file_list.extend(added)
+        tag_list.extend([None]*len(added))
+
+def read_tag_batch(filenames):
+    """Reads the tag information of filenames, in one of the processes of
+    tag_sort_thread(...).
+
+    Returns: a list of tuples (filename, mtime, size, info), where info is
+    what read_tag_info(...) returned, None if the tags can't be read. mtime
+    and size are None if the file doesn't exist.
+    """
+    reader = new_tag_reader()
+    results = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            results.append((filename, None, None, None))
+            continue
+        try:
+            info = read_tag_info(filename, reader)
+        except Exception:
+            info = None
+        results.append((filename, st.st_mtime, st.st_size, info))
+    return results
+
+def load_tag_cache(filename=TAG_CACHE_FILE, background=False):
+    """Loads the tag cache saved by save_tag_cache(...), with the entries
+    appended to its journal by append_tag_cache(...). If background is 
+    True, the cache is returned empty and filled by tag_cache_thread(...):
+    the entries are looked up and stored meanwhile, the key loaded is set
+    when it's done.
+
+    The tag cache is a dictionary with keys:
+    entries: a dictionary, the keys are absolute paths, the values are
+    tuples (mtime, size, last_used, info). info is what read_tag_info(...)
+    returned for the file when it had that mtime and size.
+    stamp: the time the cache was loaded, used as last_used for the entries
+    looked up in this session.
+    filename: where the cache is saved.
+    dirty: the set of the paths stored or dropped since the cache was last
+    saved (see store_tag_info(...)).
+    generation: the generation of the saved cache, its journal belongs to it
+    journal: the journal, a file open for writing, None until it's needed
+    journal_end: the end of the valid records in the journal
+    n_of_records: the number of records in the journal
+    loaded: a threading.Event, set when the saved cache is loaded
+    lock: a lock held while the cache is saved
+
+    A missing or unreadable cache file gives an empty cache.
+
+    Returns: the tag cache (a dictionary)
+    """
+    tag_cache = {"entries":{}, "stamp":int(time.time()), "filename":filename, "dirty":set(), \
+        "generation":None, "journal":None, "journal_end":None, "n_of_records":0, \
+        "loaded":threading.Event(), "lock":thread.allocate_lock()}
+    if background:
+        thread.start_new_thread(tag_cache_thread, (tag_cache, ))
+    else:
+        tag_cache_thread(tag_cache)
+    return tag_cache
+
+def tag_cache_thread(tag_cache):
+    """The thread loading the tag cache (see load_tag_cache(...)): the saved
+    cache, then the records of its journal, if it belongs to it. A record 
+    cut short by a crash ends the journal. 
+    The entries stored while it loads are kept, the ones added by 
+    seed_tag_cache(...) only if the saved cache doesn't have them.
+
+    Returns: when the cache is loaded.
+    """
+    start = time.time()
+    loaded = {}
+    generation = None
+    try:
+        fp = open(tag_cache["filename"], "rb")
+        try:
+            generation = cPickle.load(fp)
+            if isinstance(generation, dict):
+                # saved without a journal
+                loaded, generation = generation, None
+            else:
+                loaded = cPickle.load(fp)
+        finally:
+            fp.close()
+        if not isinstance(loaded, dict):
+            loaded, generation = {}, None
+    except Exception:
+        loaded, generation = {}, None
+    journal_end = None
+    n_of_records = 0
+    if generation is not None:
+        try:
+            fp = open(tag_cache["filename"] + ".journal", "rb")
+            try:
+                if cPickle.load(fp) == generation:
+                    journal_end = fp.tell()
+                    while True:
+                        try:
+                            filename, entry = cPickle.load(fp)
+                        except Exception:
+                            break
+                        if entry is None:
+                            loaded.pop(filename, None)
+                        else:
+                            loaded[filename] = entry
+                        journal_end = fp.tell()
+                        n_of_records = n_of_records + 1
+            finally:
+                fp.close()
+        except Exception:
+            pass
+    entries = tag_cache["entries"]
+    for filename, entry in entries.items():
+        if entry[0] is not None or not loaded.has_key(filename):
+            loaded[filename] = entry
+    entries.update(loaded)
+    tag_cache["lock"].acquire()
+    tag_cache["generation"] = generation
+    tag_cache["journal_end"] = journal_end
+    tag_cache["n_of_records"] = n_of_records
+    tag_cache["lock"].release()
+    tag_cache["loaded"].set()
+    record_time("tag cache load", time.time() - start)
+
+def store_tag_info(tag_cache, filename, mtime, size, info):
+    """Stores in the tag cache the tag information read from filename, 
+    which had that mtime and size. It is saved with the next 
+    append_tag_cache(...).
+
+    Returns: None
+    """
+    tag_cache["entries"][filename] = (mtime, size, tag_cache["stamp"], info)
+    tag_cache["dirty"].add(filename)
+
+def cached_tag_info(tag_cache, filename, reader=None):
+    """Returns the tag information of filename, reading it with
+    read_tag_info(...) (through reader, if given) only if the tag cache has
+    no valid entry for it.
+
+    An entry is valid if the file's mtime and size didn't change since it
+    was stored. Stale entries are replaced, entries of files that don't
+    exist anymore are dropped. Entries added by seed_tag_cache(...) are 
+    never valid: the file is read, they are only used if it doesn't exist.
+
+    Returns: the tag information (see read_tag_info(...))
+    """
+    entries = tag_cache["entries"]
+    entry = entries.get(filename)
+    try:
+        st = os.stat(filename)
+    except OSError:
+        if entry is not None and entry[0] is None:
+            return entry[3]
+        if entries.pop(filename, None) is not None:
+            tag_cache["dirty"].add(filename)
+        return read_tag_info(filename, reader)
+    if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        if entry[2] != tag_cache["stamp"]:
+            entries[filename] = (entry[0], entry[1], tag_cache["stamp"], entry[3])
+        return entry[3]
+    info = read_tag_info(filename, reader)
+    store_tag_info(tag_cache, filename, st.st_mtime, st.st_size, info)
+    return info
+
+def seed_tag_cache(tag_cache, tag_info):
+    """Adds to the tag cache the tag information read from a playlist (see
+    load_m3u(...)), for the files which are not in the cache yet.
+
+    These entries are placeholders: a #EXTINF line has the artist, the 
+    title and the length at most. They are written back to the playlist 
+    (see write_m3u(...)), and they are not saved to disk: cached_tag_info(...)
+    and tag_sort_thread(...) read the files.
+
+    Returns: None
+    """
+    entries = tag_cache["entries"]
+    for filename, info in tag_info.iteritems():
+        if not entries.has_key(filename):
+            entries[filename] = (None, None, tag_cache["stamp"], info)
+
+def save_tag_cache(tag_cache, base_dir=None, file_list=None):
+    """Saves the tag cache to disk, all of it, and starts its journal, 
+    empty (see append_tag_cache(...)). Waits for the cache to be loaded
+    (see load_tag_cache(...)).
+
+    If base_dir and file_list are given, the entries of files in base_dir
+    which are not in file_list are checked and dropped if the files don't
+    exist anymore.
+    If there are more than TAG_CACHE_MAX_ENTRIES entries, the least recently
+    used ones are dropped.
+
+    The cache file is replaced atomically. Errors are ignored: the cache is
+    only a cache.
+
+    Returns: None
+    """
+    tag_cache["loaded"].wait()
+    tag_cache["lock"].acquire()
+    try:
+        # tag prefetching threads may still be updating the cache
+        tag_cache["dirty"].clear()
+        entries = dict(tag_cache["entries"])
+        for filename in [k for k in entries.keys() if entries[k][0] is None]:
+            del entries[filename]
+        if base_dir is not None and file_list is not None:
+            prefix = os.path.join(base_dir, "")
+            listed = set([os.path.join(base_dir, af) for af in file_list])
+            for filename in entries.keys():
+                if filename.startswith(prefix) and filename not in listed \
+                and not os.path.exists(filename):
+                    del entries[filename]
+        if len(entries) > TAG_CACHE_MAX_ENTRIES:
+            by_age = sorted(entries.keys(), key=lambda k: entries[k][2], reverse=True)
+            for filename in by_age[TAG_CACHE_MAX_ENTRIES:]:
+                del entries[filename]
+        if tag_cache["journal"] is not None:
+            tag_cache["journal"].close()
+            tag_cache["journal"] = None
+        generation = (time.time(), os.getpid())
+        tmp_filename = tag_cache["filename"] + ".tmp"
+        try:
+            if not os.path.isdir(os.path.dirname(tag_cache["filename"])):
+                os.makedirs(os.path.dirname(tag_cache["filename"]))
+            fp = open(tmp_filename, "wb")
+            try:
+                cPickle.dump(generation, fp, cPickle.HIGHEST_PROTOCOL)
+                cPickle.dump(entries, fp, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            os.rename(tmp_filename, tag_cache["filename"])
+            journal = open(tag_cache["filename"] + ".journal", "wb")
+            cPickle.dump(generation, journal, cPickle.HIGHEST_PROTOCOL)
+            journal.flush()
+            tag_cache["journal"] = journal
+            tag_cache["generation"] = generation
+            tag_cache["n_of_records"] = 0
+        except (IOError, OSError):
+            tag_cache["generation"] = None
+    finally:
+        tag_cache["lock"].release()
+
+def append_tag_cache(tag_cache):
+    """Saves to disk the entries of the tag cache stored or dropped since
+    it was last saved, appending them to the journal of the saved cache. 
+    The whole cache is saved instead (see save_tag_cache(...)) if there is
+    no saved cache or if the journal grew beyond 
+    TAG_CACHE_JOURNAL_MAX_RECORDS records. Nothing is saved until the 
+    cache is loaded (see load_tag_cache(...)).
+
+    Errors are ignored: the cache is only a cache.
+
+    Returns: None
+    """
+    if not tag_cache["loaded"].isSet() or not len(tag_cache["dirty"]):
+        return
+    tag_cache["lock"].acquire()
+    try:
+        if tag_cache["generation"] is not None and tag_cache["journal"] is None:
+            try:
+                # after the last valid record of the loaded journal
+                journal = open(tag_cache["filename"] + ".journal", "r+b")
+                journal.seek(tag_cache["journal_end"])
+                journal.truncate()
+                tag_cache["journal"] = journal
+            except (IOError, OSError, TypeError):
+                tag_cache["generation"] = None
+        full = tag_cache["generation"] is None \
+            or tag_cache["n_of_records"] + len(tag_cache["dirty"]) > TAG_CACHE_JOURNAL_MAX_RECORDS
+        if not full:
+            entries = tag_cache["entries"]
+            dirty = tag_cache["dirty"]
+            journal = tag_cache["journal"]
+            try:
+                while True:
+                    try:
+                        filename = dirty.pop()
+                    except KeyError:
+                        break
+                    entry = entries.get(filename)
+                    if entry is not None and entry[0] is None:
+                        continue
+                    cPickle.dump((filename, entry), journal, cPickle.HIGHEST_PROTOCOL)
+                    tag_cache["n_of_records"] = tag_cache["n_of_records"] + 1
+                journal.flush()
+            except (IOError, OSError):
+                journal.close()
+                tag_cache["journal"] = None
+                tag_cache["generation"] = None
+    finally:
+        tag_cache["lock"].release()
+    if full:
+        save_tag_cache(tag_cache)
+
+def new_tag_reader():
+    """Builds a tag reader for read_tag_header(...): a buffer reused from
+    file to file and the part of the open file that it holds.
+
+    Returns: a dictionary with keys:
+    buffer: a bytearray, at least TAG_READ_CHUNK bytes long
+    fp: the file being read, None between files
+    start, end: the offsets in the file of the bytes in buffer
+    size: the size of the file
+    bytes_read: the bytes read from the file so far
+    """
+    return {"buffer":bytearray(TAG_READ_CHUNK), "fp":None, "start":0, "end":0, "size":0, "bytes_read":0}
+
+def read_file_range(reader, offset, n):
+    """Reads n bytes of the file of reader (see new_tag_reader(...)) at
+    offset, unless they are in its buffer already: TAG_READ_CHUNK bytes or
+    more are read at once.
+
+    Raises ValueError if more than TAG_READ_LIMIT bytes of the file have
+    to be read.
+
+    Returns: the bytes (a string), fewer at the end of the file.
+    """
+    if offset < reader["start"] or offset + n > reader["end"]:
+        n_of_bytes = max(n, TAG_READ_CHUNK)
+        if reader["bytes_read"] + n_of_bytes > TAG_READ_LIMIT:
+            raise ValueError("tag read limit reached")
+        if n_of_bytes > len(reader["buffer"]):
+            reader["buffer"] = bytearray(n_of_bytes)
+        reader["fp"].seek(offset)
+        count = reader["fp"].readinto(memoryview(reader["buffer"])[:n_of_bytes]) or 0
+        reader["bytes_read"] = reader["bytes_read"] + count
+        reader["start"], reader["end"] = offset, offset + count
+    position = offset - reader["start"]
+    return str(reader["buffer"][position:position + n])
+
+# ID3v2 frames of the tags in read_tag_info(...): v2.3 and v2.4 ids, then 
+# v2.2 ones
+ID3_TAG_FRAMES = {"TPE1":"artist", "TALB":"album", "TRCK":"tracknumber", "TIT2":"title", \
+    "TDRC":"date", "TYER":"date", "TP1":"artist", "TAL":"album", "TRK":"tracknumber", "TT2":"title", \
+    "TYE":"date"}
+# Text encodings of ID3v2 frames
+ID3_ENCODINGS = ("latin-1", "utf-16", "utf-16-be", "utf-8")
+
+def synchsafe_int(data):
+    """
+    Returns: the integer in the 4 bytes of data, 7 bits per byte (ID3v2
+    sizes).
+    """
+    return (ord(data[0]) << 21) | (ord(data[1]) << 14) | (ord(data[2]) << 7) | ord(data[3])
+
+def read_id3v2(reader, tags):
+    """Reads artist, album, track number, title and date from the ID3v2 
+    tag at the start of the file of reader into tags, a dictionary with the tags
+    found (the first value of each one). Other frames are skipped without
+    reading them.
+
+    Raises ValueError if the tag is unsynchronised, compressed or 
+    encrypted: mutagen has to read it.
+
+    Returns: the offset of the first byte after the ID3v2 tags, 0 if there
+    are none.
+    """
+    header = read_file_range(reader, 0, 10)
+    if len(header) < 10 or header[:3] != "ID3":
+        return 0
+    version, flags, size = ord(header[3]), ord(header[5]), synchsafe_int(header[6:10])
+    if version not in (2, 3, 4) or flags & 0x80 or (version == 2 and flags & 0x40):
+        raise ValueError("unsupported ID3v2 tag")
+    end = 10 + size
+    position = 10
+    if version > 2 and flags & 0x40:
+        extended = read_file_range(reader, position, 4)
+        if version == 3:
+            position = position + 4 + struct.unpack(">I", extended)[0]
+        else:
+            position = position + synchsafe_int(extended)
+    if version == 2:
+        header_size = 6
+    else:
+        header_size = 10
+    while position + header_size <= end and len(tags) < 5:
+        frame_header = read_file_range(reader, position, header_size)
+        if version == 2:
+            frame_id = frame_header[:3]
+            frame_size = struct.unpack(">I", "\x00" + frame_header[3:6])[0]
+            frame_flags = 0
+        else:
+            frame_id = frame_header[:4]
+            if version == 4:
+                frame_size = synchsafe_int(frame_header[4:8])
+            else:
+                frame_size = struct.unpack(">I", frame_header[4:8])[0]
+            frame_flags = struct.unpack(">H", frame_header[8:10])[0]
+        if not frame_id.strip("\x00"):
+            # padding
+            break
+        if not frame_id.isalnum():
+            raise ValueError("bad ID3v2 frame")
+        key = ID3_TAG_FRAMES.get(frame_id)
+        if key is not None and not tags.has_key(key) and frame_size > 1:
+            if (version == 3 and frame_flags & 0x00c0) or (version == 4 and frame_flags & 0x000f):
+                raise ValueError("unsupported ID3v2 frame")
+            data = read_file_range(reader, position + header_size, frame_size)
+            text = data[1:].decode(ID3_ENCODINGS[ord(data[0])], "replace")
+            tags[key] = text.split(u"\x00")[0]
+        position = position + header_size + frame_size
+    
+    # mutagen skips any other tag that follows (some programs stack them)
+    offset = end
+    header = read_file_range(reader, offset, 10)
+    while len(header) == 10 and header[:3] == "ID3" and synchsafe_int(header[6:10]):
+        offset = offset + 10 + synchsafe_int(header[6:10])
+        header = read_file_range(reader, offset, 10)
+    return offset
+
+def read_id3v1(reader, tags):
+    """Adds to tags (see read_id3v2(...)) the ones missing from the ID3v1
+    tag at the end of the file of reader, if there is one.
+
+    Returns: None
+    """
+    if reader["size"] < 128:
+        return
+    data = read_file_range(reader, reader["size"] - 128, 128)
+    if data[:3] != "TAG":
+        return
+    for key, start in (("title", 3), ("artist", 33), ("album", 63)):
+        value = data[start:start + 30].split("\x00")[0].strip().decode("latin-1")
+        if len(value) and not tags.has_key(key):
+            tags[key] = value
+    # ID3v1.1: the track number is the last byte of the comment
+    track = ord(data[126])
+    if track and (track != 32 or data[125] == "\x00") and not tags.has_key("tracknumber"):
+        tags["tracknumber"] = unicode(track)
+    year = data[93:97]
+    if year.isdigit() and not tags.has_key("date"):
+        tags["date"] = unicode(year)
+
+# MPEG audio bitrates in kbps, by (version, layer), then sample rates by 
+# version
+MPEG_BITRATES = {(1, 1):(0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448), \
+    (1, 2):(0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384), \
+    (1, 3):(0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320), \
+    (2, 1):(0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256), \
+    (2, 2):(0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160), \
+    (2, 3):(0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+MPEG_SAMPLE_RATES = {1:(44100, 48000, 32000), 2:(22050, 24000, 16000), 2.5:(11025, 12000, 8000)}
+
+def parse_mpeg_header(data):
+    """
+    Returns: None if the first 4 bytes of data aren't a MPEG audio frame
+    header, otherwise (version, layer, bitrate in bits per second, sample
+    rate, mono, samples in the frame, length of the frame in bytes).
+    """
+    if len(data) < 4 or data[0] != "\xff" or ord(data[1]) & 0xe0 != 0xe0:
+        return None
+    version_bits = (ord(data[1]) >> 3) & 3
+    layer_bits = (ord(data[1]) >> 1) & 3
+    bitrate_index = ord(data[2]) >> 4
+    rate_index = (ord(data[2]) >> 2) & 3
+    if version_bits == 1 or layer_bits == 0 or rate_index == 3 or bitrate_index in (0, 15):
+        return None
+    version = (2.5, None, 2, 1)[version_bits]
+    layer = 4 - layer_bits
+    bitrate = 1000*MPEG_BITRATES[(int(version), layer)][bitrate_index]
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    padding = (ord(data[2]) >> 1) & 1
+    mono = ord(data[3]) >> 6 == 3
+    if layer == 1:
+        samples, slot = 384, 4
+    elif version >= 2 and layer == 3:
+        samples, slot = 576, 1
+    else:
+        samples, slot = 1152, 1
+    return version, layer, bitrate, sample_rate, mono, samples, \
+        ((samples / 8 / slot * bitrate) / sample_rate + padding)*slot
+
+def lame_padding(data):
+    """
+    Returns: the samples that the LAME encoder added at the start and at
+    the end of the audio, from data, the bytes after the Xing header, 0 
+    if it has no LAME header.
+    """
+    if data[:4] != "LAME" and data[:5] != "L3.99":
+        return 0
+    version = data[:9].lstrip("EMAL")
+    major, minor = version[:1], version[1:].lstrip(".")
+    minor = minor[:len(minor) - len(minor.lstrip("0123456789"))]
+    if not major.isdigit() or not minor.isdigit():
+        return 0
+    # the LAME header was added during 3.90, "LAME3.90 (alpha)" has none
+    if (int(major), int(minor)) < (3, 90) or ((int(major), int(minor)) == (3, 90) and data[9:10] == "("):
+        return 0
+    if ord(data[9]) >> 4:
+        # unknown revision of the header
+        return 0
+    delay_and_padding = struct.unpack(">I", "\x00" + data[21:24])[0]
+    return (delay_and_padding >> 12) + (delay_and_padding & 0xfff)
+
+def read_mpeg_info(reader, offset):
+    """Reads the length and bitrate of the MPEG audio in the file of reader
+    from the first frame after offset: from its Xing, Info or VBRI header,
+    if it has one, otherwise from the file size (constant bitrate), if the
+    next frame follows it.
+
+    Raises ValueError if no frame is found in the first TAG_READ_CHUNK 
+    bytes after offset.
+
+    Returns: (length in seconds, bitrate in bits per second, layer)
+    """
+    data = read_file_range(reader, offset, TAG_READ_CHUNK)
+    index = data.find("\xff")
+    while index != -1:
+        frame = parse_mpeg_header(data[index:index + 4])
+        if frame is not None:
+            version, layer, bitrate, sample_rate, mono, samples, frame_length = frame
+            frame_offset = offset + index
+            head = read_file_range(reader, frame_offset, 256)
+            if version == 1 and not mono:
+                xing_offset = 36
+            elif version == 1 or not mono:
+                xing_offset = 21
+            else:
+                xing_offset = 13
+            if layer == 3 and head[xing_offset:xing_offset + 4] in ("Xing", "Info"):
+                flags = struct.unpack(">I", head[xing_offset + 4:xing_offset + 8])[0]
+                position = xing_offset + 8
+                n_of_frames, n_of_bytes = None, None
+                if flags & 1:
+                    n_of_frames = struct.unpack(">I", head[position:position + 4])[0]
+                    position = position + 4
+                if flags & 2:
+                    n_of_bytes = struct.unpack(">I", head[position:position + 4])[0]
+                    position = position + 4
+                position = position + 100*(flags & 4 and 1) + 4*(flags & 8 and 1)
+                if n_of_frames is None:
+                    return 8.0*(reader["size"] - frame_offset) / bitrate, bitrate, layer
+                n_of_samples = samples*n_of_frames
+                if n_of_bytes is not None and n_of_samples:
+                    # the first frame is in the bytes but not in the frames
+                    bitrate = int(round(max(0, n_of_bytes - frame_length)*8.0*sample_rate / n_of_samples))
+                n_of_samples = max(0, n_of_samples - lame_padding(head[position:position + 32]))
+                return float(n_of_samples) / sample_rate, bitrate, layer
+            if layer == 3 and head[36:40] == "VBRI":
+                n_of_bytes, n_of_frames = struct.unpack(">II", head[46:54])
+                length = float(samples*n_of_frames) / sample_rate
+                if length:
+                    bitrate = int(n_of_bytes*8 / length)
+                return length, bitrate, layer
+            following = parse_mpeg_header(read_file_range(reader, frame_offset + frame_length, 4))
+            if following is not None and following[:2] == (version, layer) and following[3] == sample_rate:
+                return 8.0*(reader["size"] - frame_offset) / bitrate, bitrate, layer
+        index = data.find("\xff", index + 1)
+    raise ValueError("MPEG frame not found")
+
+def parse_vorbis_comments(data, tags):
+    """Reads artist, album, track number, title and date from data, a Vorbis
+    comment block (as in Ogg Vorbis and FLAC files), into tags (see 
+    read_id3v2(...)).
+
+    Returns: None
+    """
+    position = 4 + struct.unpack("<I", data[:4])[0]
+    n_of_comments = struct.unpack("<I", data[position:position + 4])[0]
+    position = position + 4
+    for i in xrange(n_of_comments):
+        size = struct.unpack("<I", data[position:position + 4])[0]
+        key, equal, value = data[position + 4:position + 4 + size].partition("=")
+        key = key.lower()
+        if equal and key in ("artist", "album", "tracknumber", "title", "date") and not tags.has_key(key):
+            tags[key] = value.decode("utf-8", "replace")
+        position = position + 4 + size
+
+def read_ogg_packets(reader, offset, n_of_packets):
+    """Reads the first n_of_packets packets of the Ogg stream starting at
+    offset in the file of reader.
+
+    Returns: (the list of the packets, the serial number of the stream)
+    """
+    packets = [""]
+    serial = None
+    while len(packets) <= n_of_packets:
+        header = read_file_range(reader, offset, 27)
+        if header[:4] != "OggS" or len(header) < 27:
+            raise ValueError("bad Ogg page")
+        if serial is None:
+            serial = struct.unpack("<I", header[14:18])[0]
+        lacing = read_file_range(reader, offset + 27, ord(header[26]))
+        data = read_file_range(reader, offset + 27 + len(lacing), sum([ord(ch) for ch in lacing]))
+        position = 0
+        for ch in lacing:
+            packets[-1] = packets[-1] + data[position:position + ord(ch)]
+            position = position + ord(ch)
+            if ord(ch) < 255:
+                packets.append("")
+        offset = offset + 27 + len(lacing) + len(data)
+    return packets[:n_of_packets], serial
+
+def read_ogg_length(reader, serial, sample_rate):
+    """Reads the length of the Ogg stream serial in the file of reader, 
+    from the position of its last page in the last TAG_READ_CHUNK bytes.
+
+    Returns: the length in seconds
+    """
+    start = max(reader["size"] - TAG_READ_CHUNK, 0)
+    data = read_file_range(reader, start, reader["size"] - start)
+    index = data.rfind("OggS")
+    while index != -1:
+        if len(data) - index >= 27:
+            position, page_serial = struct.unpack("<qI", data[index + 6:index + 18])
+            if page_serial == serial and position >= 0:
+                return position / float(sample_rate)
+        index = data.rfind("OggS", 0, index)
+    raise ValueError("last Ogg page not found")
+
+def read_tag_header(filename, reader=None):
+    """Reads the tag information of filename, like read_tag_info(...), 
+    reading only the headers of the file: for mp3 files the ID3 tags and
+    the first MPEG frame, for Ogg Vorbis files the first packets and the 
+    last page, for FLAC files the metadata blocks. The bytes are read in 
+    the buffer of reader (see new_tag_reader(...)), if given, and no more 
+    than TAG_READ_LIMIT of them.
+
+    Returns: the tag information (see read_tag_info(...)), None if the
+    file is of another type or its headers can't be read this way.
+    """
+    if reader is None:
+        reader = new_tag_reader()
+    tags = {}
+    try:
+        reader["fp"] = io.open(filename, "rb", buffering=0)
+    except IOError:
+        return None
+    reader["start"], reader["end"], reader["bytes_read"] = 0, 0, 0
+    try:
+        reader["size"] = os.fstat(reader["fp"].fileno()).st_size
+        offset = read_id3v2(reader, tags)
+        if filename.lower().endswith(".mp3"):
+            length, bitrate, layer = read_mpeg_info(reader, offset)
+            if len(tags) < 5:
+                read_id3v1(reader, tags)
+            mime = "audio/mp%d" % layer
+        else:
+            magic = read_file_range(reader, offset, 4)
+            if magic == "fLaC":
+                streaminfo = None
+                position = offset + 4
+                while True:
+                    block_header = read_file_range(reader, position, 4)
+                    block_type = ord(block_header[0]) & 0x7f
+                    block_size = struct.unpack(">I", "\x00" + block_header[1:4])[0]
+                    if block_type == 0:
+                        streaminfo = read_file_range(reader, position + 4, 34)
+                    elif block_type == 4:
+                        parse_vorbis_comments(read_file_range(reader, position + 4, block_size), tags)
+                    position = position + 4 + block_size
+                    if ord(block_header[0]) & 0x80:
+                        break
+                # sample rate (20 bits), channels (3), bits per sample (5), samples (36)
+                bits = struct.unpack(">Q", streaminfo[10:18])[0]
+                if bits >> 44:
+                    length = (bits & 0xfffffffffL) / float(bits >> 44)
+                else:
+                    length = 0.0
+                if length:
+                    bitrate = int((reader["size"] - position)*8.0 / length)
+                else:
+                    bitrate = 0
+                mime = "audio/flac"
+            elif magic == "OggS":
+                packets, serial = read_ogg_packets(reader, offset, 2)
+                if packets[0][:7] != "\x01vorbis" or packets[1][:7] != "\x03vorbis":
+                    return None
+                sample_rate, max_bitrate, bitrate, min_bitrate = struct.unpack("<I3i", packets[0][12:28])
+                max_bitrate, bitrate, min_bitrate = max(max_bitrate, 0), max(bitrate, 0), max(min_bitrate, 0)
+                # as mutagen guesses the bitrate
+                if bitrate == 0:
+                    bitrate = (max_bitrate + min_bitrate) / 2
+                elif max_bitrate and max_bitrate < bitrate:
+                    bitrate = max_bitrate
+                elif min_bitrate > bitrate:
+                    bitrate = min_bitrate
+                parse_vorbis_comments(packets[1][7:], tags)
+                length = read_ogg_length(reader, serial, sample_rate)
+                mime = "audio/vorbis"
+            else:
+                return None
+    except (ValueError, IndexError, TypeError, LookupError, struct.error, ZeroDivisionError):
+        return None
+    finally:
+        reader["fp"].close()
+        reader["fp"] = None
+        reader["start"], reader["end"] = 0, 0
+    
+    info = {"mime":mime, "bitrate":bitrate, "length":length}
+    for key in ("artist", "album", "tracknumber", "title", "date"):
+        if tags.has_key(key) and len(tags[key]) and not tags[key].isspace():
+            info[key] = tags[key]
+        else:
+            info[key] = None
+    return info
+
+def read_tag_info(filename, reader=None):
+    """Reads tags and audio information from filename.
+
+    The headers of mp3, Ogg Vorbis and FLAC files are read directly (see
+    read_tag_header(...)), in the buffer of reader if given. The mutagen
+    module reads the other files and the headers that read_tag_header(...)
+    can't parse.
+
+    Returns: None if mutagen doesn't recognize the file or isn't installed,
+    otherwise a dictionary with keys:
+    artist, album, tracknumber, title, date: the tags (unicode strings) or
+    None (tag information cached by older versions has no date)
+    mime: the mime type of the file (a string) or None
+    bitrate: in bits per second or None
+    length: in seconds (a float) or None
+    """
+    start = time.time()
+    info = read_tag_header(filename, reader)
+    if info is not None:
+        record_time("tag read", time.time() - start)
+        return info
+    if not TAG_SUPPORT:
+        return None
+
+    start = time.time()
+    if filename.lower().endswith(".mp3"):
+        audio = mutagen.mp3.MP3(filename, ID3=mutagen.easyid3.EasyID3)
+    else:
+        audio = mutagen.File(filename)
+    record_time("tag read", time.time() - start)
+    
+    if audio is None:
+        return None
+
+    info = {}
+    for key in ("artist", "album", "tracknumber", "title", "date"):
+        if audio.has_key(key) and len(audio[key][0]) and not audio[key][0].isspace():
+            info[key] = audio[key][0]
+        else:
+            info[key] = None
+    info["mime"] = audio.mime[0]
+    if hasattr(audio.info, "bitrate"):
+        info["bitrate"] = audio.info.bitrate
+    else:
+        info["bitrate"] = None
+    info["length"] = audio.info.length
+    return info
+
+def format_tag_label(filename, info, n_of_cols):
+    """
+    The label is built with this format:
+    artist - album - tracknum - title   <white space>   type bitrate length
+
+    info is the tag information returned by read_tag_info(...). If artist or
+    title are missing, the file name is used instead.
+
+    Returns: the label (a unicode string)
+    """
+    if info is not None and info["artist"] is not None and info["title"] is not None:
+        tag_label = info["artist"]
+        if info["album"] is not None:
+            tag_label = tag_label + " - " + info["album"]
+        if info["tracknumber"] is not None:
+            track_num_splitted = info["tracknumber"].split("/")
+            tracknumber = info["tracknumber"]
+            if track_num_splitted[0].isdigit():
+                try:
+                    if int(track_num_splitted[0]) < 10 and int(track_num_splitted[0]) > 0 \
+                    and len(track_num_splitted[0]) == 1:
+                        tracknumber = "0" + track_num_splitted[0]
+                        if len(track_num_splitted) == 2:
+                            tracknumber = tracknumber + "/" + track_num_splitted[1]
+                except ValueError:
+                    pass
+            tag_label = tag_label + " - " + tracknumber
+        tag_label = tag_label + " - " + info["title"]
+    else:
+        tag_label = filename.split(os.sep)[-1]
+    
+    if info is not None:
+        #Now we build the audio info part of the string
+        info_label = ""
+        if info["mime"] is None:
+            pass
+        elif info["mime"].find("/") > -1:
+            info_label = info_label + info["mime"].split("/")[1]
+        else:
+            info_label = info_label + info["mime"]
+        if info["bitrate"] is not None:
+            info_label = info_label + "  " + " "*(info["bitrate"] / 1000 < 100) + str(info["bitrate"] / 1000) + "Kbps"
+        if info["length"] is not None:
+            info_label = info_label + " " + " "*(info["length"] / 60 < 10) + str(int(info["length"] / 60)) + ":" 
+            info_label = info_label + "0"*(info["length"] % 60 < 10) + str(int(info["length"] % 60))
+        info_label = info_label + " "
+        
+        #put all together
+        if len(tag_label) + len(info_label) < n_of_cols:
+            tag_label = tag_label + (n_of_cols - len(tag_label) - len(info_label))*" " + info_label
+        else:
+            tag_label = tag_label[:n_of_cols - len(tag_label) - len(info_label) - 4] + "... " + info_label
+
+    #try:
+    #    tag_label = unicode(tag_label)
+    #except UnicodeDecodeError:
+    #    tag_label = unicode(string.decode(tag_label))
+    
+    return sanitize_string(tag_label)
+
+def tag_search_text(info):
+    """
+    Returns: the text searched in the tag information info (see 
+    read_tag_info(...)): its tags, lowercase, a unicode string. Queries 
+    typed as bytes are matched against it as unicode (see 
+    tag_search_query(...)).
+    """
+    return u" - ".join([info[key] for key in ("artist", "album", "tracknumber", "title") \
+        if info[key] is not None]).lower()
+
+def tag_search_query(query):
+    """query is typed as bytes, UTF-8 (see search_key(...)).
+
+    Returns: query as a lowercase unicode string, to be found in 
+    tag_search_text(...). Bad bytes are replaced; the bytes of a character
+    not typed whole yet are left out, so the results still narrow as 
+    the query grows.
+    """
+    return codecs.getincrementaldecoder("utf-8")("replace").decode(query).lower()
+
+def load_thread(display_status_dict, display_status_lock, play_engine, base_dir, supported_exts, \
+        recursive, n_of_workers, sort):
+    """The loading thread.
+    Scans base_dir (see iter_file_list(...)) while the user interface is
+    already running, appending the files found to the playlist in batches
+    of SCAN_BATCH_SIZE. The status line shows how many files were found.
+
+    If sort is True, the playlist is sorted when the scan is over.
+    The state of the scan is kept in display_status_dict["dir_state"], for 
+    later rescans (see load_dir_state(...)).
+
+    Returns: when the scan is over.
+    """
+    last_paint = 0
+    batch = []
+    dir_mtimes = {}
+    start = time.time()
+    for files in iter_file_list(base_dir, supported_exts, recursive, n_of_workers, dir_mtimes):
+        batch.extend(files)
+        if len(batch) < SCAN_BATCH_SIZE:
+            continue
+        display_status_lock.acquire()
+        display_status_dict["file_list"].extend(batch)
+        display_status_dict["tag_list"].extend([None]*len(batch))
+        if time.time() - last_paint > SCAN_PAINT_INTERVAL:
+            request_paint(display_status_dict)
+            last_paint = time.time()
+        display_status_lock.release()
+        batch = []
+    record_time("scan", time.time() - start)
+    
+    display_status_lock.acquire()
+    display_status_dict["file_list"].extend(batch)
+    display_status_dict["tag_list"].extend([None]*len(batch))
+    if sort:
+        clear_filter(display_status_dict)
+        file_list, tag_list, hl_index, new_index = sort_playlist(display_status_dict["file_list"], \
+            display_status_dict["tag_list"], None)
+        replace_playlist(display_status_dict, play_engine, file_list, tag_list, new_index)
+    display_status_dict["dir_state"] = {"base_dir":base_dir, "recursive":recursive, "dirs":dir_mtimes}
+    display_status_dict["scanning"] = False
+    request_paint(display_status_dict)
+    display_status_lock.release()
+
+def start_rescan(display_status_dict, display_status_lock):
+    """Checks if a rescan of the directory can start now and marks it as
+    started. 
+
+    Must be called with display_status_lock held.
+
+    Returns: True if the caller has to run rescan_thread(...)
+    """
+    if display_status_dict["dir_state"] is None or display_status_dict["scanning"] \
+    or display_status_dict["rescanning"]:
+        return False
+    display_status_dict["rescanning"] = True
+    return True
+
+def rescan_thread(display_status_dict, display_status_lock, play_engine, supported_exts, \
+        n_of_workers, dirty=None):
+    """The rescanning thread. 
+    Looks for files added to or removed from the directory since it was
+    scanned (see rescan_library(...)) and merges them into the playlist
+    (see merge_rescan(...)).
+
+    It has to be started only if start_rescan(...) returned True.
+
+    Returns: when the rescan is over.
+    """
+    display_status_lock.acquire()
+    file_list = display_status_dict["file_list"][:]
+    dir_state = display_status_dict["dir_state"]
+    request_paint(display_status_dict)
+    display_status_lock.release()
+    
+    start = time.time()
+    added, removed = rescan_library(dir_state["base_dir"], file_list, dir_state, supported_exts, \
+        n_of_workers, dirty)
+    record_time("rescan", time.time() - start)
+    
+    display_status_lock.acquire()
+    merge_rescan(display_status_dict, play_engine, added, removed)
+    display_status_dict["rescanning"] = False
+    if dirty is None or len(added) or len(removed):
+        display_status_dict["message"] = "rescan: " + str(len(added)) + " added, " + \
+            str(len(removed)) + " removed"
+    request_paint(display_status_dict)
+    display_status_lock.release()
+
+def watch_thread(display_status_dict, display_status_lock, play_engine, supported_exts, n_of_workers):
+    """The watching thread.
+    Uses inotify to be notified of changes in the scanned directories and
+    rescans them (see rescan_thread(...)) WATCH_DELAY seconds after the last
+    change.
+
+    inotify is reached through ctypes, it is only available on Linux.
+
+    Returns: at once if inotify is not available, otherwise _never_.
+    """
+    import ctypes
+    try:
+        libc = ctypes.CDLL("libc.so.6", use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return
+    if fd < 0:
+        return
+    # IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE, IN_DELETE_SELF
+    mask = 0x40 | 0x80 | 0x100 | 0x200 | 0x400
+    # wd -> directory relative to base_dir
+    watched = {}
+    while True:
+        # the first scan may be still running
+        display_status_lock.acquire()
+        scanning = display_status_dict["scanning"]
+        if display_status_dict["dir_state"] is not None and not scanning:
+            dirs = display_status_dict["dir_state"]["dirs"].keys()
+            base_dir = display_status_dict["dir_state"]["base_dir"]
+        else:
+            dirs = None
+        display_status_lock.release()
+        if dirs is None and not scanning:
+            # the playlist doesn't come from a directory
+            return
+        elif dirs is None:
+            time.sleep(WATCH_DELAY)
+            continue
+        
+        watched_dirs = set(watched.values())
+        for rel_dir in dirs:
+            if rel_dir not in watched_dirs:
+                wd = libc.inotify_add_watch(fd, os.path.join(base_dir, rel_dir), mask)
+                if wd >= 0:
+                    watched[wd] = rel_dir
+        
+        dirty = set()
+        timeout = None
+        while len(select.select([fd], [], [], timeout)[0]):
+            data = os.read(fd, 65536)
+            while len(data) >= 16:
+                wd, event_mask, cookie, length = struct.unpack("iIII", data[:16])
+                data = data[16 + length:]
+                if watched.has_key(wd):
+                    dirty.add(watched[wd])
+                # IN_IGNORED: the watch was removed
+                if event_mask & 0x8000:
+                    watched.pop(wd, None)
+            timeout = WATCH_DELAY
+        
+        while True:
+            display_status_lock.acquire()
+            started = start_rescan(display_status_dict, display_status_lock)
+            display_status_lock.release()
+            if started:
+                break
+            time.sleep(WATCH_DELAY)
+        rescan_thread(display_status_dict, display_status_lock, play_engine, supported_exts, \
+            n_of_workers, dirty)
+
+def new_tag_prefetcher(display_status_dict, display_status_lock, base_dir, \
+        n_of_workers=TAG_PREFETCH_WORKERS):
+    """Builds the status of the tag prefetcher, a pool of threads that
+    read tags in background and fill display_status_dict["tag_list"].
+
+    The threads are started by the first call to request_tag_prefetch(...)
+
+    Returns: a dictionary with keys:
+    pending: a list of (index, relative path) still to be read, the last
+    item is read first.
+    in_flight: the set of relative paths being read right now.
+    condition: a threading.Condition guarding pending and in_flight.
+    """
+    return {"pending":[], "in_flight":set(), "condition":threading.Condition(), \
+        "started":False, "n_of_workers":n_of_workers, "base_dir":base_dir, \
+        "display_status_dict":display_status_dict, "display_status_lock":display_status_lock}
+
+def request_tag_prefetch(prefetch_dict, text_index, n_of_lines_on_screen, view=None):
+    """Asks the tag prefetcher to read the tags of the visible lines, then
+    those of TAG_PREFETCH_PAGES pages below and above them. If view is 
+    given, the lines are the files with those indices (see 
+    paint_screen(...)).
+
+    The previous requests still pending are discarded, so the prefetcher
+    always follows the user scrolling the list.
+    Must be called with display_status_lock held. It never waits for I/O.
+
+    Returns: None
+    """
+    file_list = prefetch_dict["display_status_dict"]["file_list"]
+    tag_list = prefetch_dict["display_status_dict"]["tag_list"]
+    ranges = [(text_index, text_index + n_of_lines_on_screen)]
+    for page in range(1, TAG_PREFETCH_PAGES + 1):
+        ranges.append((text_index + page*n_of_lines_on_screen, \
+            text_index + (page + 1)*n_of_lines_on_screen))
+        ranges.append((text_index - page*n_of_lines_on_screen, \
+            text_index - (page - 1)*n_of_lines_on_screen))
+    pending = []
+    for start, stop in ranges:
+        if view is not None:
+            indices = view[max(start, 0):max(stop, 0)]
+        else:
+            indices = range(max(start, 0), min(stop, len(file_list)))
+        for i in indices:
+            if tag_list[i] is None:
+                pending.append((i, file_list[i]))
+    pending.reverse()
+    
+    condition = prefetch_dict["condition"]
+    condition.acquire()
+    prefetch_dict["pending"] = pending
+    if not prefetch_dict["started"]:
+        prefetch_dict["started"] = True
+        for i in range(prefetch_dict["n_of_workers"]):
+            thread.start_new_thread(tag_prefetch_thread, (prefetch_dict, ))
+    condition.notifyAll()
+    condition.release()
+
+def tag_prefetch_thread(prefetch_dict):
+    """A tag prefetching thread.
+    Reads the tags requested by request_tag_prefetch(...), stores them in
+    tag_list and asks for a repaint if they are visible. The tag 
+    information of file_list[i] is tag_list[i] (see read_tag_info(...)),
+    an empty dictionary if its tags can't be read, None if they haven't
+    been read yet.
+
+    Files whose tags can't be read are shown by name.
+
+    Returns: This method _never_ returns.
+    """
+    condition = prefetch_dict["condition"]
+    display_status_dict = prefetch_dict["display_status_dict"]
+    display_status_lock = prefetch_dict["display_status_lock"]
+    reader = new_tag_reader()
+    while True:
+        condition.acquire()
+        while not len(prefetch_dict["pending"]):
+            condition.wait()
+        index, name = prefetch_dict["pending"].pop()
+        if name in prefetch_dict["in_flight"]:
+            condition.release()
+            continue
+        prefetch_dict["in_flight"].add(name)
+        condition.release()
+        
+        filename = os.path.join(prefetch_dict["base_dir"], name)
+        try:
+            info = cached_tag_info(display_status_dict["tag_cache"], filename, reader)
+        except Exception:
+            info = None
+        
+        display_status_lock.acquire()
+        # the list may have been sorted in the meantime
+        if index < len(display_status_dict["file_list"]) \
+        and display_status_dict["file_list"][index] == name \
+        and display_status_dict["tag_list"][index] is None:
+            display_status_dict["tag_list"][index] = info or {}
+            position = view_position(display_status_dict, index)
+            if display_status_dict["tag_mode"] and position is not None and \
+            0 <= position - display_status_dict["current_text_line"] < curses.LINES - 2:
+                request_paint(display_status_dict)
+        display_status_lock.release()
+        
+        condition.acquire()
+        prefetch_dict["in_flight"].discard(name)
+        condition.release()
+
+def init_tag_sort_process():
+    """Prepares a process of tag_sort_thread(...), just forked: it gets its
+    own timing statistics, as a thread of the parent may have been holding
+    their lock, and ignores SIGINT. The handlers that curses installs for 
+    SIGTERM and SIGTSTP are dropped: they would restore the terminal of the
+    parent when the process is terminated or stopped.
+
+    Returns: None
+    """
+    global STATS
+    STATS = new_stats()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGTSTP, signal.SIG_DFL)
+
+def start_tag_sort(display_status_dict, display_status_lock):
+    """Checks if a sort by tags can start now and marks it as started: not
+    while the directory is being scanned or rescanned.
+
+    Must be called with display_status_lock held.
+
+    Returns: True if the caller has to run tag_sort_thread(...)
+    """
+    if display_status_dict["tag_sort"] is not None:
+        return False
+    if display_status_dict["scanning"] or display_status_dict["rescanning"]:
+        display_status_dict["message"] = "sort: wait for the scan to end"
+        return False
+    display_status_dict["tag_sort"] = {"done":0, "total":len(display_status_dict["file_list"]), \
+        "cancel":False}
+    return True
+
+def tag_sort_thread(display_status_dict, display_status_lock, play_engine, base_dir, \
+        n_of_processes=TAG_SORT_PROCESSES):
+    """The tag sorting thread. 
+    Reads the tags of all the files in the playlist, then sorts it by 
+    artist, album, track number and title.
+
+    The tags not in tag_list nor in the tag cache are read in batches by 
+    n_of_processes processes (see read_tag_batch(...)). Each batch read is
+    stored in tag_list and in the tag cache at once, so it is kept if the
+    sort is cancelled: display_status_dict["tag_sort"] shows the progress
+    and cancels the sort if its key cancel is set.
+
+    It has to be started only if start_tag_sort(...) returned True.
+
+    Returns: when the playlist is sorted, or the sort is cancelled.
+    """
+    progress = display_status_dict["tag_sort"]
+    tag_cache = display_status_dict["tag_cache"]
+    display_status_lock.acquire()
+    file_list = display_status_dict["file_list"]
+    tag_list = display_status_dict["tag_list"][:]
+    request_paint(display_status_dict)
+    display_status_lock.release()
+    
+    # tags already read, or in the tag cache
+    tag_cache["loaded"].wait()
+    infos = [None]*len(file_list)
+    to_read = {}
+    for i in range(len(file_list)):
+        if tag_list[i] is not None:
+            infos[i] = tag_list[i] or None
+            continue
+        filename = os.path.join(base_dir, file_list[i])
+        entry = tag_cache["entries"].get(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            infos[i] = entry[3]
+        else:
+            to_read.setdefault(filename, []).append(i)
+    display_status_lock.acquire()
+    progress["done"] = len(file_list) - sum([len(indices) for indices in to_read.values()])
+    display_status_lock.release()
+    
+    filenames = to_read.keys()
+    filenames.sort()
+    batches = [filenames[i:i + TAG_SORT_BATCH_SIZE] for i in range(0, len(filenames), TAG_SORT_BATCH_SIZE)]
+    pool = None
+    if len(batches) > 1 and n_of_processes > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(n_of_processes, len(batches)), init_tag_sort_process)
+        results = pool.imap_unordered(read_tag_batch, batches)
+    else:
+        results = None
+    start = time.time()
+    last_paint = 0.0
+    try:
+        for i in range(len(batches)):
+            if pool is not None:
+                batch = None
+                while batch is None and not progress["cancel"]:
+                    try:
+                        batch = results.next(SCAN_PAINT_INTERVAL)
+                    except multiprocessing.TimeoutError:
+                        pass
+            elif not progress["cancel"]:
+                batch = read_tag_batch(batches[i])
+            if progress["cancel"]:
+                break
+            
+            display_status_lock.acquire()
+            for filename, mtime, size, info in batch:
+                if mtime is not None:
+                    store_tag_info(tag_cache, filename, mtime, size, info)
+                for index in to_read[filename]:
+                    infos[index] = info
+                    # the playlist may have been sorted or rescanned in 
+                    # the meantime
+                    current_list = display_status_dict["file_list"]
+                    if index < len(current_list) and current_list[index] == file_list[index] \
+                    and display_status_dict["tag_list"][index] is None:
+                        display_status_dict["tag_list"][index] = info or {}
+                progress["done"] = progress["done"] + len(to_read[filename])
+            if time.time() - last_paint >= SCAN_PAINT_INTERVAL:
+                request_paint(display_status_dict)
+                last_paint = time.time()
+            display_status_lock.release()
+    finally:
+        if pool is not None:
+            pool.terminate()
+    record_time("tag sort read", time.time() - start)
+    
+    display_status_lock.acquire()
+    if progress["cancel"]:
+        display_status_dict["message"] = "sort cancelled: " + str(progress["done"]) + " of " + \
+            str(progress["total"]) + " tags read"
+    elif display_status_dict["file_list"] is file_list and len(file_list) == len(infos):
+        clear_filter(display_status_dict)
+        keys = [tag_sort_key(file_list[i], infos[i]) for i in range(len(file_list))]
+        sorted_list, tag_list, hl_index, new_index = sort_playlist(file_list, \
+            display_status_dict["tag_list"], None, keys)
+        replace_playlist(display_status_dict, play_engine, sorted_list, tag_list, new_index)
+    else:
+        display_status_dict["message"] = "sort cancelled: the playlist changed"
+    display_status_dict["tag_sort"] = None
+    request_paint(display_status_dict)
+    display_status_lock.release()
+
+def new_play_queue(indices=()):
+    """Builds the play queue: the indices in the playlist of the songs to
+    be played next, in order.
+
+    Each queued index has a sequence number, growing from the head to the
+    tail of the queue. The position of an index is its sequence number 
+    minus the one of the head, so that membership, position and popping 
+    the head take O(1).
+
+    Returns: a dictionary with keys:
+    order: a deque of the queued indices
+    seq: a dictionary: queued index -> sequence number
+    head: the sequence number of order[0]
+    """
+    queue = {"order":collections.deque(), "seq":{}, "head":0}
+    queue_extend(queue, indices)
+    return queue
+
+def queue_extend(queue, indices):
+    """Appends to queue (see new_play_queue(...)) the indices which are 
+    not queued yet.
+
+    Returns: the number of indices appended.
+    """
+    order = queue["order"]
+    seq = queue["seq"]
+    n_of_queued = len(order)
+    for index in indices:
+        if not seq.has_key(index):
+            seq[index] = queue["head"] + len(order)
+            order.append(index)
+    return len(order) - n_of_queued
+
+def queue_position(queue, index):
+    """
+    Returns: the position (starting from 1) of index in queue, None if 
+    it's not queued.
+    """
+    if queue["seq"].has_key(index):
+        return queue["seq"][index] - queue["head"] + 1
+    return None
+
+def queue_pop(queue):
+    """Removes the head of queue.
+
+    Returns: the index at the head of queue, None if queue is empty.
+    """
+    if not len(queue["order"]):
+        return None
+    index = queue["order"].popleft()
+    del queue["seq"][index]
+    queue["head"] = queue["head"] + 1
+    return index
+
+def queue_remove(queue, index):
+    """Removes index from queue. The indices after it are renumbered, so
+    this takes O(n).
+
+    Returns: True if index was queued.
+    """
+    position = queue_position(queue, index)
+    if position is None:
+        return False
+    order = queue["order"]
+    seq = queue["seq"]
+    del order[position - 1]
+    del seq[index]
+    for i in xrange(position - 1, len(order)):
+        seq[order[i]] = seq[order[i]] - 1
+    return True
+
+def queue_remap(queue, new_index):
+    """Updates queue after the playlist changed: new_index[i] is the new
+    index of the song whose index was i, None if it was removed.
+
+    Returns: None
+    """
+    indices = [new_index[i] for i in queue["order"]]
+    queue["order"].clear()
+    queue["seq"].clear()
+    queue["head"] = 0
+    queue_extend(queue, [i for i in indices if i is not None])
+
+def queue_copy(queue):
+    """
+    Returns: a copy of queue (see new_play_queue(...)), to be changed 
+    while queue stays as it is.
+    """
+    return {"order":collections.deque(queue["order"]), "seq":dict(queue["seq"]), "head":queue["head"]}
+
+def directory_span(file_list, index):
+    """
+    Returns: (first, last + 1), the indices of the files next to 
+    file_list[index] (itself included) in its same directory: an album, 
+    in a sorted or scanned playlist.
+    """
+    directory = os.path.dirname(file_list[index])
+    first = index
+    while first > 0 and os.path.dirname(file_list[first - 1]) == directory:
+        first = first - 1
+    last = index + 1
+    while last < len(file_list) and os.path.dirname(file_list[last]) == directory:
+        last = last + 1
+    return first, last
+
+def new_wake_pipe():
+    """Builds a pipe used to wake up a thread waiting in select(...). The
+    writing end doesn't block: if the pipe is full, the thread is going to
+    wake up anyway.
+
+    Returns: (reading fd, writing fd)
+    """
+    wake_pipe = os.pipe()
+    fcntl.fcntl(wake_pipe[1], fcntl.F_SETFL, fcntl.fcntl(wake_pipe[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+    return wake_pipe
+
+def wake_up(wake_pipe):
+    """Wakes up the thread waiting on wake_pipe (see new_wake_pipe(...)).
+
+    Returns: None
+    """
+    try:
+        os.write(wake_pipe[1], "x")
+    except OSError:
+        pass
+
+def new_play_engine(file_list, tag_cache=None, ui_wake_pipe=None):
+    """Builds the playing engine: the playing thread (see play_thread(...))
+    and what it owns, the playing song, the queue and the players.
+
+    Only the playing thread changes it. The other threads send it 
+    commands (see send_play_command(...)) and read the state it 
+    publishes, without locks: a published state is never changed, the 
+    next one replaces it.
+
+    file_list is the playlist (see replace_playlist(...) when it's 
+    replaced), tag_cache gives the length of the songs (see 
+    load_tag_cache(...)).
+
+    Returns: a dictionary with keys:
+    commands: a deque of the commands to the playing thread
+    wake_pipe: the pipe waking up the playing thread (see new_wake_pipe(...))
+    ui_wake_pipe: the pipe written after a new state is published, None
+    if nobody waits for it
+    state: the published state, a dictionary with keys:
+        file_list: the playlist the indices refer to
+        playing: the index of the playing song, None if there isn't one
+        queue: the play queue (see new_play_queue(...))
+        continue: True if the next song is played when a song ends
+        paused: True if the playing song is paused
+    tag_cache: tag_cache
+    players: pid -> player (see spawn_player(...))
+    stopped: a threading.Event, set when the playing thread returns
+    wakeups, transitions, transition_time: see play_thread(...)
+    read_ahead: the read-ahead of the next songs (see new_read_ahead(...)),
+    None if they are not read ahead
+    """
+    state = {"file_list":file_list, "playing":None, "queue":new_play_queue(), "continue":True, \
+        "paused":False}
+    return {"commands":collections.deque(), "wake_pipe":new_wake_pipe(), "ui_wake_pipe":ui_wake_pipe, \
+        "state":state, "tag_cache":tag_cache, "players":{}, "stopped":threading.Event(), "wakeups":0, \
+        "transitions":0, "transition_time":0.0, "read_ahead":None}
+
+def send_play_command(play_engine, command):
+    """Sends a command to the playing thread (see play_thread(...)). It 
+    never waits.
+
+    command is one of:
+    ("play", index): play the song with that index in the playlist
+    "stop_song": stop playing
+    "pause": pause or resume the song
+    ("seek", seconds): move forward (or backward) in the song
+    "continue": switch the continuous mode on or off
+    ("queue", indices): append these indices to the queue
+    ("unqueue", index): remove index from the queue
+    ("playlist", file_list, new_index): the playlist was replaced by 
+    file_list (see replace_playlist(...))
+    "quit": stop all the players and return
+    ("exited", pid, time): the player with that pid exited at that time
+    ("ended", pid, time): the player in remote mode with that pid reached
+    the end of the song at that time
+
+    Returns: None
+    """
+    play_engine["commands"].append(command)
+    wake_up(play_engine["wake_pipe"])
+
+def play_state(play_engine, file_list):
+    """
+    Returns: the state published by the playing thread (see 
+    new_play_engine(...)) as seen from file_list, the playlist on the
+    screen. If the playing thread isn't told yet that the playlist was 
+    replaced by file_list, its indices don't point into it: the playing
+    song and the queue are left out until it is.
+    """
+    state = play_engine["state"]
+    if state["file_list"] is not file_list:
+        state = dict(state)
+        state["playing"] = None
+        state["queue"] = new_play_queue()
+    return state
+
+def replace_playlist(display_status_dict, play_engine, file_list, tag_list, new_index):
+    """Replaces the playlist with file_list and tag_list and tells the 
+    playing thread: new_index[i] is the new index of the song whose index
+    was i, None if it was removed.
+
+    Must be called with display_status_lock held: the commands of the 
+    playing thread about a playlist are sent after the one replacing it.
+
+    Returns: None
+    """
+    display_status_dict["file_list"] = file_list
+    display_status_dict["tag_list"] = tag_list
+    send_play_command(play_engine, ("playlist", file_list, new_index))
+
+def wait_player_thread(play_engine, player):
+    """Waits for a player (see spawn_player(...)) to exit, then tells the
+    playing thread.
+
+    Returns: when the player exits.
+    """
+    while True:
+        try:
+            pid, status = os.waitpid(player["pid"], 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                status = 0
+                break
+    player["returncode"] = status
+    send_play_command(play_engine, ("exited", player["pid"], time.time()))
+
+def player_output_thread(play_engine, player):
+    """Reads the output of a player in remote mode and tells the playing
+    thread when a song ends (see the remote key of the players).
+
+    Returns: when the player exits.
+    """
+    remote = player["remote"]
+    output = os.fdopen(player["stdout"], "rb", 0)
+    while True:
+        try:
+            line = output.readline()
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                continue
+            break
+        if not line:
+            break
+        if line.startswith(remote["end"]) \
+        or (remote["error"] is not None and line.startswith(remote["error"])):
+            send_play_command(play_engine, ("ended", player["pid"], time.time()))
+    output.close()
+
+def spawn_player(command, filename, play_engine, stopped=False, remote=None):
+    """Starts a player (command is a list: the player and its options) on
+    filename. A thread waits for it to exit (see wait_player_thread(...)).
+
+    If stopped is True, the player stops itself with SIGSTOP before 
+    running: the fork is paid in advance and a SIGCONT makes it play.
+    subprocess.Popen can't do that, it waits for the program to start.
+
+    If remote is given (see the remote key of the players), the player is
+    started in remote mode, without filename: it's driven through its
+    standard input (see send_to_player(...)) and a thread reads its 
+    output (see player_output_thread(...)). Otherwise its output is 
+    discarded.
+
+    The player is added to play_engine["players"], the playing thread
+    removes it when it exits.
+
+    Returns: a dictionary with keys:
+    pid: the pid of the player
+    returncode: None while the player runs, then its exit status
+    stdin: the fd of a pipe to the standard input of the player
+    stdout: the fd of a pipe from the output of the player in remote mode
+    remote: remote or None
+    filename: the file the player is playing
+    playing: in remote mode, True while the player is playing a song
+    ignore_ends: in remote mode, the number of song ends to be ignored
+    because the song was stopped
+    """
+    stdin_r, stdin_w = os.pipe()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    if remote is not None:
+        stdout_r, stdout_w = os.pipe()
+        argv = command + remote["options"]
+    else:
+        stdout_r, stdout_w = None, devnull
+        argv = command + [filename]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.dup2(stdin_r, 0)
+            os.dup2(stdout_w, 1)
+            os.dup2(stdout_w, 2)
+            if stopped:
+                os.kill(os.getpid(), signal.SIGSTOP)
+            os.execvp(argv[0], argv)
+        finally:
+            os._exit(127)
+    os.close(stdin_r)
+    os.close(devnull)
+    fcntl.fcntl(stdin_w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    if remote is not None:
+        os.close(stdout_w)
+        fcntl.fcntl(stdout_r, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    player = {"pid":pid, "returncode":None, "stdin":stdin_w, "stdout":stdout_r, "remote":remote, \
+        "filename":filename, "playing":False, "ignore_ends":0}
+    play_engine["players"][pid] = player
+    thread.start_new_thread(wait_player_thread, (play_engine, player))
+    if remote is not None:
+        thread.start_new_thread(player_output_thread, (play_engine, player))
+        if remote["init"] is not None:
+            send_to_player(player, remote["init"])
+    return player
+
+def send_to_player(player, remote_command):
+    """Writes a command to a player in remote mode.
+
+    Returns: True if it was written, False if the player is gone.
+    """
+    try:
+        os.write(player["stdin"], remote_command)
+        return True
+    except OSError:
+        return False
+
+def kill_player(player):
+    """Stops a player (see spawn_player(...)), even if it's waiting for 
+    SIGCONT.
+
+    Returns: None
+    """
+    if player is not None and player["returncode"] is None:
+        try:
+            os.kill(player["pid"], signal.SIGTERM)
+            os.kill(player["pid"], signal.SIGCONT)
+        except OSError:
+            pass
+
+def stop_player(player):
+    """Stops the song a player is playing. Players in remote mode are 
+    kept running, the others are killed.
+
+    Returns: None
+    """
+    if player is None:
+        return
+    if player["remote"] is None:
+        kill_player(player)
+    elif player["playing"]:
+        if player["remote"]["stop_ends"]:
+            player["ignore_ends"] = player["ignore_ends"] + 1
+        send_to_player(player, player["remote"]["stop"])
+        player["playing"] = False
+
+def player_command(filename, support_dict):
+    """
+    Returns: the player command to play filename (see check_players(...)),
+    None if there isn't one.
+    """
+    ext = os.path.splitext(filename.lower())[1]
+    if len(ext) and ext[0] == ".":
+        ext = ext[1:]
+    if support_dict.has_key(ext):
+        return support_dict[ext][0]
+    return None
+
+def remote_mode(command):
+    """
+    Returns: the remote mode (see the remote key of the players) of the 
+    player command (see check_players(...)), None if it hasn't one.
+    """
+    for player in KNOWN_PLAYERS:
+        if player["command"] == command[0]:
+            return player["remote"]
+    return None
+
+def song_length(tag_cache, filename):
+    """
+    Returns: the length of filename in seconds according to its tags, None
+    if it's not known.
+    """
+    if tag_cache is None:
+        return None
+    try:
+        info = cached_tag_info(tag_cache, filename)
+    except Exception:
+        return None
+    if info is None:
+        return None
+    return info["length"]
+
+def next_song(status, base_dir):
+    """status is the state of the playing thread (see new_play_engine(...)).
+
+    Returns: the absolute path of the song to be played when the current
+    one ends, None if there isn't one.
+    """
+    if len(status["queue"]["order"]):
+        return os.path.join(base_dir, status["file_list"][status["queue"]["order"][0]])
+    elif status["playing"] is not None and status["playing"] + 1 < len(status["file_list"]) \
+    and status["continue"]:
+        return os.path.join(base_dir, status["file_list"][status["playing"] + 1])
+    return None
+
+def upcoming_songs(status, base_dir, n_of_songs):
+    """status is the state of the playing thread (see new_play_engine(...)).
+
+    Returns: the absolute paths of the next n_of_songs songs to be played,
+    as next_song(...) picks them, if nothing changes.
+    """
+    songs = []
+    order = status["queue"]["order"]
+    playing = status["playing"]
+    while len(songs) < n_of_songs:
+        if len(songs) < len(order):
+            playing = order[len(songs)]
+        elif playing is not None and playing + 1 < len(status["file_list"]) and status["continue"]:
+            playing = playing + 1
+        else:
+            break
+        songs.append(os.path.join(base_dir, status["file_list"][playing]))
+    return songs
+
+def new_read_ahead(budget=READ_AHEAD_BUDGET, n_of_songs=READ_AHEAD_SONGS):
+    """Builds the read-ahead of the next songs (see read_ahead_thread(...)):
+    n_of_songs of them, no more than budget megabytes.
+
+    Returns: a dictionary with keys:
+    wake_pipe: the pipe waking up the read-ahead thread, written by the
+    playing thread when it publishes a state (see new_wake_pipe(...))
+    budget: in bytes
+    n_of_songs: n_of_songs
+    read: the absolute paths of the next songs read ahead -> (the number 
+    of bytes read ahead, the size of the file). Only the read-ahead thread
+    replaces it.
+    hits, misses: the songs started after another one ended which were 
+    read ahead, and which were not
+    bytes, files: the bytes and the files read ahead so far
+    """
+    return {"wake_pipe":new_wake_pipe(), "budget":budget*1024*1024, "n_of_songs":n_of_songs, \
+        "read":{}, "hits":0, "misses":0, "bytes":0, "files":0}
+
+def posix_fadvise_function():
+    """
+    Returns: posix_fadvise(fd, offset, length, advice) of the C library,
+    through ctypes, None if it's not there.
+    """
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        if hasattr(libc, "posix_fadvise64"):
+            fadvise = libc.posix_fadvise64
+            fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+        else:
+            fadvise = libc.posix_fadvise
+            fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+    except (ImportError, OSError, AttributeError):
+        return None
+    return fadvise
+
+def read_file_ahead(filename, n, fadvise=None):
+    """Reads the first n bytes of filename into the page cache: it asks 
+    the kernel to read them in the background through fadvise (see 
+    posix_fadvise_function(...)), if given, otherwise it reads them.
+
+    Returns: (the number of bytes read ahead, the size of the file), 
+    (0, None) if the file can't be read.
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return 0, None
+    done = 0
+    try:
+        size = os.fstat(fd).st_size
+        n = min(n, size)
+        if fadvise is not None and fadvise(fd, 0, n, POSIX_FADV_WILLNEED) == 0:
+            return n, size
+        while done < n:
+            data = os.read(fd, min(READ_AHEAD_CHUNK, n - done))
+            if not len(data):
+                break
+            done = done + len(data)
+        return done, size
+    except OSError:
+        return done, None
+    finally:
+        os.close(fd)
+
+def read_ahead_thread(play_engine, base_dir):
+    """The read-ahead thread.
+    Whenever the playing thread publishes a new state, reads ahead the next
+    songs that will be played (see upcoming_songs(...)) into the page 
+    cache, so that they start at once when the playing song ends, even 
+    from a cold disk or network mount. The budget of the read-ahead (see
+    new_read_ahead(...)) goes to the songs in the order they are played:
+    the start of a song is read ahead if it doesn't fit whole. Songs 
+    already read ahead are not read again.
+
+    The playing thread counts the songs started that were read ahead (see
+    play_thread(...)).
+
+    Returns: This method _never_ returns.
+    """
+    read_ahead = play_engine["read_ahead"]
+    fadvise = posix_fadvise_function()
+    state = None
+    while True:
+        try:
+            select.select([read_ahead["wake_pipe"][0]], [], [])
+        except select.error:
+            continue
+        os.read(read_ahead["wake_pipe"][0], 4096)
+        if play_engine["state"] is state:
+            continue
+        state = play_engine["state"]
+        budget = read_ahead["budget"]
+        read = {}
+        for filename in upcoming_songs(state, base_dir, read_ahead["n_of_songs"]):
+            if budget <= 0:
+                break
+            done, size = read_ahead["read"].get(filename, (0, None))
+            if size is None or done < min(size, budget):
+                start = time.time()
+                done, size = read_file_ahead(filename, budget, fadvise)
+                record_time("read-ahead", time.time() - start)
+                read_ahead["bytes"] = read_ahead["bytes"] + done
+                read_ahead["files"] = read_ahead["files"] + 1
+            if size is None:
+                continue
+            read[filename] = (min(done, budget), size)
+            budget = budget - read[filename][0]
+        # songs which are not next anymore are dropped
+        read_ahead["read"] = read
+
+def play_thread(play_engine, base_dir, support_dict):
+    """ The playing thread. 
+    Owns the state of play_engine (see new_play_engine(...)): it starts 
+    the songs, keeps the queue and the players.
+
+    It sleeps until a command arrives (see send_play_command(...)): a 
+    request from the user or from another thread, or the end of a song, 
+    reported by wait_player_thread(...) or player_output_thread(...).
+    When the commands are over, it publishes its new state, if it 
+    changed, and wakes up play_engine["ui_wake_pipe"]. It never takes a
+    lock.
+
+    Players with a remote mode are started once and kept running, songs
+    are loaded through their standard input (see spawn_player(...)). If 
+    that fails, the player is started again for each song.
+
+    PREWARM_TIME seconds before the playing song ends, according to its
+    tags, the player of the next song is started and stopped (see 
+    spawn_player(...)), so that it's ready to play when the song ends.
+    Players in remote mode don't need that.
+
+    play_engine["wakeups"] counts the times it woke up,
+    play_engine["transitions"] the songs started after another one
+    ended and play_engine["transition_time"] the total time it took
+    to start them. Of these songs, the ones that were read ahead (see 
+    read_ahead_thread(...)) are counted as hits of the read-ahead, the
+    others as misses: their transition times are recorded in STATS as
+    "read-ahead hit" and "read-ahead miss".
+    
+    Returns: after the command "quit".
+    """
+    # the player playing the song
+    play_process = None
+    # player command -> player in remote mode
+    remote_players = {}
+    # player commands whose remote mode doesn't work
+    remote_failed = set()
+    exit_time = None
+    # when to start the player of the next song
+    prewarm_time = None
+    # (filename, player) of the player of the next song
+    prewarmed = None
+    commands = play_engine["commands"]
+    # the next state, published when it's different from the last one.
+    # The queue is copied before it's changed: the published one is 
+    # never changed.
+    status = dict(play_engine["state"])
+    while True:
+        if prewarm_time is not None and not status["paused"]:
+            timeout = max(prewarm_time - time.time(), 0)
+        else:
+            timeout = None
+        try:
+            ready = select.select([play_engine["wake_pipe"][0]], [], [], timeout)[0]
+        except select.error:
+            continue
+        if len(ready):
+            os.read(play_engine["wake_pipe"][0], 4096)
+        play_engine["wakeups"] = play_engine["wakeups"] + 1
+        
+        if prewarm_time is not None and time.time() >= prewarm_time \
+        and not status["paused"]:
+            prewarm_time = None
+            filename = next_song(status, base_dir)
+            if filename is not None and prewarmed is None and player_command(filename, support_dict):
+                command = player_command(filename, support_dict)
+                if remote_mode(command) is None or tuple(command) in remote_failed:
+                    prewarmed = (filename, spawn_player(command, filename, play_engine, True))
+        
+        while len(commands):
+            command = commands.popleft()
+            
+            if command == "quit":
+                # the playing song, the prewarmed player and the players 
+                # in remote mode
+                for player in play_engine["players"].values():
+                    kill_player(player)
+                play_engine["stopped"].set()
+                return
+            
+            elif command == "stop_song":
+                stop_player(play_process)
+                kill_player(prewarmed and prewarmed[1])
+                
+                play_process = None
+                prewarmed = None
+                prewarm_time = None
+                status["playing"] = None
+                status["paused"] = False
+            
+            elif command == "pause":
+                if play_process is not None:
+                    status["paused"] = not status["paused"]
+                    if play_process["remote"] is not None:
+                        send_to_player(play_process, play_process["remote"]["pause"])
+                    else:
+                        # players without remote mode are simply stopped
+                        if status["paused"]:
+                            pause_signal = signal.SIGSTOP
+                            if prewarm_time is not None:
+                                prewarm_time = prewarm_time - time.time()
+                        else:
+                            pause_signal = signal.SIGCONT
+                            if prewarm_time is not None:
+                                prewarm_time = prewarm_time + time.time()
+                        try:
+                            os.kill(play_process["pid"], pause_signal)
+                        except OSError:
+                            pass
+            
+            elif command == "continue":
+                status["continue"] = not status["continue"]
+            
+            elif command[0] == "play":
+                if command[1] is None or command[1] >= len(status["file_list"]):
+                    continue
+                # the song at the head of the queue is being played now
+                if queue_position(status["queue"], command[1]) == 1:
+                    status["queue"] = queue_copy(status["queue"])
+                    queue_pop(status["queue"])
+                status["playing"] = command[1]
+                commands.appendleft(("start_song", os.path.join(base_dir, status["file_list"][command[1]])))
+            
+            elif command[0] == "start_song":
+                filename = command[1]
+                stop_player(play_process)
+                play_process = None
+                status["paused"] = False
+                prewarm_time = None
+                
+                player = player_command(filename, support_dict)
+                if player is not None and remote_mode(player) is not None \
+                and tuple(player) not in remote_failed and filename.find("\n") < 0:
+                    if not remote_players.has_key(tuple(player)):
+                        remote_players[tuple(player)] = spawn_player(player, None, play_engine, \
+                            remote=remote_mode(player))
+                    play_process = remote_players[tuple(player)]
+                    send_to_player(play_process, play_process["remote"]["load"] % \
+                        play_process["remote"]["quote"](filename))
+                    play_process["playing"] = True
+                    play_process["filename"] = filename
+                    kill_player(prewarmed and prewarmed[1])
+                elif prewarmed is not None and prewarmed[0] == filename:
+                    play_process = prewarmed[1]
+                    try:
+                        os.kill(play_process["pid"], signal.SIGCONT)
+                    except OSError:
+                        pass
+                else:
+                    kill_player(prewarmed and prewarmed[1])
+                    if player is not None:
+                        play_process = spawn_player(player, filename, play_engine)
+                prewarmed = None
+                
+                if play_process is not None and exit_time is not None:
+                    play_engine["transitions"] = play_engine["transitions"] + 1
+                    play_engine["transition_time"] = play_engine["transition_time"] + \
+                        time.time() - exit_time
+                    record_time("transition", time.time() - exit_time)
+                    read_ahead = play_engine["read_ahead"]
+                    if read_ahead is not None and read_ahead["read"].has_key(filename):
+                        read_ahead["hits"] = read_ahead["hits"] + 1
+                        record_time("read-ahead hit", time.time() - exit_time)
+                    elif read_ahead is not None:
+                        read_ahead["misses"] = read_ahead["misses"] + 1
+                        record_time("read-ahead miss", time.time() - exit_time)
+                exit_time = None
+                
+                if play_process is not None and play_process["remote"] is None:
+                    start_time = time.time()
+                    length = song_length(play_engine["tag_cache"], filename)
+                    if length is not None:
+                        prewarm_time = start_time + length - PREWARM_TIME
+            
+            elif command[0] == "seek":
+                if play_process is not None and play_process["remote"] is not None:
+                    send_to_player(play_process, play_process["remote"]["seek"] % command[1])
+            
+            elif command[0] == "queue":
+                status["queue"] = queue_copy(status["queue"])
+                queue_extend(status["queue"], [i for i in command[1] if i < len(status["file_list"])])
+            
+            elif command[0] == "unqueue":
+                if queue_position(status["queue"], command[1]) is not None:
+                    status["queue"] = queue_copy(status["queue"])
+                    queue_remove(status["queue"], command[1])
+            
+            elif command[0] == "playlist":
+                new_index = command[2]
+                status["file_list"] = command[1]
+                if status["playing"] is not None:
+                    status["playing"] = new_index[status["playing"]]
+                status["queue"] = queue_copy(status["queue"])
+                queue_remap(status["queue"], new_index)
+            
+            elif (command[0] == "exited" or command[0] == "ended") and play_process is not None \
+            and command[1] == play_process["pid"] and (command[0] == "exited" \
+            or (play_process["remote"] is not None and play_process["ignore_ends"] == 0)):
+                if command[0] == "exited":
+                    play_engine["players"].pop(command[1], None)
+                    os.close(play_process["stdin"])
+                    if play_process["remote"] is not None:
+                        # the player died or can't work in remote mode:
+                        # play the song again, one player per song
+                        for key in remote_players.keys():
+                            if remote_players[key] is play_process:
+                                del remote_players[key]
+                                remote_failed.add(key)
+                        if play_process["playing"]:
+                            commands.appendleft(("start_song", play_process["filename"]))
+                            play_process = None
+                            continue
+                else:
+                    play_process["playing"] = False
+                prewarm_time = None
+                status["paused"] = False
+                filename = next_song(status, base_dir)
+                if filename is not None:
+                    commands.appendleft(("start_song", filename))
+                    exit_time = command[2]
+                    if len(status["queue"]["order"]):
+                        status["queue"] = queue_copy(status["queue"])
+                        status["playing"] = queue_pop(status["queue"])
+                    else:
+                        status["playing"] = status["playing"] + 1
+                else:
+                    kill_player(prewarmed and prewarmed[1])
+                    prewarmed = None
+                    play_process = None
+                    status["playing"] = None
+            
+            elif command[0] == "exited":
+                # a player we already stopped
+                player = play_engine["players"].pop(command[1], None)
+                if player is not None:
+                    os.close(player["stdin"])
+                    for key in remote_players.keys():
+                        if remote_players[key] is player:
+                            del remote_players[key]
+            
+            else:
+                # the end of a song we stopped
+                player = play_engine["players"].get(command[1])
+                if player is not None and player["ignore_ends"] > 0:
+                    player["ignore_ends"] = player["ignore_ends"] - 1
+        
+        # the values are replaced, never changed in place
+        if [key for key in status if status[key] is not play_engine["state"][key]]:
+            play_engine["state"] = status
+            status = dict(status)
+            if play_engine["ui_wake_pipe"] is not None:
+                wake_up(play_engine["ui_wake_pipe"])
+            if play_engine["read_ahead"] is not None:
+                wake_up(play_engine["read_ahead"]["wake_pipe"])
+
+def new_search_index(file_list, n_of_files):
+    """Builds the search index of the first n_of_files files of file_list:
+    for each trigram (three consecutive characters) of the lowercased file 
+    names, the ascending array of the indices of the files containing it.
+
+    Returns: a dictionary with keys:
+    file_list: file_list (the index is stale if the playlist is replaced)
+    size: n_of_files
+    lowered: the list of the lowercased file names
+    trigrams: a dictionary: trigram -> array of indices
+    """
+    lowered = [name.lower() for name in file_list[:n_of_files]]
+    trigrams = {}
+    for i in xrange(n_of_files):
+        name = lowered[i]
+        for trigram in set([name[j:j+3] for j in xrange(len(name) - 2)]):
+            indices = trigrams.get(trigram)
+            if indices is None:
+                indices = trigrams[trigram] = array.array("i")
+            indices.append(i)
+    return {"file_list":file_list, "size":n_of_files, "lowered":lowered, "trigrams":trigrams}
+
+def start_search_index(display_status_dict, display_status_lock):
+    """Starts building the search index of the playlist in background (see
+    search_index_thread(...)), unless it's up to date or being built.
+
+    Must be called with display_status_lock held.
+
+    Returns: None
+    """
+    index = display_status_dict["search_index"]
+    if display_status_dict["indexing"] or (index is not None \
+    and index["file_list"] is display_status_dict["file_list"]):
+        return
+    display_status_dict["indexing"] = True
+    thread.start_new_thread(search_index_thread, (display_status_dict, display_status_lock))
+
+def search_index_thread(display_status_dict, display_status_lock):
+    """The search index thread.
+    Builds the search index (see new_search_index(...)) of the files in 
+    the playlist. Files appended later are searched without the index, if
+    the playlist is replaced (sorted or rescanned) the index is dropped.
+
+    Returns: when the index is built.
+    """
+    display_status_lock.acquire()
+    file_list = display_status_dict["file_list"]
+    n_of_files = len(file_list)
+    display_status_lock.release()
     
+    index = new_search_index(file_list, n_of_files)
+    
+    display_status_lock.acquire()
+    if display_status_dict["file_list"] is file_list:
+        display_status_dict["search_index"] = index
+    display_status_dict["indexing"] = False
+    display_status_lock.release()
+
+def search_playlist(display_status_dict, query, candidates=None):
+    """Searches the playlist for the files whose name contains query (bytes,
+    see search_key(...)), case insensitive. In tag mode the tag labels 
+    read so far are searched too (see tag_search_query(...)).
+
+    If candidates (a sorted list of indices) is given, only they are 
+    searched: the results for a prefix of query narrow as the user types.
+    If query is at least three characters long, the search index (see 
+    new_search_index(...)) gives the files that contain its rarest 
+    trigram, and only those are checked if they are much fewer than the 
+    candidates.
+    Must be called with display_status_lock held.
+
+    Returns: the sorted list of the indices of the matching files.
+    """
+    file_list = display_status_dict["file_list"]
+    tag_list = display_status_dict["tag_list"]
+    # file names are bytes, tags unicode
+    tag_query = tag_search_query(query)
+    query = query.lower()
+    index = display_status_dict["search_index"]
+    if index is not None and index["file_list"] is not file_list:
+        index = None
+    
+    if index is not None and len(query) >= 3:
+        trigrams = index["trigrams"]
+        rarest = min([trigrams.get(query[j:j+3], ()) for j in xrange(len(query) - 2)], key=len)
+    else:
+        rarest = None
+    
+    if candidates is not None:
+        # checking if a file is a candidate takes longer than checking its name
+        if rarest is not None and 4*len(rarest) < len(candidates):
+            lowered = index["lowered"]
+            size = index["size"]
+            results = [i for i in rarest if query in lowered[i] \
+                and bisect.bisect_left(candidates, i) < len(candidates) \
+                and candidates[bisect.bisect_left(candidates, i)] == i]
+            results.extend([i for i in candidates[bisect.bisect_left(candidates, size):] \
+                if query in file_list[i].lower()])
+        elif index is not None:
+            lowered = index["lowered"]
+            size = index["size"]
+            results = [i for i in candidates if (i < size and query in lowered[i]) \
+                or (i >= size and query in file_list[i].lower())]
+        else:
+            results = [i for i in candidates if query in file_list[i].lower()]
+        if display_status_dict["tag_mode"]:
+            results = sorted(set(results).union([i for i in candidates \
+                if tag_list[i] and tag_query in tag_search_text(tag_list[i])]))
+        return results
+    
+    if rarest is not None:
+        lowered = index["lowered"]
+        results = [i for i in rarest if query in lowered[i]]
+        start = index["size"]
+    else:
+        results = []
+        start = 0
+    results.extend([i for i in xrange(start, len(file_list)) if query in file_list[i].lower()])
+    if display_status_dict["tag_mode"]:
+        results = sorted(set(results).union([i for i in xrange(len(tag_list)) \
+            if tag_list[i] and tag_query in tag_search_text(tag_list[i])]))
+    return results
+
+def view_length(display_status_dict):
+    """
+    Returns: the number of lines of the list on the screen: the length of
+    the playlist, or of the filter results (see search_key(...)).
+    """
+    if display_status_dict["view"] is not None:
+        return len(display_status_dict["view"]["indices"])
+    return len(display_status_dict["file_list"])
+
+def cursor_index(display_status_dict):
+    """
+    Returns: the index in the playlist of the file under the cursor, None
+    if the list is empty.
+    """
+    position = display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"]
+    if position >= view_length(display_status_dict):
+        return None
+    if display_status_dict["view"] is not None:
+        return display_status_dict["view"]["indices"][position]
+    return position
+
+def view_position(display_status_dict, index):
+    """
+    Returns: the line of the list showing the file with that index in the
+    playlist, None if it's filtered out.
+    """
+    if display_status_dict["view"] is None:
+        return index
+    indices = display_status_dict["view"]["indices"]
+    position = bisect.bisect_left(indices, index)
+    if position < len(indices) and indices[position] == index:
+        return position
+    return None
+
+def show_position(display_status_dict, position):
+    """Moves the cursor to the line position of the list, scrolling the 
+    list if it isn't visible.
+
+    Returns: None
+    """
+    n_of_lines = curses.LINES - 2
+    text_index = display_status_dict["current_text_line"]
+    if position < text_index or position >= text_index + n_of_lines:
+        text_index = max(min(position - n_of_lines/2, view_length(display_status_dict) - n_of_lines), 0)
+    display_status_dict["current_text_line"] = text_index
+    display_status_dict["current_cursor_line"] = position - text_index
+
+def request_paint(display_status_dict):
+    """Asks the main loop to paint the screen again (see main(...)), the 
+    only thread calling curses.
+
+    Must be called with display_status_lock held.
+
+    Returns: None
+    """
+    if not display_status_dict["repaint"]:
+        display_status_dict["repaint"] = True
+        wake_up(display_status_dict["wake_pipe"])
+
+def wait_for_events(wake_fd, timeout=None):
+    """Waits for a key, for wake_fd (the reading end of a wake pipe, see
+    new_wake_pipe(...)) to be woken up or for a signal, up to timeout 
+    seconds (forever if None). The wake pipe is emptied.
+
+    Returns: None
+    """
+    if timeout is not None:
+        timeout = max(timeout, 0)
+    try:
+        ready = select.select([sys.stdin.fileno(), wake_fd], [], [], timeout)[0]
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return
+    if wake_fd in ready:
+        os.read(wake_fd, 4096)
+
+def read_keys(stdscr):
+    """
+    Returns: the list of all the keys pending, as stdscr.getch() returns 
+    them (stdscr must be in nodelay mode).
+    """
+    keys = []
+    ch = stdscr.getch()
+    while ch != -1:
+        keys.append(ch)
+        ch = stdscr.getch()
+    return keys
+
+def terminal_size():
+    """
+    Returns: (lines, columns) of the terminal on the standard output, 
+    (0, 0) if it doesn't know them.
+    """
+    try:
+        return struct.unpack("hh", fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, "\x00"*4))
+    except IOError:
+        return 0, 0
+
+def resize_screen(display_status_dict):
+    """Follows a resize of the terminal (curses.KEY_RESIZE): sets 
+    curses.LINES and curses.COLS, which python doesn't update, and keeps
+    the cursor on the same line of the list. The next paint_screen(...) 
+    paints everything again for the new size, no file is read.
+
+    Must be called with display_status_lock held.
+
+    Returns: None
+    """
+    position = display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"]
+    curses.LINES, curses.COLS = display_status_dict["stdscr"].getmaxyx()
+    if view_length(display_status_dict):
+        show_position(display_status_dict, min(position, view_length(display_status_dict) - 1))
+
+def start_search(display_status_dict, mode):
+    """Starts a search (mode "search") or a filter (mode "filter") of the
+    playlist, typed by the user (see search_key(...)).
+    A search looks into the files on the screen, a filter into the whole
+    playlist.
+
+    Must be called with display_status_lock held.
+
+    Returns: None
+    """
+    if mode == "filter":
+        clear_filter(display_status_dict)
+        results = None
+    elif display_status_dict["view"] is not None:
+        results = display_status_dict["view"]["indices"]
+    else:
+        results = None
+    display_status_dict["search"] = {"mode":mode, "history":[("", results)], \
+        "origin":cursor_index(display_status_dict)}
+
+def search_key(display_status_dict, ch):
+    """Handles a key typed during a search or a filter (see 
+    start_search(...)). Printable characters are added to the query, 
+    backspace removes the last one, enter ends the query and escape 
+    cancels it.
+
+    While a search is typed, the cursor moves to the first match from the
+    line where the search started. The query is kept for the next 
+    searches (see search_next(...)).
+    While a filter is typed, only the files that match are shown 
+    (display_status_dict["view"]): the lines of the list are positions in
+    display_status_dict["view"]["indices"]. Escape shows the whole 
+    playlist again.
+
+    Each character narrows the results of the previous query, backspace 
+    goes back to them.
+    Must be called with display_status_lock held.
+
+    Returns: None
+    """
+    search = display_status_dict["search"]
+    history = search["history"]
+    if ch == 27:
+        display_status_dict["search"] = None
+        if search["mode"] == "filter":
+            clear_filter(display_status_dict)
+        if search["origin"] is not None and view_position(display_status_dict, search["origin"]) is not None:
+            show_position(display_status_dict, view_position(display_status_dict, search["origin"]))
+        return
+    elif ch in (10, 13, curses.KEY_ENTER):
+        display_status_dict["search"] = None
+        if search["mode"] == "search" and len(history[-1][0]):
+            display_status_dict["last_search"] = history[-1][0]
+        return
+    elif ch in (curses.KEY_BACKSPACE, 127, 8):
+        if len(history) > 1:
+            history.pop()
+    elif 32 <= ch < 256:
+        query = history[-1][0] + chr(ch)
+        history.append((query, search_playlist(display_status_dict, query, history[-1][1])))
+    else:
+        return
+    
+    query, results = history[-1]
+    if search["mode"] == "filter":
+        if len(query):
+            display_status_dict["view"] = {"query":query, "indices":results}
+        else:
+            display_status_dict["view"] = None
+        display_status_dict["current_text_line"] = 0
+        display_status_dict["current_cursor_line"] = 0
+    elif len(query) and len(results):
+        first = bisect.bisect_left(results, search["origin"] or 0)
+        if first == len(results):
+            first = 0
+        show_position(display_status_dict, view_position(display_status_dict, results[first]))
+
+def search_next(display_status_dict, backward=False):
+    """Moves the cursor to the next (or previous) file matching the last
+    search (see search_key(...)), wrapping around the list.
+
+    Must be called with display_status_lock held.
+
+    Returns: True if a file matches.
+    """
+    if display_status_dict["last_search"] is None or not view_length(display_status_dict):
+        return False
+    if display_status_dict["view"] is not None:
+        candidates = display_status_dict["view"]["indices"]
+    else:
+        candidates = None
+    results = search_playlist(display_status_dict, display_status_dict["last_search"], candidates)
+    if not len(results):
+        return False
+    index = cursor_index(display_status_dict)
+    if backward:
+        position = bisect.bisect_left(results, index) - 1
+    else:
+        position = bisect.bisect_right(results, index)
+    show_position(display_status_dict, view_position(display_status_dict, results[position % len(results)]))
+    return True
+
+def clear_filter(display_status_dict):
+    """Shows the whole playlist again, after a filter (see search_key(...)),
+    keeping the cursor on the same file. The search being typed, if any,
+    is cancelled. Must be called before the playlist is reordered or 
+    replaced.
+
+    Returns: None
+    """
+    display_status_dict["search"] = None
+    if display_status_dict["view"] is not None:
+        index = cursor_index(display_status_dict)
+        display_status_dict["view"] = None
+        if index is not None:
+            show_position(display_status_dict, index)
+        else:
+            display_status_dict["current_text_line"] = 0
+            display_status_dict["current_cursor_line"] = 0
+
+def new_stats():
+    """Builds the timing statistics (see record_time(...)).
+
+    Returns: a dictionary with keys:
+    started: when they were built
+    timers: a dictionary, the keys are the names of what's timed, the 
+    values dictionaries with keys count, total, max (in seconds) and 
+    histogram: histogram[i] is how many times took STATS_BUCKETS[i - 1] 
+    to STATS_BUCKETS[i] seconds
+    lock: a lock guarding timers
+    """
+    return {"started":time.time(), "timers":{}, "lock":thread.allocate_lock()}
+
+# The timing statistics of this process, see record_time(...)
+STATS = new_stats()
+
+def record_time(name, seconds):
+    """Records in STATS that name took seconds.
+
+    Returns: None
+    """
+    STATS["lock"].acquire()
+    timer = STATS["timers"].get(name)
+    if timer is None:
+        timer = STATS["timers"][name] = {"count":0, "total":0.0, "max":0.0, \
+            "histogram":[0]*(len(STATS_BUCKETS) + 1)}
+    timer["count"] = timer["count"] + 1
+    timer["total"] = timer["total"] + seconds
+    if seconds > timer["max"]:
+        timer["max"] = seconds
+    timer["histogram"][bisect.bisect_left(STATS_BUCKETS, seconds)] += 1
+    STATS["lock"].release()
+
+class TimedLock:
+    """A lock like the ones of thread.allocate_lock(), which records in 
+    STATS, under name, the time threads wait for it when it's taken."""
+    def __init__(self, name):
+        self.lock = thread.allocate_lock()
+        self.name = name
+    
+    def acquire(self, blocking=1):
+        if self.lock.acquire(0):
+            return True
+        if not blocking:
+            return False
+        start = time.time()
+        self.lock.acquire()
+        record_time(self.name, time.time() - start)
+        return True
+    
+    def release(self):
+        self.lock.release()
+    
+    def locked(self):
+        return self.lock.locked()
+
+def timer_percentile(timer, fraction):
+    """
+    Returns: the upper bound of the histogram bucket where the given 
+    fraction of the times of timer (see new_stats(...)) is reached, its
+    max for the last bucket.
+    """
+    count = 0
+    for i in range(len(timer["histogram"])):
+        count = count + timer["histogram"][i]
+        if count >= fraction*timer["count"]:
+            if i < len(STATS_BUCKETS):
+                return min(STATS_BUCKETS[i], timer["max"])
+            break
+    return timer["max"]
+
+def stats_lines():
+    """
+    Returns: STATS as a table, a list of strings: for each timer, how many
+    times it was recorded, its mean, 95th percentile (approximated from 
+    the histogram) and max times in milliseconds.
+    """
+    lines = ["%-18s %6s %8s %8s %8s" % ("ms, %ds" % (time.time() - STATS["started"]), "count", "mean", \
+        "p95", "max")]
+    for name, timer in sorted(STATS["timers"].items()):
+        lines.append("%-18s %6d %8.2f %8.2f %8.2f" % (name[:18], timer["count"], \
+            1000*timer["total"] / timer["count"], 1000*timer_percentile(timer, 0.95), 1000*timer["max"]))
+    return lines
+
+def write_stats(filename=STATS_FILE):
+    """Writes STATS to filename, as JSON: the tables of stats_lines(...) 
+    and the histograms. It's called on exit and on SIGUSR1, without the 
+    lock of STATS: a signal may come while it's held.
+
+    The file is replaced atomically. Errors are ignored.
+
+    Returns: None
+    """
+    timers = {}
+    for name, timer in STATS["timers"].items():
+        timer = dict(timer)
+        timer["histogram"] = list(timer["histogram"])
+        timer["p50"] = timer_percentile(timer, 0.5)
+        timer["p95"] = timer_percentile(timer, 0.95)
+        timers[name] = timer
+    try:
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        fp = open(filename + ".tmp", "w")
+        try:
+            json.dump({"started":STATS["started"], "written":time.time(), "pid":os.getpid(), \
+                "buckets":STATS_BUCKETS, "timers":timers, "table":stats_lines()}, fp, indent=1, sort_keys=True)
+            fp.write("\n")
+        finally:
+            fp.close()
+        os.rename(filename + ".tmp", filename)
+    except (IOError, OSError):
+        pass
+
+def paint_display(display_status_dict, play_engine):
+    """Paints the screen showing the tag labels or the file names, 
+    according to tag mode. Lines whose tag label is not available yet show
+    the file name. If a filter is on, only the files that match are shown
+    (see search_key(...)).
+
+    Must be called with display_status_lock held, from the main loop only
+    (other threads call request_paint(...)). The playing song, the queue
+    and the pause come from the state published by the playing thread 
+    (see play_state(...)).
+
+    Returns: None
+    """
+    play = play_state(play_engine, display_status_dict["file_list"])
+    if display_status_dict["tag_mode"]:
+        paint_list = display_status_dict["tag_list"]
+        fallback_list = display_status_dict["file_list"]
+    else:
+        paint_list = display_status_dict["file_list"]
+        fallback_list = None
+    if display_status_dict["search"] is not None:
+        query, results = display_status_dict["search"]["history"][-1]
+        if display_status_dict["search"]["mode"] == "filter":
+            status = "filter: " + query
+        else:
+            status = "/" + query
+        if len(query):
+            status = status + " (" + str(len(results)) + " found)"
+    elif display_status_dict["scanning"]:
+        status = "scanning... " + str(len(display_status_dict["file_list"])) + " files"
+    elif display_status_dict["rescanning"]:
+        status = "rescanning..."
+    elif display_status_dict["tag_sort"] is not None:
+        status = "reading tags... " + str(display_status_dict["tag_sort"]["done"]) + "/" + \
+            str(display_status_dict["tag_sort"]["total"]) + " (escape to cancel)"
+    elif display_status_dict["message"] is not None:
+        status = display_status_dict["message"]
+    elif display_status_dict["view"] is not None:
+        status = "filter: " + display_status_dict["view"]["query"] + " (" + \
+            str(len(display_status_dict["view"]["indices"])) + " found)"
+    elif play["paused"]:
+        status = "paused"
+    elif not len(display_status_dict["file_list"]):
+        status = "no supported files"
+    else:
+        status = None
+    paint_screen(display_status_dict["stdscr"], paint_list, \
+        display_status_dict["current_cursor_line"], display_status_dict["current_text_line"], \
+        play["playing"], play["queue"], display_status_dict["base_path"], play["continue"], \
+        fallback_list, status, display_status_dict["screen"], \
+        display_status_dict["view"] and display_status_dict["view"]["indices"], \
+        display_status_dict["stats_overlay"] and stats_lines() or None)
+
+def new_screen():
+    """Builds the record of what paint_screen(...) painted on the screen, so
+    that the next call only paints what changed.
+
+    Returns: a dictionary with keys:
+    size: (curses.LINES, curses.COLS) when the screen was painted, None if
+    it has to be painted from scratch
+    text_index: the index of the first line of the list on the screen
+    rows: a list with an entry for each line of the list area, None if the
+    line has to be painted again (see paint_screen(...))
+    title: the title on the screen
+    footer: the status line on the screen
+    """
+    return {"size":None, "text_index":0, "rows":[], "title":None, "footer":None}
+
+def paint_screen(stdscr, file_list, line_index, text_index, hl_abs_index, queue, title, continuous, \
+        fallback_list=None, status=None, screen=None, view=None, overlay=None):
+    """Paints the screen.
+
+    If file_list[i] is None, fallback_list[i] is shown instead. If it's a 
+    dictionary, it's the tag information of fallback_list[i] (see 
+    tag_prefetch_thread(...)) and the label is built from it for the 
+    width of the screen.
+    queue is the play queue (see new_play_queue(...)).
+    status, if given, is a message shown in the status line.
+
+    screen (see new_screen(...)) is what was painted last time: only the 
+    lines that changed are painted again. When the list scrolls by less 
+    than a screen, the lines on the screen are scrolled too, so that only
+    the new ones are painted. screen is updated. Without screen, 
+    everything is painted.
+
+    If view (a list of indices in file_list) is given, the lines of the 
+    list are file_list[view[0]], file_list[view[1]], ... and line_index, 
+    text_index are positions in view.
+
+    overlay, if given, is a list of lines painted over the top right 
+    corner of the list (see stats_lines(...)).
+
+    The time it takes is recorded in STATS, see record_time(...).
+    
+    Returns: None
+    """
+    start = time.time()
+    if screen is None:
+        screen = new_screen()
+    n_of_rows = curses.LINES - 2
+    if screen["size"] != (curses.LINES, curses.COLS):
+        stdscr.erase()
+        stdscr.border()
+        screen["size"] = (curses.LINES, curses.COLS)
+        screen["rows"] = [None]*n_of_rows
+        screen["title"] = None
+        screen["footer"] = None
+    elif screen["text_index"] != text_index:
+        shift = text_index - screen["text_index"]
+        if abs(shift) < n_of_rows:
+            stdscr.scrollok(1)
+            stdscr.setscrreg(1, n_of_rows)
+            stdscr.scroll(shift)
+            stdscr.setscrreg(0, curses.LINES - 1)
+            stdscr.scrollok(0)
+            if shift > 0:
+                screen["rows"] = screen["rows"][shift:] + [None]*shift
+            else:
+                screen["rows"] = [None]*(-shift) + screen["rows"][:shift]
+        else:
+            screen["rows"] = [None]*n_of_rows
+    screen["text_index"] = text_index
+    
+    if screen["title"] != title:
+        if screen["title"] is not None:
+            stdscr.hline(0, 1, curses.ACS_HLINE, curses.COLS - 2)
+        stdscr.addstr(0, (curses.COLS-len(title))/2, title)
+        screen["title"] = title
+    if view is not None:
+        n_of_lines = len(view)
+    else:
+        n_of_lines = len(file_list)
+    if n_of_lines > curses.LINES - 2:
+        percentual_str = str((100*(text_index + curses.LINES - 2))/n_of_lines) + "%"
+    else:
+        percentual_str = "100%"
+    footer = (percentual_str, continuous, status)
+    if screen["footer"] != footer:
+        if screen["footer"] is not None:
+            stdscr.hline(curses.LINES-1, 1, curses.ACS_HLINE, curses.COLS - 2)
+        stdscr.addstr(curses.LINES-1, 2, "kolmogorov " + VERSION)
+        stdscr.addstr(curses.LINES-1, 6 + len("kolmogorov " + VERSION) + (4 - len(percentual_str)), percentual_str)
+        if continuous:
+            stdscr.addstr(curses.LINES-1, 14 + len("kolmogorov " + VERSION), "CONT")
+        if status is not None:
+            stdscr.addstr(curses.LINES-1, 20 + len("kolmogorov " + VERSION), \
+                status[:max(curses.COLS - 22 - len("kolmogorov " + VERSION), 0)])
+        screen["footer"] = footer
+    
+    rows = screen["rows"]
+    max_i = min(n_of_lines - text_index, n_of_rows)
+    for i in range(n_of_rows):
+        if i < max_i:
+            if view is not None:
+                index = view[i + text_index]
+            else:
+                index = i + text_index
+            label = file_list[index]
+            if label is None:
+                label = fallback_list[index]
+            row = (label, queue_position(queue, index), hl_abs_index == index, i == line_index)
+        else:
+            row = ()
+        if rows[i] == row:
+            continue
+        if rows[i] is None:
+            # a new line: the scroll may have blanked the border
+            stdscr.addch(i+1, 0, curses.ACS_VLINE)
+            stdscr.addch(i+1, curses.COLS-1, curses.ACS_VLINE)
+        rows[i] = row
+        if not len(row):
+            stdscr.addstr(i+1, 1, " "*(curses.COLS - 2))
+            continue
+        if isinstance(label, dict):
+            label = format_tag_label(fallback_list[index], label or None, curses.COLS - 8)
+        if len(label) > curses.COLS - 8:
+            filename = label[:curses.COLS-8]
+        else:
+            filename = label + " "*(curses.COLS - 8 - len(label))
+        if row[1] is not None:
+            queue_index = str(row[1])
+            stdscr.addstr(i+1, 2, (" "*(len(queue_index)==1) + queue_index).ljust(3))
+        else:
+            stdscr.addstr(i+1, 2, "   ")
+        if row[2] or row[3]:
+            if row[2] and row[3]:
+                stdscr.addch(i+1, 5, curses.ACS_DIAMOND)
+                stdscr.addch(i+1, 6, " ")
+                stdscr.addstr(i+1, 7, filename, curses.A_STANDOUT + curses.A_BOLD)
+            elif row[2]:
+                stdscr.addstr(i+1, 5, "  ")
+                stdscr.addstr(i+1, 7, filename, curses.A_STANDOUT) 
+            elif row[3]:
+                stdscr.addch(i+1, 5, curses.ACS_DIAMOND)
+                stdscr.addch(i+1, 6, " ")
+                stdscr.addstr(i+1, 7, filename, curses.A_BOLD)
+        else:
+            stdscr.addstr(i + 1, 5, "  " + filename)
+    if overlay is not None:
+        width = max([len(line) for line in overlay]) + 2
+        x = max(curses.COLS - 1 - width, 1)
+        for i in range(min(len(overlay), n_of_rows)):
+            stdscr.addstr(i + 1, x, (" " + overlay[i]).ljust(width)[:curses.COLS - 1 - x], curses.A_REVERSE)
+            # painted again when the overlay is gone
+            rows[i] = None
+    stdscr.refresh()
+    record_time("paint", time.time() - start)
+
+def main(stdscr, file_list, base_dir, support_dict, scan_options=None, dir_state=None, watch=False, \
+        tag_info=None, session=None, read_ahead_budget=READ_AHEAD_BUDGET):
+    """The main method. It holds the main while cycle.
+    
+    Returns: This method _never_ returns. It calls sys.exit
+    
+    Notice that this is different from the __name__ == '__main__' section
+    In that section the options are processed, the file list is read, we 
+    decide which type of audio file we can play and with which programs.
+
+    If scan_options is given, base_dir is scanned while the user interface
+    is running and the files found are added to file_list (see 
+    load_thread(...)). It is a dictionary with keys recursive, n_of_workers
+    and sort.
+
+    If dir_state is given, file_list comes from a scan of base_dir whose
+    state is dir_state (see load_dir_state(...)): base_dir is rescanned
+    for changes at once.
+    If watch is True, the scanned directories are watched for changes (see
+    watch_thread(...)).
+    tag_info is the tag information read from the playlist, if any (see
+    load_m3u(...)).
+    If session is given (see load_session(...)), file_list is its 
+    playlist: the cursor, the queue and the modes are restored, the song
+    that was playing when kolmogorov died is played again. The session is
+    saved while kolmogorov runs (see session_thread(...)).
+    While a song plays, up to read_ahead_budget megabytes of the next songs
+    are read ahead (see read_ahead_thread(...)), unless it's 0.
+
+    This is the player main method. Here keystrokes are processed.
+    """
+    if not isinstance(file_list, Playlist):
+        file_list = Playlist(file_list)
+    tag_list = [None]*len(file_list)
+    # loaded while the playlist is painted
+    tag_cache = load_tag_cache(background=True)
+    if tag_info is not None:
+        seed_tag_cache(tag_cache, tag_info)
+    display_status_dict = {"current_cursor_line":0, "current_text_line":0, "stdscr":stdscr, \
+            "tag_mode":False, "file_list":file_list, "tag_list":tag_list, "base_path":base_dir, \
+            "tag_cache":tag_cache, "scanning":scan_options is not None, "rescanning":False, \
+            "dir_state":dir_state, "message":None, "screen":new_screen(), "view":None, "search":None, \
+            "last_search":None, "search_index":None, "indexing":False, "stats_overlay":False, "tag_sort":None, \
+            "wake_pipe":new_wake_pipe(), "repaint":True, "resized":False}
+    if scan_options is not None:
+        n_of_workers = scan_options["n_of_workers"]
+    else:
+        n_of_workers = SCAN_WORKERS
+    display_status_lock = TimedLock("display lock wait")
+    # let curses scroll with the terminal's line insert/delete
+    stdscr.idlok(1)
+    
+    play_engine = new_play_engine(file_list, tag_cache, display_status_dict["wake_pipe"])
+    if session is None:
+        session = new_session(base_dir, file_list, dir_state)
+    else:
+        display_status_dict["tag_mode"] = session["tag_mode"]
+        text_index, line_index = session["cursor"]
+        if text_index + line_index < len(file_list):
+            display_status_dict["current_text_line"] = text_index
+            show_position(display_status_dict, text_index + line_index)
+        play_engine["state"]["queue"] = new_play_queue([i for i in session["queue"] if i < len(file_list)])
+        play_engine["state"]["continue"] = session["continue"]
+        if session["playing"] is not None and session["playing"] < len(file_list):
+            send_play_command(play_engine, ("play", session["playing"]))
+    session_writer = new_session_writer(session, tag_cache)
+    # kill -USR1 writes the timing statistics
+    signal.signal(signal.SIGUSR1, lambda signum, frame: write_stats())
+    
+    prefetch_dict = new_tag_prefetcher(display_status_dict, display_status_lock, base_dir)
+    
+    if read_ahead_budget > 0:
+        play_engine["read_ahead"] = new_read_ahead(read_ahead_budget)
+        thread.start_new_thread(read_ahead_thread, (play_engine, base_dir))
+    thread.start_new_thread(play_thread, (play_engine, base_dir, support_dict))
+    if scan_options is not None:
+        thread.start_new_thread(load_thread, (display_status_dict, display_status_lock, play_engine, \
+            base_dir, supported_extensions(support_dict), scan_options["recursive"], n_of_workers, \
+            scan_options["sort"]))
+    else:
+        display_status_lock.acquire()
+        if start_rescan(display_status_dict, display_status_lock):
+            thread.start_new_thread(rescan_thread, (display_status_dict, display_status_lock, \
+                play_engine, supported_extensions(support_dict), n_of_workers))
+        display_status_lock.release()
+    if watch:
+        thread.start_new_thread(watch_thread, (display_status_dict, display_status_lock, \
+            play_engine, supported_extensions(support_dict), n_of_workers))
+    thread.start_new_thread(session_thread, (session_writer, display_status_dict, display_status_lock, \
+        play_engine))
+
+    # main loop: wait for keys, paint requests (see request_paint(...)),
+    # new states of the playing thread and SIGWINCH, act on all the keys 
+    # pending, paint once, rinse, repeat.
+    # This is the only thread calling curses. It never waits for the 
+    # playing thread: it sends it commands (see send_play_command(...)).
+    stdscr.nodelay(1)
+    # the handler of curses, which would give curses.KEY_RESIZE, is 
+    # replaced: the terminal is resized by hand
+    signal.signal(signal.SIGWINCH, lambda signum, frame: display_status_dict.__setitem__("resized", True))
+    signal.set_wakeup_fd(display_status_dict["wake_pipe"][1])
+    last_paint = 0.0
+    # the state of the playing thread on the screen
+    painted_state = None
+    quit = False
+    while not quit:
+        display_status_lock.acquire()
+        if display_status_dict["resized"]:
+            display_status_dict["resized"] = False
+            lines, cols = terminal_size()
+            # a terminal with no size: curses keeps the one of LINES and
+            # COLUMNS
+            if lines > 0 and cols > 0 and (lines, cols) != (curses.LINES, curses.COLS):
+                curses.resizeterm(lines, cols)
+                resize_screen(display_status_dict)
+                display_status_dict["repaint"] = True
+        now = time.time()
+        if display_status_dict["stats_overlay"] and now - last_paint >= STATS_PAINT_INTERVAL:
+            display_status_dict["repaint"] = True
+        if play_engine["state"] is not painted_state:
+            display_status_dict["repaint"] = True
+        timeout = None
+        if display_status_dict["repaint"] and now - last_paint >= PAINT_INTERVAL:
+            if display_status_dict["tag_mode"]:
+                request_tag_prefetch(prefetch_dict, display_status_dict["current_text_line"], \
+                    curses.LINES - 2, display_status_dict["view"] and display_status_dict["view"]["indices"])
+            painted_state = play_engine["state"]
+            paint_display(display_status_dict, play_engine)
+            display_status_dict["repaint"] = False
+            last_paint = now
+        elif display_status_dict["repaint"]:
+            timeout = last_paint + PAINT_INTERVAL - now
+        if display_status_dict["stats_overlay"] and (timeout is None \
+        or last_paint + STATS_PAINT_INTERVAL - now < timeout):
+            timeout = last_paint + STATS_PAINT_INTERVAL - now
+        display_status_lock.release()
+        
+        wait_for_events(display_status_dict["wake_pipe"][0], timeout)
+        # keys, new states of the playing thread and the end of scans and 
+        # sorts all come through here
+        request_session_sync(session_writer)
+        keys = read_keys(stdscr)
+        if not len(keys):
+            continue
+        display_status_lock.acquire()
+        display_status_dict["repaint"] = True
+        for ch in keys:
+            # the playlist grows while it's being scanned
+            tot_lines = view_length(display_status_dict)
+            display_status_dict["message"] = None
+            
+            if ch == curses.KEY_RESIZE:
+                resize_screen(display_status_dict)
+        
+            elif display_status_dict["search"] is not None:
+                search_key(display_status_dict, ch)
+        
+            elif ch == ord("q"):
+                quit = True
+                break
+        
+            elif ch == curses.KEY_DOWN or ch == ord("j"): 
+                if display_status_dict["current_cursor_line"] + 1 < min(curses.LINES - 2, tot_lines):
+                    display_status_dict["current_cursor_line"] = display_status_dict["current_cursor_line"] + 1
+                elif display_status_dict["current_text_line"] + display_status_dict["current_cursor_line"] + 1 < tot_lines:
+                    display_status_dict["current_text_line"] = display_status_dict["current_text_line"] + 1
+        
+            elif ch == curses.KEY_UP or ch == ord("k"):
+                if display_status_dict["current_cursor_line"] > 0:
+                    display_status_dict["current_cursor_line"] = display_status_dict["current_cursor_line"] - 1
+                elif display_status_dict["current_text_line"] > 0:
+                    display_status_dict["current_text_line"] = display_status_dict["current_text_line"] - 1
+        
+            elif ch == curses.KEY_NPAGE:
+                step = curses.LINES - 4
+                if display_status_dict["current_text_line"] + step + curses.LINES - 2 < tot_lines:
+                    display_status_dict["current_text_line"] = display_status_dict["current_text_line"] + step
+                    display_status_dict["current_cursor_line"] = 0
+                elif tot_lines > curses.LINES - 2:
+                    display_status_dict["current_text_line"] = tot_lines - curses.LINES + 2
+                    display_status_dict["current_cursor_line"] = curses.LINES - 3
+                else:
+                    display_status_dict["current_cursor_line"] = max(tot_lines - 1, 0)
+        
+            elif ch == curses.KEY_PPAGE:
+                step = curses.LINES - 4
+                if display_status_dict["current_text_line"] - step > 0:
+                    display_status_dict["current_text_line"] = display_status_dict["current_text_line"] - step
+                else:
+                    display_status_dict["current_text_line"] = 0
+                display_status_dict["current_cursor_line"] = 0
+        
+            elif ch == curses.KEY_END:
+                display_status_dict["current_cursor_line"] = max(min(tot_lines, curses.LINES - 2) - 1, 0)
+                display_status_dict["current_text_line"] = max(tot_lines, curses.LINES - 2) - curses.LINES + 2
+        
+            elif ch == curses.KEY_HOME:
+                display_status_dict["current_cursor_line"] = 0
+                display_status_dict["current_text_line"] = 0
+        
+            elif (ch == curses.KEY_ENTER or ch == ord(" ")) and tot_lines:
+                if play_state(play_engine, display_status_dict["file_list"])["playing"] == \
+                cursor_index(display_status_dict):
+                    send_play_command(play_engine, "stop_song")
+                else:
+                    send_play_command(play_engine, ("play", cursor_index(display_status_dict)))
+        
+            elif ch == ord("+") and tot_lines:
+                send_play_command(play_engine, ("queue", [cursor_index(display_status_dict)]))
+        
+            elif ch == ord("A") and tot_lines:
+                first, last = directory_span(display_status_dict["file_list"], cursor_index(display_status_dict))
+                send_play_command(play_engine, ("queue", range(first, last)))
+        
+            elif ch == ord("-") and tot_lines:
+                send_play_command(play_engine, ("unqueue", cursor_index(display_status_dict)))
+        
+            elif ch == ord("p"):
+                send_play_command(play_engine, "pause")
+        
+            elif ch == curses.KEY_LEFT or ch == curses.KEY_RIGHT:
+                if ch == curses.KEY_LEFT:
+                    send_play_command(play_engine, ("seek", -SEEK_STEP))
+                else:
+                    send_play_command(play_engine, ("seek", SEEK_STEP))
+        
+            elif ch == ord("c"):
+                send_play_command(play_engine, "continue")
+        
+            elif ch == ord("S"):
+                # the line of the playing song, None if it's filtered out
+                hl_position = None
+                playing = play_state(play_engine, display_status_dict["file_list"])["playing"]
+                if playing is not None:
+                    hl_position = view_position(display_status_dict, playing)
+                if hl_position is not None and \
+                        hl_position < display_status_dict["current_text_line"] or \
+                        hl_position > display_status_dict["current_text_line"] + \
+                        curses.LINES + 2 - 5: # wtf shouldn't this be -1 ??
+                    if tot_lines - hl_position >= curses.LINES -2:
+                        display_status_dict["current_text_line"] = hl_position - \
+                            1*(hl_position > 0)
+                        display_status_dict["current_cursor_line"] = 1 
+                    else:
+                        display_status_dict["current_text_line"] = tot_lines - curses.LINES -2 +4
+                        display_status_dict["current_cursor_line"] = hl_position - \
+                            display_status_dict["current_text_line"]
+        
+            elif ch == ord("/") or ch == ord("f"):
+                start_search_index(display_status_dict, display_status_lock)
+                if ch == ord("/"):
+                    start_search(display_status_dict, "search")
+                else:
+                    start_search(display_status_dict, "filter")
+        
+            elif ch == ord("n") or ch == ord("N"):
+                if not search_next(display_status_dict, ch == ord("N")) and \
+                display_status_dict["last_search"] is not None:
+                    display_status_dict["message"] = "not found: " + display_status_dict["last_search"]
+        
+            elif ch == ord("s"):
+                if not display_status_dict["tag_mode"]:
+                    clear_filter(display_status_dict)
+                    sorted_list, tag_list, hl_index, new_index = sort_playlist(display_status_dict["file_list"], \
+                        display_status_dict["tag_list"], None)
+                    replace_playlist(display_status_dict, play_engine, sorted_list, tag_list, new_index)
+                else:
+                    # First we need to read all tags, then we can sort by 
+                    # artist, album, track number and title.
+                    if start_tag_sort(display_status_dict, display_status_lock):
+                        thread.start_new_thread(tag_sort_thread, (display_status_dict, display_status_lock, \
+                            play_engine, base_dir))
+        
+            elif ch == 27 and display_status_dict["tag_sort"] is not None:
+                display_status_dict["tag_sort"]["cancel"] = True
+
+        
+            elif ch == ord("T") and TAG_SUPPORT:
+                display_status_dict["tag_mode"] = not display_status_dict["tag_mode"]
+        
+            elif ch == ord("r"):
+                stdscr.clearok(1)
+        
+            elif ch == ord("i"):
+                display_status_dict["stats_overlay"] = not display_status_dict["stats_overlay"]
+        
+            elif ch == ord("R"):
+                if start_rescan(display_status_dict, display_status_lock):
+                    thread.start_new_thread(rescan_thread, (display_status_dict, display_status_lock, \
+                        play_engine, supported_extensions(support_dict), n_of_workers))
+        display_status_lock.release()
+    # end of while
+    send_play_command(play_engine, "quit")
+    play_engine["stopped"].wait()
+    sync_session(session_writer, display_status_dict, display_status_lock, play_engine, True)
+    if len(display_status_dict["file_list"]):
+        write_m3u(display_status_dict["file_list"], base_dir, os.path.expanduser("~/.kolmogorov_playlist.m3u"), \
+            tag_cache)
+        save_dir_state(display_status_dict["dir_state"])
+    save_tag_cache(tag_cache, base_dir, display_status_dict["file_list"])
+    write_stats()
+    #fp = open(os.path.expanduser("~/.kolmogorov_playlist"), "w")
+    #cPickle.dump((base_dir, display_status_dict["file_list"]), fp)
+    #fp.close()
+    sys.exit(0)
+
+if __name__ == '__main__':
+    recursive = False
+    sort = False
+    watch = False
+    n_of_workers = SCAN_WORKERS
+    new_roots = []
+    update = False
+    query = None
+    query_name = None
+    show_library = False
+    read_ahead_budget = READ_AHEAD_BUDGET
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hLVrstpj:wa:uq:n:lb:", ("help", "license", "version", "recursive", "sort", "tag", "players", \
+            "jobs=", "watch", "add=", "update", "query=", "name=", "library", "read-ahead="))
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for option, a  in opts:
+        if option in ("-h", "--help"):
+            usage()
+            sys.exit(9)
+        if option in ("-L", "--license"):
+            print __doc__
+            sys.exit(0)
+        if option in ("-V", "--version"):
+            print VERSION
+            sys.exit(10)
+        if option in ("-p", "--players"):
+            print_players()
+            sys.exit(10)
+        if option in ("-r", "--recursive"):
+            recursive = True
+        if option in ("-s", "--sort"):
+            sort = True
+        if option in ("-t", "--tag"):
+            print "Tag support (through mutagen): " + str(TAG_SUPPORT)
+            sys.exit(11)
+        if option in ("-j", "--jobs"):
+            try:
+                n_of_workers = int(a)
+            except ValueError:
+                usage()
+                sys.exit(2)
+        if option in ("-w", "--watch"):
+            watch = True
+        if option in ("-a", "--add"):
+            new_roots.append(os.path.realpath(os.path.abspath(os.path.expanduser(a))))
+            update = True
+        if option in ("-u", "--update"):
+            update = True
+        if option in ("-q", "--query"):
+            query = a
+        if option in ("-n", "--name"):
+            query_name = a
+        if option in ("-l", "--library"):
+            show_library = True
+        if option in ("-b", "--read-ahead"):
+            try:
+                read_ahead_budget = int(a)
+            except ValueError:
+                usage()
+                sys.exit(2)
+    if query_name is not None and query is None:
+        usage()
+        sys.exit(2)
+
     support_dict = check_players(KNOWN_PLAYERS, KNOWN_EXTENSIONS)
     if len(support_dict) == 0:
         print "Error: Kolmogorov didn't find any supported player to play your media."
@@ -804,7 +4592,58 @@ if __name__ == '__main__':
             support_dict[ext] = [support_dict[ext][0]]
     
     #print args
-    if len(args) != 1 and not os.path.exists(os.path.expanduser("~/.kolmogorov_playlist.m3u")):
+    scan_options = None
+    dir_state = None
+    tag_info = None
+    session = None
+    if len(new_roots) or update or query is not None or show_library:
+        if not LIBRARY_SUPPORT:
+            print "Error: the library needs the sqlite3 module."
+            sys.exit(12)
+        import sqlite3
+        try:
+            library = open_library()
+            for path in new_roots:
+                if not os.path.isdir(path):
+                    print "Error: " + path + " is not a directory."
+                    sys.exit(34)
+                add_library_root(library, path)
+            if update:
+                tag_cache = load_tag_cache()
+                for root, n_of_files, updated, removed in update_library(library, \
+                        supported_extensions(support_dict), n_of_workers, tag_cache=tag_cache):
+                    print root + ": " + str(n_of_files) + " files, " + str(updated) + " new or changed, " + \
+                        str(removed) + " removed."
+                save_tag_cache(tag_cache)
+            if query_name is not None:
+                save_library_query(library, query_name, query)
+            if show_library:
+                for root in library_roots(library):
+                    print "root: " + root
+                print str(library.execute("select count(*) from tracks").fetchone()[0]) + " files."
+                for name, saved_query in library_playlists(library):
+                    print "playlist " + name + ": " + saved_query
+            if query is None:
+                sys.exit(0)
+            file_list, base_path, tag_info = query_library(library, query)
+        except ValueError, e:
+            print "Error: bad query, " + str(e) + "."
+            sys.exit(2)
+        except sqlite3.Error, e:
+            print "Error: the library " + LIBRARY_FILE + " can't be used, " + str(e) + "."
+            sys.exit(12)
+        library.close()
+        if not len(file_list):
+            print "Error: no file in the library matches the query."
+            sys.exit(34)
+    
+    if len(args) != 1 and query is None:
+        session = load_session()
+    if query is not None:
+        # the playlist is the result of the query
+        pass
+    elif len(args) != 1 and session is None \
+    and not os.path.exists(os.path.expanduser("~/.kolmogorov_playlist.m3u")):
         usage()
         sys.exit(2)
     elif len(args) == 1:
@@ -813,26 +4652,37 @@ if __name__ == '__main__':
 
         if not os.path.isdir(base_path):
             if is_m3u_playlist(base_path):
-                file_list, base_path = load_m3u(base_path)
-                print base_path, file_list[0]
+                file_list, base_path, tag_info = load_m3u(base_path)
             else:
                 print "Error: Kolmogorov doesn't play single files.\nYou can use mpg123/ogg123 directly."
                 sys.exit(34)
         else:
-            file_list = read_file_list(base_path, support_dict, recursive)
-            if len(file_list) == 0:
-                print "Error: empty file list."
-                print base_path, "doesn't contain any supported file."
-                sys.exit(12)    
+            # the directory is scanned while the user interface is running
+            file_list = []
+            scan_options = {"recursive":recursive, "n_of_workers":n_of_workers, "sort":sort}
+    elif session is not None:
+        # the playlist is resumed as it was, sorted or not
+        file_list, base_path, dir_state = session["file_list"], session["base_dir"], session["dir_state"]
+        sort = False
     elif os.path.exists(os.path.expanduser("~/.kolmogorov_playlist.m3u")):
-        file_list, base_path = load_m3u(os.path.expanduser("~/.kolmogorov_playlist.m3u"))
+        file_list, base_path, tag_info = load_m3u(os.path.expanduser("~/.kolmogorov_playlist.m3u"))
+        dir_state = load_dir_state()
+        if dir_state is not None:
+            rebased_file_list = rebase_file_list(file_list, base_path, dir_state["base_dir"])
+            if rebased_file_list is None:
+                dir_state = None
+            else:
+                file_list, base_path = rebased_file_list, dir_state["base_dir"]
         #fp = open(os.path.expanduser("~/.kolmogorov_playlist.m3u"), "r")
         #base_path, file_list = cPickle.load(fp)
         #fp.close()
 
     if sort:
-        file_list.sort(cmp=lambda a, b: cmp(a.lower(), b.lower()))
+        file_list.sort(key=lambda name: name.lower())
     
     #print support_dict
-    stdscr = curses.wrapper(main, file_list, base_path, support_dict)
+    # escape ends searches, don't wait a second for escape sequences
+    os.environ.setdefault("ESCDELAY", "25")
+    stdscr = curses.wrapper(main, file_list, base_path, support_dict, scan_options, dir_state, watch, \
+        tag_info, session, read_ahead_budget)
 
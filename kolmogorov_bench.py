@@ -0,0 +1,1272 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""kolmogorov_bench, benchmarks for kolmogorov
+Copyright (C) 2007  G. G. Venturini
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, version 3 of the License.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>."""
+
+import os, sys, getopt, time, tempfile, shutil, subprocess, signal, thread, curses, struct
+import json, platform
+import kolmogorov
+
+BENCHMARKS = ("scan", "library", "tags", "play", "paint", "sort", "memory", "startup", "session", \
+    "query", "readahead", "tagcache")
+
+def usage():
+    """Prints usage info.
+
+    Returns: None
+    """
+    print "kolmogorov_bench: benchmarks for kolmogorov.\n"
+    print "Usage: \n\tkolmogorov_bench [options] [benchmark ...]\n"
+    print "Available benchmarks are:"
+    print "\tscan\tcompares the directory scanners on a synthetic tree."
+    print "\tlibrary\ttimes scanning, m3u, tag labels, sorting and painting on a synthetic tagged library."
+    print "\ttags\tcompares the header-only tag reader with mutagen: tags per second and bytes read."
+    print "\tplay\tcompares the playing threads: song transition latency and idle wakeups."
+    print "\tpaint\tcompares the screen painters while the cursor moves down the playlist."
+    print "\tsort\tcompares the playlist sorts, by file name and by tags."
+    print "\tmemory\tcompares the memory used by a list of paths and by a Playlist."
+    print "\tstartup\tcompares the player discovery, and times the import of kolmogorov."
+    print "\tsession\tcompares resuming the last session from the m3u playlist and from the session snapshot."
+    print "\tquery\ttimes filling the library database and opening a playlist by a query on it."
+    print "\treadahead\tcompares reading songs dropped from the page cache, cold and read ahead."
+    print "\ttagcache\ttimes loading the tag cache, blocking and in the background, and saving it, whole and by its journal."
+    print "If no benchmark is given, all of them are run.\n"
+    print "Available options are:"
+    print "\t-h (--help)\tprint this help and quit."
+    print "\t-d N (--depth=N)\tdepth of the synthetic tree and library (default 3)."
+    print "\t-w N (--width=N)\tsubdirectories in each directory (default 6)."
+    print "\t-f N (--files=N)\tfiles in each directory (default 12)."
+    print "\t-g DIR (--generate=DIR)\tbuild a synthetic library in DIR (see -d, -w, -f) and quit."
+    print "\t-o FILE (--output=FILE)\twrite the results to FILE as JSON."
+    print "\t-c FILE (--compare=FILE)\tcompare the results with the JSON ones of a previous run."
+    print "\t-j N (--jobs=N)\tworkers of the parallel scan (default 8)."
+    print "\t-n N (--repeat=N)\ttimes each scanner is run, the best run is kept (default 3)."
+    print "\t-s N (--songs=N)\tsongs played by the play benchmark (default 10)."
+    print "\t-l N (--lines=N)\tlines of the fake screen of the paint benchmark (default 50)."
+    print "\t-q N (--queue=N)\tqueued songs in the paint benchmark (default 1000)."
+    print "\t-e N (--entries=N)\tplaylist entries in the sort benchmark (default 100000)."
+    print "\t-t N (--tracks=N)\tplaylist entries in the memory benchmark (default 1000000)."
+    print "\t-u N (--session=N)\tplaylist entries in the session benchmark (default 500000)."
+    print "\t-k N (--indexed=N)\ttracks in the library database of the query benchmark (default 500000)."
+
+def read_file_list(base_path, supported_dict, recursive=False, n_of_workers=kolmogorov.SCAN_WORKERS):
+    """The read_file_list(...) of kolmogorov after iter_file_list(...), 
+    which now scans while the user interface runs: the whole scan, at
+    once, kept as a reference.
+
+    If recursive == True: load recursively all subdirs, listing
+    n_of_workers directories at a time.
+
+    Returns: the filtered list of filenames."""
+    file_list = []
+    for files in kolmogorov.iter_file_list(base_path, kolmogorov.supported_extensions(supported_dict), \
+            recursive, n_of_workers):
+        file_list.extend(files)
+    return file_list
+
+def legacy_read_file_list(base_path, supported_dict, recursive=False):
+    """The os.walk based read_file_list(...) of kolmogorov 0.051beta, kept
+    as a reference.
+
+    Returns: the filtered list of filenames."""
+    file_list = []
+    for root, dirs, files in os.walk(base_path):
+        if os.path.samefile(base_path, root):
+            file_list = file_list + files
+            if not recursive:
+                break
+        else:
+            temp_root = root
+            temp_top = ""
+            while(True):
+                base, top = os.path.split(os.path.normpath(temp_root))
+                temp_top = os.path.join(top, temp_top)
+                if os.path.samefile(base, base_path):
+                    file_list = file_list + [os.path.join(temp_top, af) for af in files]
+                    break
+                else:
+                    temp_root = base
+
+    file_list = [ af for af in file_list if kolmogorov.is_file_supported(af, supported_dict) ]
+    return file_list
+
+def legacy_play_thread(play_status_dict, play_status_lock, display_status_dict, \
+    display_status_lock, base_dir, support_dict):
+    """The polling play_thread(...) of kolmogorov 0.051beta, kept as a 
+    reference.
+    
+    Returns: This method _never_ returns.
+    """
+    play_process = None
+    while True:
+        play_status_lock.acquire()
+        
+        if play_status_dict["todo"] == "start_song":
+            filename = play_status_dict["queue_file"].pop(0)
+            
+            if play_process is not None and play_process.poll() is None:
+                os.kill(play_process.pid, signal.SIGTERM)
+            
+            ext = os.path.splitext(filename.lower())[1]
+            if len(ext) and ext[0] == ".":
+                ext = ext[1:]
+            if support_dict.has_key(ext):
+                play_process = subprocess.Popen(support_dict[ext][0] + [filename], \
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, \
+                    stderr=subprocess.STDOUT)
+                play_status_dict["pp_pid"] = play_process.pid
+                
+            play_status_dict["todo"] = "do_nothing"
+        
+        elif play_status_dict["todo"] == "stop_song":
+            if play_process is not None and play_process.poll() is None:
+                os.kill(play_process.pid, signal.SIGTERM)
+            
+            play_process = None
+            play_status_dict["pp_pid"] = None
+            play_status_dict["todo"] = "do_nothing"
+        
+        play_status_lock.release()
+
+        if play_process is not None and play_process.poll() is not None:
+            play_status_lock.acquire()
+            if len(play_status_dict["queue_index"]) \
+            and len(play_status_dict["queue_file"]):
+                play_status_dict["todo"] = "start_song"
+                display_status_lock.acquire()
+                display_status_dict["abs_hilighted_line"] = \
+                    play_status_dict["queue_index"].pop(0)
+                play_status_lock.release()
+            elif display_status_dict["abs_hilighted_line"] + 1 < \
+            len(display_status_dict["file_list"]) and play_status_dict["continue"]:
+                play_status_dict["todo"] = "start_song"
+                play_status_dict["queue_file"].append(os.path.join(base_dir, \
+                    display_status_dict["file_list"][display_status_dict["abs_hilighted_line"]+1]))
+                play_status_lock.release()
+                display_status_lock.acquire()
+                display_status_dict["abs_hilighted_line"] = display_status_dict["abs_hilighted_line"] + 1
+            else:
+                play_process = None
+                play_status_dict["pp_pid"] = None
+                play_status_lock.release()
+                display_status_lock.acquire()
+                display_status_dict["abs_hilighted_line"] = None
+            
+            kolmogorov.paint_display(display_status_dict, play_status_dict)
+            
+            display_status_lock.release()
+
+        else:
+            time.sleep(0.4)
+        time.sleep(0.3)
+
+def legacy_check_players(KNOWN_PLAYERS, KNOWN_EXTENSIONS):
+    """The check_players(...) of kolmogorov 0.051beta, kept as a reference:
+    it runs 'which' once for each known player.
+
+    Returns: the support dictionary (see check_players(...))"""
+    support_dict = {}
+    
+    for player in KNOWN_PLAYERS:
+        s = subprocess.Popen(("which", player["command"]), stdin=subprocess.PIPE, \
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if s.wait() != 0: # file not found
+            continue
+        for ext in [k for k in KNOWN_EXTENSIONS if player[k]]:
+            if support_dict.has_key(ext):
+                support_dict[ext] = support_dict[ext] + [[player["command"]] + \
+                    player["options"]]
+            else:
+                support_dict.update({ext:[[player["command"]] + player["options"]]})
+            
+    return support_dict
+
+def tag_sort_keys(file_list, base_dir, tag_cache=None):
+    """The sort keys of the sort by tags of kolmogorov before 
+    tag_sort_thread(...), kept as a reference: the tags of all the files in
+    file_list are read (through tag_cache, if given) one after the other.
+
+    Returns: the list of their sort keys (see tag_sort_key(...)).
+    """
+    keys = []
+    reader = kolmogorov.new_tag_reader()
+    for name in file_list:
+        filename = os.path.join(base_dir, name)
+        if tag_cache is None:
+            info = kolmogorov.read_tag_info(filename, reader)
+        else:
+            info = kolmogorov.cached_tag_info(tag_cache, filename, reader)
+        keys.append(kolmogorov.tag_sort_key(name, info))
+    return keys
+
+def build_label_from_tag(filename, n_of_cols):
+    """The label of filename in tag mode, as kolmogorov built it before the
+    tags were kept in tag_list and the labels formatted when painting,
+    kept as a reference: the tags are read for each label.
+
+    Returns: the label (a unicode string)
+    """
+    return kolmogorov.format_tag_label(filename, kolmogorov.read_tag_info(filename), n_of_cols)
+
+def legacy_read_tag_info(filename):
+    """The read_tag_info(...) of kolmogorov before read_tag_header(...), 
+    kept as a reference: mutagen reads every file.
+
+    Returns: the tag information (see read_tag_info(...)), None if mutagen
+    doesn't recognize the file.
+    """
+    import mutagen, mutagen.mp3, mutagen.easyid3
+    if filename.lower().endswith(".mp3"):
+        audio = mutagen.mp3.MP3(filename, ID3=mutagen.easyid3.EasyID3)
+    else:
+        audio = mutagen.File(filename)
+    if audio is None:
+        return None
+
+    info = {}
+    for key in ("artist", "album", "tracknumber", "title", "date"):
+        if audio.has_key(key) and len(audio[key][0]) and not audio[key][0].isspace():
+            info[key] = audio[key][0]
+        else:
+            info[key] = None
+    info["mime"] = audio.mime[0]
+    if hasattr(audio.info, "bitrate"):
+        info["bitrate"] = audio.info.bitrate
+    else:
+        info["bitrate"] = None
+    info["length"] = audio.info.length
+    return info
+
+def legacy_sort_playlist(primary_list, sec_list, aindex):
+    """The sort_playlist(...) of kolmogorov 0.051beta, kept as a reference.
+
+    Case-insensitive sorts the primary list.
+    
+    sec_list is ordered to reflect primary_list's new sorting.
+    aindex is a index on a element in primary list. The method returns 
+    the index of the same element in the sorted list."""
+
+    if aindex is not None:
+        avalue = primary_list[aindex]
+    tmp_dict = {}
+    for i in range(len(primary_list)):
+        tmp_dict.update({primary_list[i]:sec_list[i]})
+    primary_list.sort(cmp=lambda a, b: cmp(a.lower(), b.lower()))
+    return_sec_list = []
+    for i in range(len(primary_list)):
+        return_sec_list = return_sec_list + [tmp_dict[primary_list[i]]]
+    if aindex is not None:
+        ret_index = primary_list.index(avalue)
+    else:
+        ret_index = None
+    return primary_list, return_sec_list, ret_index
+
+def legacy_paint_screen(stdscr, file_list, line_index, text_index, hl_abs_index, queue, title, continuous, \
+        fallback_list=None, status=None):
+    """The paint_screen(...) of kolmogorov 0.051beta, kept as a reference:
+    it paints everything and queue is the list of queued indices.
+
+    If file_list[i] is None, fallback_list[i] is shown instead.
+    status, if given, is a message shown in the status line.
+    
+    Returns: None
+    """
+    if len(file_list) > curses.LINES - 2:
+        percentual_str = str((100*(text_index + curses.LINES - 2))/(len(file_list))) + "%"
+    else:
+        percentual_str = "100%"
+    stdscr.border()
+    stdscr.addstr(0, (curses.COLS-len(title))/2, title)
+    stdscr.addstr(curses.LINES-1, 2, "kolmogorov " + kolmogorov.VERSION)
+    stdscr.addstr(curses.LINES-1, 6 + len("kolmogorov " + kolmogorov.VERSION) + (4 - len(percentual_str)), percentual_str)
+    if continuous:
+        stdscr.addstr(curses.LINES-1, 14 + len("kolmogorov " + kolmogorov.VERSION), "CONT")
+    if status is not None:
+        stdscr.addstr(curses.LINES-1, 20 + len("kolmogorov " + kolmogorov.VERSION), \
+            status[:max(curses.COLS - 22 - len("kolmogorov " + kolmogorov.VERSION), 0)])
+    
+    max_i = min(len(file_list) - text_index, curses.LINES - 2)
+    for i in range(max_i):
+        label = file_list[i + text_index]
+        if label is None:
+            label = fallback_list[i + text_index]
+        if len(label) > curses.COLS - 8:
+            filename = label[:curses.COLS-8]
+        else:
+            #print  file_list[i + text_index]
+            filename = label + " "*(curses.COLS - 8 - len(label))
+        if queue.count(i + text_index):
+            queue_index = str(1 + queue.index(i + text_index))
+            stdscr.addstr(i+1, 2 , " "*(len(queue_index)==1) + queue_index)
+        else:
+            stdscr.addstr(i+1, 2, "   ")
+        if hl_abs_index == i + text_index or i == line_index:
+            if hl_abs_index == i + text_index and i == line_index:
+                stdscr.addch(i+1, 5, curses.ACS_DIAMOND)
+                stdscr.addch(i+1, 6, " ")
+                stdscr.addstr(i+1, 7, filename, curses.A_STANDOUT + curses.A_BOLD)
+            elif hl_abs_index == i + text_index:
+                stdscr.addstr(i+1, 5, "  ")
+                stdscr.addstr(i+1, 7, filename, curses.A_STANDOUT) 
+            elif i == line_index:
+                stdscr.addch(i+1, 5, curses.ACS_DIAMOND)
+                stdscr.addch(i+1, 6, " ")
+                stdscr.addstr(i+1, 7, filename, curses.A_BOLD)
+        else:
+            stdscr.addstr(i + 1, 5, "  " + filename)
+    stdscr.refresh()
+
+class FakeWindow:
+    """A curses window that paints nowhere, it counts the characters 
+    written."""
+    def __init__(self, n_of_lines=50, n_of_cols=132):
+        curses.LINES = n_of_lines
+        curses.COLS = n_of_cols
+        for name in ("ACS_DIAMOND", "ACS_HLINE", "ACS_VLINE"):
+            if not hasattr(curses, name):
+                setattr(curses, name, ord("*"))
+        self.n_of_refreshes = 0
+        self.n_of_chars = 0
+    def border(self, *args):
+        self.n_of_chars = self.n_of_chars + 2*(curses.LINES + curses.COLS)
+    def addstr(self, y, x, text, *args):
+        self.n_of_chars = self.n_of_chars + len(text)
+    def addch(self, *args):
+        self.n_of_chars = self.n_of_chars + 1
+    def hline(self, y, x, ch, n):
+        self.n_of_chars = self.n_of_chars + n
+    def scroll(self, n_of_lines):
+        pass
+    def erase(self):
+        pass
+    def clearok(self, *args):
+        pass
+    def idlok(self, *args):
+        pass
+    def scrollok(self, *args):
+        pass
+    def setscrreg(self, *args):
+        pass
+    def refresh(self):
+        self.n_of_refreshes = self.n_of_refreshes + 1
+
+def make_tree(base_path, depth, width, n_of_files):
+    """Builds a synthetic music library in base_path: each directory has
+    n_of_files empty files (audio files and some covers) and, down to
+    depth levels, width subdirectories.
+
+    Returns: the number of audio files created.
+    """
+    exts = ["mp3", "ogg", "flac", "wav", "jpg"]
+    count = 0
+    for i in range(n_of_files):
+        ext = exts[i % len(exts)]
+        open(os.path.join(base_path, "%02d - track %d.%s" % (i, i, ext)), "wb").close()
+        if ext != "jpg":
+            count = count + 1
+    if depth > 0:
+        for i in range(width):
+            subdir = os.path.join(base_path, "dir %d" % i)
+            os.mkdir(subdir)
+            count = count + make_tree(subdir, depth - 1, width, n_of_files)
+    return count
+
+def synchsafe(n):
+    """
+    Returns: n as a 4 bytes ID3v2 synchsafe integer (7 bits per byte).
+    """
+    return struct.pack(">4B", (n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f)
+
+def mp3_stub(tags, n_of_frames=40, cover_size=0):
+    """
+    Returns: a small mp3 file, an ID3v2.3 tag with tags (a dictionary with
+    keys artist, album, tracknumber, title) and n_of_frames silent MPEG-1
+    layer III frames, 128kbps, 44.1kHz. If cover_size is given, a picture
+    of cover_size bytes comes before the tags, as many taggers write it.
+    """
+    frames = ""
+    if cover_size:
+        data = "\x00image/jpeg\x00\x03\x00" + "\x00"*cover_size
+        frames = "APIC" + struct.pack(">I", len(data)) + "\x00\x00" + data
+    for frame_id, key in (("TPE1", "artist"), ("TALB", "album"), ("TRCK", "tracknumber"), ("TIT2", "title")):
+        data = "\x00" + tags[key].encode("latin-1")
+        frames = frames + frame_id + struct.pack(">I", len(data)) + "\x00\x00" + data
+    # 144*128000/44100 bytes per frame, header included
+    return "ID3\x03\x00\x00" + synchsafe(len(frames)) + frames + \
+        ("\xff\xfb\x90\x64" + "\x00"*413)*n_of_frames
+
+OGG_CRC_TABLE = []
+
+def ogg_crc(data):
+    """
+    Returns: the checksum of an Ogg page (CRC-32, polynomial 0x04c11db7,
+    not reflected).
+    """
+    if not len(OGG_CRC_TABLE):
+        for i in range(256):
+            r = i << 24
+            for j in range(8):
+                if r & 0x80000000:
+                    r = ((r << 1) ^ 0x04c11db7) & 0xffffffff
+                else:
+                    r = (r << 1) & 0xffffffff
+            OGG_CRC_TABLE.append(r)
+    crc = 0
+    for ch in data:
+        crc = ((crc << 8) & 0xffffffff) ^ OGG_CRC_TABLE[(crc >> 24) ^ ord(ch)]
+    return crc
+
+def ogg_page(packet, header_type, granule, sequence, serial=1):
+    """
+    Returns: an Ogg page holding packet, which must be shorter than 64kB.
+    """
+    lacing = "\xff"*(len(packet) / 255) + chr(len(packet) % 255)
+    page = "OggS\x00" + chr(header_type) + struct.pack("<qII", granule, serial, sequence) + "\x00"*4 + \
+        chr(len(lacing)) + lacing + packet
+    return page[:22] + struct.pack("<I", ogg_crc(page)) + page[26:]
+
+def vorbis_comments(tags):
+    """
+    Returns: tags (see mp3_stub(...)) as a Vorbis comment block, without
+    the framing bit.
+    """
+    vendor = "kolmogorov_bench"
+    block = struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(tags))
+    for key in ("artist", "album", "tracknumber", "title"):
+        comment = key.upper() + "=" + tags[key].encode("utf-8")
+        block = block + struct.pack("<I", len(comment)) + comment
+    return block
+
+def ogg_stub(tags, n_of_samples=44100):
+    """
+    Returns: a small Ogg Vorbis file with tags (see mp3_stub(...)): the 
+    identification and comment headers, and an audio page ending after 
+    n_of_samples samples at 44.1kHz. The audio isn't decodable.
+    """
+    identification = "\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+    comment = "\x03vorbis" + vorbis_comments(tags) + "\x01"
+    return ogg_page(identification, 0x02, 0, 0) + ogg_page(comment, 0x00, 0, 1) + \
+        ogg_page("\x00"*4000, 0x04, n_of_samples, 2)
+
+def flac_stub(tags, n_of_samples=44100):
+    """
+    Returns: a small FLAC file with tags (see mp3_stub(...)): the 
+    STREAMINFO and VORBIS_COMMENT metadata blocks, for n_of_samples 
+    samples of 16 bits stereo at 44.1kHz, and no audio frames.
+    """
+    # sample rate (20 bits), channels - 1 (3), bits per sample - 1 (5), samples (36)
+    streaminfo = struct.pack(">HH", 4096, 4096) + "\x00"*6 + \
+        struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36) | n_of_samples) + "\x00"*16
+    comments = vorbis_comments(tags)
+    return "fLaC" + struct.pack(">I", len(streaminfo)) + streaminfo + \
+        chr(0x84) + struct.pack(">I", len(comments))[1:] + comments
+
+def wav_stub(tags, n_of_samples=4410):
+    """
+    Returns: a small wav file, n_of_samples samples of 16 bits stereo 
+    silence at 44.1kHz. wav files have no tags.
+    """
+    data = "\x00"*(4*n_of_samples)
+    return "RIFF" + struct.pack("<I", 36 + len(data)) + "WAVEfmt " + \
+        struct.pack("<IHHIIHH", 16, 1, 2, 44100, 4*44100, 4, 16) + "data" + struct.pack("<I", len(data)) + data
+
+# The stub builders of make_library(...), by extension
+STUB_BUILDERS = {"mp3":mp3_stub, "ogg":ogg_stub, "flac":flac_stub, "wav":wav_stub}
+
+def make_library(base_path, depth, width, n_of_files, exts=("mp3", "ogg", "flac", "wav"), rel_path=""):
+    """Builds a synthetic music library in base_path: each directory is an
+    album of n_of_files small tagged audio files (see mp3_stub(...)) and, 
+    down to depth levels, has width subdirectories. The formats go round
+    exts. A deep library has a big depth, a wide one a big width.
+    
+    The library only depends on the arguments, the tags are made up from 
+    the positions of the files.
+
+    Returns: a dictionary, the keys are the absolute paths of the files 
+    created, the values their tags (see mp3_stub(...)).
+    """
+    library = {}
+    directory = os.path.join(base_path, rel_path)
+    artist = u"Artist " + (rel_path.split(os.sep)[0] or u"root")
+    for i in range(n_of_files):
+        ext = exts[i % len(exts)]
+        tags = {"artist":artist, "album":u"Album " + (rel_path or u"root"), \
+            "tracknumber":u"%d/%d" % (i + 1, n_of_files), "title":u"Song %d" % i}
+        filename = os.path.join(directory, "%02d - song %d.%s" % (i + 1, i, ext))
+        fp = open(filename, "wb")
+        fp.write(STUB_BUILDERS[ext](tags))
+        fp.close()
+        library[filename] = tags
+    if depth > 0:
+        for i in range(width):
+            subdir = os.path.join(rel_path, "%d" % i)
+            os.mkdir(os.path.join(base_path, subdir))
+            library.update(make_library(base_path, depth - 1, width, n_of_files, exts, subdir))
+    return library
+
+# The results of the benchmarks run, see report(...)
+RESULTS = []
+
+def report(benchmark, label, value, unit, **extra):
+    """Prints a result of benchmark and keeps it in RESULTS for the JSON 
+    output (see write_results(...)). value is the measure, in unit; extra
+    are other measures printed and kept along with it.
+
+    Returns: None
+    """
+    result = {"benchmark":benchmark, "label":label, "value":value, "unit":unit}
+    result.update(extra)
+    RESULTS.append(result)
+    if isinstance(value, float):
+        text = "%-46s %12.4f %s" % (label, value, unit)
+    else:
+        text = "%-46s %12d %s" % (label, value, unit)
+    for key in sorted(extra.keys()):
+        text = text + "  %s %s" % (key, extra[key])
+    print text
+
+def write_results(filename, options):
+    """Writes RESULTS to filename as JSON, along with the options of the 
+    run and where it was run.
+
+    Returns: None
+    """
+    fp = open(filename, "w")
+    json.dump({"kolmogorov":kolmogorov.VERSION, "python":platform.python_version(), \
+        "platform":platform.platform(), "date":time.strftime("%Y-%m-%d %H:%M:%S"), "options":options, \
+        "results":RESULTS}, fp, indent=1, sort_keys=True)
+    fp.write("\n")
+    fp.close()
+
+def compare_results(filename):
+    """Compares RESULTS with the results of a previous run, written to 
+    filename by write_results(...). Only the results with the same 
+    benchmark, label and unit are compared: the runs should have the same
+    options.
+
+    Returns: None
+    """
+    fp = open(filename, "r")
+    previous = json.load(fp)
+    fp.close()
+    old_values = dict([((result["benchmark"], result["label"], result["unit"]), result["value"]) \
+        for result in previous["results"]])
+    print "compared with %s (kolmogorov %s, %s):" % (filename, previous["kolmogorov"], previous["date"])
+    for result in RESULTS:
+        key = (result["benchmark"], result["label"], result["unit"])
+        if old_values.has_key(key) and old_values[key]:
+            print "%-46s %12.4f -> %12.4f %-14s %6.2fx" % (result["label"], old_values[key], \
+                result["value"], result["unit"], float(result["value"]) / old_values[key])
+
+def best_time(function, args, n_of_runs):
+    """Runs function(*args) n_of_runs times.
+
+    Returns: (best time in seconds, the last result)
+    """
+    best = None
+    for i in range(n_of_runs):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def bench_scan(depth, width, n_of_files, n_of_workers, n_of_runs):
+    """Times legacy_read_file_list(...) against read_file_list(...), with
+    one and with n_of_workers workers, on a synthetic tree.
+
+    Returns: None
+    """
+    supported_dict = {"mp3":[["mpg123", "-q"]], "ogg":[["ogg123", "-q"]], \
+        "flac":[["flac123", "-q"]], "wav":[["mplayer"]]}
+    base_path = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    try:
+        n_of_audio_files = make_tree(base_path, depth, width, n_of_files)
+        print "synthetic tree: depth %d, width %d, %d files per dir, %d audio files" % \
+            (depth, width, n_of_files, n_of_audio_files)
+        print "scandir support: " + str(kolmogorov.SCANDIR_SUPPORT)
+        reference = None
+        for label, function, args in ( \
+                ("legacy os.walk", legacy_read_file_list, (base_path, supported_dict, True)), \
+                ("read_file_list, 1 worker", read_file_list, \
+                    (base_path, supported_dict, True, 1)), \
+                ("read_file_list, %d workers" % n_of_workers, read_file_list, \
+                    (base_path, supported_dict, True, n_of_workers))):
+            elapsed, file_list = best_time(function, args, n_of_runs)
+            if reference is None:
+                reference = elapsed
+            report("scan", label, elapsed, "s", speedup=round(reference / max(elapsed, 1e-9), 2), \
+                files=len(file_list))
+    finally:
+        shutil.rmtree(base_path)
+
+def bench_library(depth, width, n_of_files, n_of_workers, n_of_runs, n_of_lines):
+    """Builds a synthetic library of tagged files (see make_library(...)),
+    then times on it: read_file_list(...), write_m3u(...) and load_m3u(...),
+    build_label_from_tag(...) over a screen of files and over all of them,
+    sort_playlist(...) by name and by tags, paint_screen(...) while the 
+    cursor moves down the whole playlist.
+    The tags are read with mutagen, if it's there. Otherwise the tags 
+    written by make_library(...) are used where possible and the rest is 
+    skipped.
+
+    Returns: None
+    """
+    supported_dict = {"mp3":[["mpg123", "-q"]], "ogg":[["ogg123", "-q"]], \
+        "flac":[["flac123", "-q"]], "wav":[["mplayer"]]}
+    base_path = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    try:
+        start = time.time()
+        library = make_library(base_path, depth, width, n_of_files)
+        report("library", "make_library, %d files" % len(library), time.time() - start, "s", \
+            depth=depth, width=width, files=n_of_files)
+        print "tag support (through mutagen): " + str(kolmogorov.TAG_SUPPORT)
+        
+        for label, workers in (("read_file_list, 1 worker", 1), \
+                ("read_file_list, %d workers" % n_of_workers, n_of_workers)):
+            elapsed, file_list = best_time(read_file_list, (base_path, supported_dict, True, \
+                workers), n_of_runs)
+            report("library", label, elapsed, "s", files=len(file_list))
+        
+        tag_cache = kolmogorov.load_tag_cache(os.devnull)
+        for filename, tags in library.iteritems():
+            st = os.stat(filename)
+            kolmogorov.store_tag_info(tag_cache, filename, st.st_mtime, st.st_size, {"artist":tags["artist"], \
+                "album":tags["album"], "tracknumber":tags["tracknumber"], "title":tags["title"], \
+                "mime":None, "bitrate":None, "length":1.0})
+        m3u_filename = os.path.join(base_path, "playlist.m3u")
+        report("library", "write_m3u", best_time(kolmogorov.write_m3u, (file_list, base_path, m3u_filename, \
+            tag_cache), n_of_runs)[0], "s")
+        elapsed, loaded = best_time(kolmogorov.load_m3u, (m3u_filename, ), n_of_runs)
+        report("library", "load_m3u", elapsed, "s", files=len(loaded[0]), extinf=len(loaded[2]))
+        
+        sorted_list = kolmogorov.sort_playlist(file_list[:], [None]*len(file_list), 0)[0]
+        report("library", "sort_playlist", best_time(lambda: kolmogorov.sort_playlist(file_list[:], \
+            [None]*len(file_list), 0), (), n_of_runs)[0], "s")
+        report("library", "sort_playlist by cached tags", best_time(lambda: kolmogorov.sort_playlist( \
+            file_list[:], [None]*len(file_list), 0, tag_sort_keys(file_list, base_path, \
+            tag_cache)), (), n_of_runs)[0], "s")
+        infos = [tag_cache["entries"][os.path.join(base_path, name)][3] for name in sorted_list]
+        n_of_viewed = min(n_of_lines - 2, len(sorted_list))
+        report("library", "format_tag_label, %d files" % n_of_viewed, best_time(lambda: \
+            [kolmogorov.format_tag_label(sorted_list[i], infos[i], 124) for i in range(n_of_viewed)], (), \
+            n_of_runs)[0], "s")
+        if kolmogorov.TAG_SUPPORT:
+            report("library", "sort_playlist by tags", best_time(lambda: kolmogorov.sort_playlist( \
+                file_list[:], [None]*len(file_list), 0, tag_sort_keys(file_list, base_path)), \
+                (), n_of_runs)[0], "s")
+            for label, names in (("build_label_from_tag, %d files" % n_of_viewed, sorted_list[:n_of_viewed]), \
+                    ("build_label_from_tag, %d files" % len(sorted_list), sorted_list)):
+                report("library", label, best_time(lambda: [build_label_from_tag( \
+                    os.path.join(base_path, name), 132) for name in names], (), n_of_runs)[0], "s")
+        
+        stdscr = FakeWindow(n_of_lines)
+        screen = kolmogorov.new_screen()
+        queue = kolmogorov.new_play_queue(range(0, len(sorted_list), 7))
+        line_index, text_index = 0, 0
+        start = time.time()
+        for i in range(len(sorted_list)):
+            kolmogorov.paint_screen(stdscr, sorted_list, line_index, text_index, 0, queue, base_path, True, \
+                None, None, screen)
+            if line_index < curses.LINES - 3:
+                line_index = line_index + 1
+            else:
+                text_index = text_index + 1
+        elapsed = time.time() - start
+        report("library", "paint_screen", 1000*elapsed / max(len(sorted_list), 1), "ms per paint", \
+            chars=stdscr.n_of_chars / max(len(sorted_list), 1))
+    finally:
+        shutil.rmtree(base_path)
+
+def read_bytes():
+    """
+    Returns: the bytes read so far by this process through read(2) and
+    alike, from /proc/self/io (Linux only), 0 if it can't be read.
+    """
+    try:
+        fp = open("/proc/self/io", "r")
+    except IOError:
+        return 0
+    try:
+        for line in fp:
+            if line.startswith("rchar:"):
+                return int(line.split()[1])
+    finally:
+        fp.close()
+    return 0
+
+def bench_tags(depth, width, n_of_files, n_of_runs, cover_size=262144):
+    """Reads the tags of a synthetic library (see make_library(...)) with
+    read_tag_info(...), which reads the headers with read_tag_header(...),
+    and with legacy_read_tag_info(...) (mutagen), if mutagen is there.
+    Then does the same after adding a picture of cover_size bytes to the
+    tags of the mp3 files. Reports tags per second, the bytes read per 
+    file and the files read_tag_header(...) leaves to mutagen. The results
+    of the two readers are checked against each other.
+
+    Returns: None
+    """
+    base_path = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    try:
+        library = make_library(base_path, depth, width, n_of_files)
+        filenames = sorted(library)
+        readers = [("read_tag_info", None)]
+        if kolmogorov.TAG_SUPPORT:
+            # imported now, not to count its modules in the bytes read
+            import mutagen, mutagen.mp3, mutagen.easyid3
+            readers.append(("legacy_read_tag_info (mutagen)", legacy_read_tag_info))
+        else:
+            print "mutagen not found: files left to mutagen are skipped"
+        for case in ("", ", %d bytes cover" % cover_size):
+            if case:
+                for filename in filenames:
+                    if filename.endswith(".mp3"):
+                        fp = open(filename, "wb")
+                        fp.write(mp3_stub(library[filename], cover_size=cover_size))
+                        fp.close()
+            reader = kolmogorov.new_tag_reader()
+            n_of_fallbacks = len([filename for filename in filenames \
+                if kolmogorov.read_tag_header(filename, reader) is None])
+            report("tags", "files left to mutagen" + case, n_of_fallbacks, "files", files=len(filenames))
+            results = {}
+            for label, function in readers:
+                if function is None:
+                    reader = kolmogorov.new_tag_reader()
+                    if kolmogorov.TAG_SUPPORT:
+                        function = lambda filename: kolmogorov.read_tag_info(filename, reader)
+                    else:
+                        function = lambda filename: kolmogorov.read_tag_header(filename, reader)
+                start_bytes = read_bytes()
+                elapsed, results[label] = best_time(lambda: [function(filename) for filename in filenames], \
+                    (), n_of_runs)
+                n_of_bytes = (read_bytes() - start_bytes) / max(n_of_runs*len(filenames), 1)
+                report("tags", label + case, len(filenames) / max(elapsed, 1e-9), "tags/s", \
+                    bytes_per_file=n_of_bytes)
+            if len(results) == 2:
+                mismatches = [filename for filename, fast, legacy in zip(filenames, *results.values()) \
+                    if fast != legacy]
+                report("tags", "results different from mutagen" + case, len(mismatches), "files")
+    finally:
+        shutil.rmtree(base_path)
+
+def bench_play(n_of_songs, song_length=0.5, idle_time=2.0):
+    """Plays n_of_songs fake songs (a shell sleeping song_length seconds)
+    in continuous mode, with legacy_play_thread(...) and play_thread(...),
+    with and without the next player started in advance.
+    Measures the time between the end of a song and the start of the next
+    one, then the voluntary context switches of the threads it started (see
+    thread_switches(...)) while it's idle for idle_time seconds.
+
+    Returns: None
+    """
+    prewarm_time = kolmogorov.PREWARM_TIME
+    for label, play_function, prewarm in (("play_thread", kolmogorov.play_thread, False), \
+            ("play_thread, prewarm", kolmogorov.play_thread, True), \
+            ("legacy polling play_thread", legacy_play_thread, False)):
+        # each fake player writes the time it starts
+        log_fd, log_filename = tempfile.mkstemp(prefix="kolmogorov_bench")
+        os.close(log_fd)
+        file_list = ["song %d.mp3" % i for i in range(n_of_songs)]
+        support_dict = {"mp3":[["sh", "-c", "date +%s.%N >> \"$0\"; sleep " + str(song_length), \
+            log_filename]]}
+        tag_cache = None
+        if prewarm:
+            tag_cache = kolmogorov.load_tag_cache(os.devnull)
+            kolmogorov.seed_tag_cache(tag_cache, dict([(os.path.join("/", af), {"length":song_length}) \
+                for af in file_list]))
+            kolmogorov.PREWARM_TIME = song_length / 2
+        display_status_dict = {"current_cursor_line":0, "current_text_line":0, "abs_hilighted_line":0, \
+            "stdscr":FakeWindow(), "tag_mode":False, "file_list":file_list, \
+            "tag_list":[None]*n_of_songs, "base_path":"/", "tag_cache":tag_cache, "scanning":False, \
+            "rescanning":False, "dir_state":None, "message":None, \
+            "screen":kolmogorov.new_screen(), "view":None, "search":None, "stats_overlay":False, \
+            "tag_sort":None, "wake_pipe":kolmogorov.new_wake_pipe(), "repaint":False}
+        play_engine = kolmogorov.new_play_engine(file_list, tag_cache)
+        deadline = time.time() + n_of_songs*(song_length + 2)
+        if play_function is legacy_play_thread:
+            display_status_lock = thread.allocate_lock()
+            # the keys of kolmogorov 0.051beta, and the state shown by
+            # paint_display(...)
+            play_status_dict = {"queue_file":[os.path.join("/", file_list[0])], "queue_index":[], \
+                "todo":"start_song", "pp_pid":None, "continue":True, "state":play_engine["state"]}
+            play_status_lock = thread.allocate_lock()
+            thread.start_new_thread(play_function, (play_status_dict, play_status_lock, \
+                display_status_dict, display_status_lock, "/", support_dict))
+            while display_status_dict["abs_hilighted_line"] is not None and time.time() < deadline:
+                time.sleep(0.01)
+        else:
+            thread.start_new_thread(play_function, (play_engine, "/", support_dict))
+            kolmogorov.send_play_command(play_engine, ("play", 0))
+            while play_engine["state"]["playing"] is None and time.time() < deadline:
+                time.sleep(0.01)
+            while play_engine["state"]["playing"] is not None and time.time() < deadline:
+                time.sleep(0.01)
+        kolmogorov.PREWARM_TIME = prewarm_time
+        
+        n_of_switches = thread_switches()
+        time.sleep(idle_time)
+        n_of_switches = thread_switches() - n_of_switches
+        
+        starts = [float(line) for line in open(log_filename)]
+        os.remove(log_filename)
+        latencies = [starts[i + 1] - starts[i] - song_length for i in range(len(starts) - 1)]
+        if len(latencies):
+            report("play", label + ", transition latency", sum(latencies) / len(latencies), "s", \
+                max=round(max(latencies), 4), songs=len(starts))
+        else:
+            print "%-46s no song played" % label
+        report("play", label + ", idle wakeups", n_of_switches / idle_time, "per s")
+        if play_function is not legacy_play_thread:
+            kolmogorov.send_play_command(play_engine, "quit")
+            play_engine["stopped"].wait()
+
+def bench_paint(n_of_lines, n_of_queued, n_of_moves=2000):
+    """Moves the cursor down n_of_moves lines of a playlist, as holding 
+    the down arrow does, and paints the screen after each move with 
+    legacy_paint_screen(...) and paint_screen(...). n_of_queued songs are
+    in the queue.
+    Measures the time of a paint and the characters written to the 
+    curses window.
+
+    Returns: None
+    """
+    file_list = ["artist %d/album %d/%02d - song %d.mp3" % (i/100, i/10, i%10, i) \
+        for i in range(2*n_of_moves)]
+    queue = range(0, 2*n_of_moves, max(2*n_of_moves / max(n_of_queued, 1), 1))[:n_of_queued]
+    for label, function in (("legacy paint_screen", legacy_paint_screen), \
+            ("paint_screen", kolmogorov.paint_screen)):
+        stdscr = FakeWindow(n_of_lines)
+        screen = kolmogorov.new_screen()
+        play_queue = kolmogorov.new_play_queue(queue)
+        line_index, text_index = 0, 0
+        start = time.time()
+        for i in range(n_of_moves):
+            if line_index < curses.LINES - 3:
+                line_index = line_index + 1
+            else:
+                text_index = text_index + 1
+            if function is legacy_paint_screen:
+                function(stdscr, file_list, line_index, text_index, 0, queue, "/music", True)
+            else:
+                function(stdscr, file_list, line_index, text_index, 0, play_queue, \
+                    "/music", True, None, None, screen)
+        elapsed = time.time() - start
+        report("paint", label, 1000*elapsed / n_of_moves, "ms per paint", chars=stdscr.n_of_chars / n_of_moves)
+
+def bench_sort(n_of_entries, n_of_runs, n_of_legacy_entries=20000):
+    """Sorts a shuffled playlist of n_of_entries files by name with 
+    sort_playlist(...), and by tags with tag_sort_key(...) keys. 
+    legacy_sort_playlist(...) is quadratic, it sorts only 
+    n_of_legacy_entries files.
+
+    Returns: None
+    """
+    import random
+    random.seed(0)
+    file_list = ["Artist %d/Album %d/%02d - Song %d.mp3" % (i/200, i/12, i%12, i) for i in range(n_of_entries)]
+    random.shuffle(file_list)
+    playlist = kolmogorov.Playlist(file_list)
+    tag_list = [None]*n_of_entries
+    infos = [{"artist":u"Artist %d" % (i%500), "album":u"Album %d" % (i%50), "tracknumber":u"%d/12" % (i%12), \
+        "title":u"Song %d" % i} for i in range(n_of_entries)]
+    n_of_legacy_entries = min(n_of_legacy_entries, n_of_entries)
+    for label, function, args in ( \
+            ("legacy sort_playlist, %d" % n_of_legacy_entries, legacy_sort_playlist, \
+                lambda: (file_list[:n_of_legacy_entries], tag_list[:n_of_legacy_entries], 0)), \
+            ("sort_playlist, %d" % n_of_entries, kolmogorov.sort_playlist, \
+                lambda: (file_list[:], tag_list, 0)), \
+            ("sort_playlist of a Playlist, %d" % n_of_entries, kolmogorov.sort_playlist, \
+                lambda: (playlist, tag_list, 0, [name.lower() for name in file_list])), \
+            ("sort_playlist by tags, %d" % n_of_entries, kolmogorov.sort_playlist, \
+                lambda: (file_list[:], tag_list, 0, [kolmogorov.tag_sort_key(file_list[i], infos[i]) \
+                for i in range(n_of_entries)]))):
+        report("sort", label, best_time(lambda: function(*args()), (), n_of_runs)[0], "s")
+
+def bench_startup(n_of_runs):
+    """Times the player discovery: legacy_check_players(...), which runs
+    'which', against check_players(...). Then times the import of 
+    kolmogorov in a new interpreter.
+
+    Returns: None
+    """
+    for label, function in (("legacy check_players", legacy_check_players), \
+            ("check_players", kolmogorov.check_players)):
+        report("startup", label, 1000*best_time(function, (kolmogorov.KNOWN_PLAYERS, \
+            kolmogorov.KNOWN_EXTENSIONS), n_of_runs)[0], "ms")
+    
+    package_dir = os.path.dirname(os.path.abspath(kolmogorov.__file__))
+    timings = []
+    for statement in ("pass", "import sys; sys.path.insert(0, %r); import kolmogorov" % package_dir):
+        timings.append(best_time(lambda: subprocess.call((sys.executable, "-c", statement)), (), \
+            n_of_runs)[0])
+    report("startup", "import kolmogorov", 1000*(timings[1] - timings[0]), "ms")
+
+def bench_session(n_of_entries, n_of_runs, n_of_records=500):
+    """Saves a session of n_of_entries files as the m3u playlist written 
+    on quit (see write_m3u(...)) and as a session snapshot with a journal
+    of n_of_records records (see write_session(...)), then times resuming
+    it from each: load_m3u(...) and the Playlist built by main(...), 
+    against load_session(...). Also times an append to the journal.
+
+    Returns: None
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    m3u_filename = os.path.join(tmp_dir, "playlist.m3u")
+    session_filename = os.path.join(tmp_dir, "session")
+    journal_filename = os.path.join(tmp_dir, "session.journal")
+    try:
+        file_list = kolmogorov.Playlist("Artist %d/Album %d/%02d - Song %d.mp3" % (i/200, i/12, i%12, i) \
+            for i in xrange(n_of_entries))
+        session = kolmogorov.new_session("/music", file_list)
+        session["queue"] = range(0, n_of_entries, max(n_of_entries / 1000, 1))
+        report("session", "write m3u", best_time(kolmogorov.write_m3u, (file_list, "/music", \
+            m3u_filename), n_of_runs)[0], "s", entries=n_of_entries)
+        elapsed, journal = best_time(kolmogorov.write_session, (session, session_filename, \
+            journal_filename), n_of_runs)
+        report("session", "write session snapshot", elapsed, "s", entries=n_of_entries)
+        start = time.time()
+        for i in range(n_of_records):
+            kolmogorov.append_session_journal(journal, [("cursor", (i, 0))])
+        report("session", "journal append", (time.time() - start) / n_of_records, "s")
+        journal.close()
+        
+        def resume_m3u():
+            m3u_list, base_path, tag_info = kolmogorov.load_m3u(m3u_filename)
+            return kolmogorov.Playlist(m3u_list)
+        elapsed, resumed = best_time(resume_m3u, (), n_of_runs)
+        report("session", "resume from m3u", elapsed, "s", entries=len(resumed))
+        elapsed, resumed = best_time(kolmogorov.load_session, (session_filename, journal_filename), n_of_runs)
+        report("session", "resume from session", elapsed, "s", entries=len(resumed["file_list"]), \
+            queued=len(resumed["queue"]), cursor=resumed["cursor"][0])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def bench_tag_cache(n_of_runs, n_of_entries=kolmogorov.TAG_CACHE_MAX_ENTRIES, n_of_stored=100):
+    """Saves a tag cache of n_of_entries synthetic entries, then times 
+    loading it (see load_tag_cache(...)): blocking, as main(...) did, and in
+    the background, until main(...) can go on and until it's loaded. Then
+    times saving it after n_of_stored entries were stored: the whole cache
+    (see save_tag_cache(...)), as it was saved every 
+    TAG_CACHE_SAVE_INTERVAL seconds, against the journal (see 
+    append_tag_cache(...)).
+
+    Returns: None
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    filename = os.path.join(tmp_dir, "tag_cache")
+    try:
+        tag_cache = kolmogorov.load_tag_cache(filename)
+        for i in xrange(n_of_entries):
+            kolmogorov.store_tag_info(tag_cache, "/music/Artist %d/Album %d/%02d - Song %d.mp3" % \
+                (i/200, i/12, i%12, i), 1200000000.0 + i, 4000000 + i, {"artist":u"Artist %d" % (i/200), \
+                "album":u"Album %d" % (i/12), "tracknumber":u"%d" % (i%12 + 1), "title":u"Song %d" % i, \
+                "length":180.0 + i%120})
+        kolmogorov.save_tag_cache(tag_cache)
+        report("tagcache", "tag cache file", os.path.getsize(filename) / 1048576.0, "MB", entries=n_of_entries)
+        
+        report("tagcache", "load, blocking", best_time(kolmogorov.load_tag_cache, (filename, ), \
+            n_of_runs)[0], "s")
+        def load_background():
+            start = time.time()
+            loading = kolmogorov.load_tag_cache(filename, True)
+            returned = time.time() - start
+            loading["loaded"].wait()
+            return returned, time.time() - start
+        timings = [load_background() for i in range(n_of_runs)]
+        report("tagcache", "load in the background, returned", min([t[0] for t in timings]), "s")
+        report("tagcache", "load in the background, loaded", min([t[1] for t in timings]), "s")
+        
+        def store():
+            for i in xrange(n_of_stored):
+                kolmogorov.store_tag_info(tag_cache, "/music/new/%d.mp3" % i, time.time(), i, {})
+        def save_whole():
+            store()
+            kolmogorov.save_tag_cache(tag_cache)
+        def save_journal():
+            store()
+            kolmogorov.append_tag_cache(tag_cache)
+        report("tagcache", "save whole", best_time(save_whole, (), n_of_runs)[0], "s", stored=n_of_stored)
+        report("tagcache", "save by the journal", best_time(save_journal, (), n_of_runs)[0], "s", \
+            stored=n_of_stored)
+        loaded = kolmogorov.load_tag_cache(filename)
+        report("tagcache", "reloaded", len(loaded["entries"]), "entries", \
+            journal=loaded["n_of_records"])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def bench_query(n_of_tracks, n_of_runs):
+    """Fills a library database with n_of_tracks synthetic tracks, by 10 
+    artists, as update_library(...) stores them, then times opening the 
+    playlist of an artist (a tenth of the tracks) with query_library(...),
+    and the Playlist built from it by main(...).
+
+    Returns: None
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    try:
+        library = kolmogorov.open_library(os.path.join(tmp_dir, "library.db"))
+        rows = [kolmogorov.library_row("/music/Artist %d/Album %d/%02d - Song %d.mp3" % (i%10, i/12, i%12, i), \
+            "/music", 1.0, 1000, {"artist":u"Artist %d" % (i%10), "album":u"Album %d" % (i/12), \
+            "tracknumber":u"%d/12" % (i%12 + 1), "title":u"Song %d" % i, "date":u"%d" % (1960 + i%50), \
+            "mime":"audio/mp3", "bitrate":128000, "length":200.0}) for i in xrange(n_of_tracks)]
+        start = time.time()
+        library.executemany("insert or replace into tracks values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+            rows)
+        library.commit()
+        report("query", "insert", time.time() - start, "s", tracks=n_of_tracks)
+        
+        for query in ("artist = Artist 3 order by album, track", "artist = Artist 3", "year = 1975"):
+            elapsed, result = best_time(kolmogorov.query_library, (library, query), n_of_runs)
+            report("query", query, elapsed, "s", files=len(result[0]))
+        report("query", "Playlist of the result", best_time(kolmogorov.Playlist, (result[0], ), \
+            n_of_runs)[0], "s")
+        library.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+# The advice of posix_fadvise(...) to drop a file from the page cache 
+# (Linux value)
+POSIX_FADV_DONTNEED = 4
+
+def bench_read_ahead(n_of_runs, n_of_songs=4, size=8*1024*1024, delay=0.5):
+    """Writes n_of_songs files of size bytes, then times reading them as a
+    player does, after dropping them from the page cache: cold, and read 
+    ahead with read_file_ahead(...), through posix_fadvise(...) and by 
+    reading them, delay seconds before (the end of the playing song).
+    The disk of the temporary directory must not be a RAM disk.
+
+    Returns: None
+    """
+    fadvise = kolmogorov.posix_fadvise_function()
+    if fadvise is None:
+        print "posix_fadvise not found: the page cache can't be dropped"
+        return
+    tmp_dir = tempfile.mkdtemp(prefix="kolmogorov_bench")
+    filenames = [os.path.join(tmp_dir, "%02d - Song %d.mp3" % (i, i)) for i in range(n_of_songs)]
+    
+    def drop_caches():
+        for filename in filenames:
+            fd = os.open(filename, os.O_RDONLY)
+            try:
+                fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+    
+    def play(filename):
+        fp = open(filename, "rb")
+        try:
+            while len(fp.read(65536)):
+                pass
+        finally:
+            fp.close()
+    
+    try:
+        for filename in filenames:
+            fp = open(filename, "wb")
+            fp.write(os.urandom(size))
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.close()
+        for label, read_ahead in (("cold", None), ("read ahead, posix_fadvise", fadvise), \
+                ("read ahead, reading", False)):
+            best = None
+            for i in range(n_of_runs):
+                drop_caches()
+                elapsed = 0.0
+                for filename in filenames:
+                    if read_ahead is not None:
+                        kolmogorov.read_file_ahead(filename, size, read_ahead or None)
+                        time.sleep(delay)
+                    start = time.time()
+                    play(filename)
+                    elapsed = elapsed + time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            report("readahead", label, 1000*best / n_of_songs, "ms per song", size=size)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def resident_memory():
+    """
+    Returns: the resident memory of this process in kB, from 
+    /proc/self/status (Linux only).
+    """
+    fp = open("/proc/self/status", "r")
+    try:
+        for line in fp:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    finally:
+        fp.close()
+    return 0
+
+def thread_switches():
+    """
+    Returns: the voluntary context switches of the threads of this process 
+    but the main one, from /proc/self/task (Linux only): the wakeups of the
+    threads started by the main one, while it sleeps.
+    """
+    n_of_switches = 0
+    for tid in os.listdir("/proc/self/task"):
+        if int(tid) == os.getpid():
+            continue
+        try:
+            fp = open(os.path.join("/proc/self/task", tid, "status"), "r")
+        except IOError:
+            # the thread exited
+            continue
+        try:
+            for line in fp:
+                if line.startswith("voluntary_ctxt_switches:"):
+                    n_of_switches = n_of_switches + int(line.split()[1])
+        finally:
+            fp.close()
+    return n_of_switches
+
+def bench_memory(n_of_tracks):
+    """Builds a playlist of n_of_tracks files as a list of paths and as a 
+    kolmogorov.Playlist, each one in a child process, and compares the 
+    memory they use.
+
+    Returns: None
+    """
+    results = {}
+    for label, build in (("list", list), ("Playlist", kolmogorov.Playlist)):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            before = resident_memory()
+            start = time.time()
+            playlist = build("Artist %d/Album %d/%02d - Song %d.mp3" % (i/200, i/12, i%12, i) \
+                for i in xrange(n_of_tracks))
+            elapsed = time.time() - start
+            os.write(write_fd, "%d %f" % (resident_memory() - before, elapsed))
+            os._exit(0)
+        os.close(write_fd)
+        output = os.read(read_fd, 100)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        used, elapsed = output.split()
+        results[label] = int(used)
+        report("memory", "%s, %d" % (label, n_of_tracks), int(used), "kB", seconds=round(float(elapsed), 4))
+    if results["Playlist"] > 0:
+        report("memory", "reduction", float(results["list"])/results["Playlist"], "x")
+
+if __name__ == '__main__':
+    depth = 3
+    width = 6
+    n_of_files = 12
+    n_of_workers = 8
+    n_of_runs = 3
+    n_of_songs = 10
+    n_of_lines = 50
+    n_of_queued = 1000
+    n_of_entries = 100000
+    n_of_tracks = 1000000
+    n_of_session_entries = 500000
+    n_of_indexed = 500000
+    library_path = None
+    output_filename = None
+    compare_filename = None
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:w:f:j:n:s:l:q:e:t:u:k:g:o:c:", ("help", "depth=", \
+            "width=", "files=", "jobs=", "repeat=", "songs=", "lines=", "queue=", "entries=", "tracks=", \
+            "session=", "indexed=", "generate=", "output=", "compare="))
+        for option, a in opts:
+            if option in ("-h", "--help"):
+                usage()
+                sys.exit(9)
+            if option in ("-d", "--depth"):
+                depth = int(a)
+            if option in ("-w", "--width"):
+                width = int(a)
+            if option in ("-f", "--files"):
+                n_of_files = int(a)
+            if option in ("-j", "--jobs"):
+                n_of_workers = int(a)
+            if option in ("-n", "--repeat"):
+                n_of_runs = int(a)
+            if option in ("-s", "--songs"):
+                n_of_songs = int(a)
+            if option in ("-l", "--lines"):
+                n_of_lines = int(a)
+            if option in ("-q", "--queue"):
+                n_of_queued = int(a)
+            if option in ("-e", "--entries"):
+                n_of_entries = int(a)
+            if option in ("-t", "--tracks"):
+                n_of_tracks = int(a)
+            if option in ("-u", "--session"):
+                n_of_session_entries = int(a)
+            if option in ("-k", "--indexed"):
+                n_of_indexed = int(a)
+            if option in ("-g", "--generate"):
+                library_path = a
+            if option in ("-o", "--output"):
+                output_filename = a
+            if option in ("-c", "--compare"):
+                compare_filename = a
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+    for benchmark in args:
+        if benchmark not in BENCHMARKS:
+            usage()
+            sys.exit(2)
+    if not len(args):
+        args = BENCHMARKS
+    
+    if library_path is not None:
+        if not os.path.isdir(library_path):
+            os.makedirs(library_path)
+        print "%d files in %s" % (len(make_library(os.path.abspath(library_path), depth, width, \
+            n_of_files)), library_path)
+        sys.exit(0)
+
+    if "scan" in args:
+        bench_scan(depth, width, n_of_files, n_of_workers, n_of_runs)
+    if "library" in args:
+        bench_library(depth, width, n_of_files, n_of_workers, n_of_runs, n_of_lines)
+    if "tags" in args:
+        bench_tags(depth, width, n_of_files, n_of_runs)
+    if "play" in args:
+        bench_play(n_of_songs)
+    if "paint" in args:
+        bench_paint(n_of_lines, n_of_queued)
+    if "sort" in args:
+        bench_sort(n_of_entries, n_of_runs)
+    if "memory" in args:
+        bench_memory(n_of_tracks)
+    if "startup" in args:
+        bench_startup(n_of_runs)
+    if "session" in args:
+        bench_session(n_of_session_entries, n_of_runs)
+    if "query" in args:
+        bench_query(n_of_indexed, n_of_runs)
+    if "readahead" in args:
+        bench_read_ahead(n_of_runs)
+    if "tagcache" in args:
+        bench_tag_cache(n_of_runs)
+    
+    if output_filename is not None:
+        write_results(output_filename, {"benchmarks":list(args), "depth":depth, "width":width, \
+            "files":n_of_files, "jobs":n_of_workers, "repeat":n_of_runs, "songs":n_of_songs, \
+            "lines":n_of_lines, "queue":n_of_queued, "entries":n_of_entries, "tracks":n_of_tracks, \
+            "session":n_of_session_entries, "indexed":n_of_indexed})
+    if compare_filename is not None:
+        compare_results(compare_filename)
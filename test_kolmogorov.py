@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""Tests for kolmogorov: python test_kolmogorov.py"""
+
+import os, sys, tempfile, shutil, subprocess, unittest, curses, struct, thread, cPickle
+import kolmogorov, kolmogorov_bench
+
+class LibraryTest(unittest.TestCase):
+    """The library with a music root and tags which are not ASCII."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="kolmogorov_test")
+        self.root = os.path.join(self.home, "music", "Bj\xc3\xb6rk")
+        os.makedirs(os.path.join(self.root, "Homog\xc3\xa9nic"))
+        for i in range(3):
+            fp = open(os.path.join(self.root, "Homog\xc3\xa9nic", "%02d - J\xc3\xb3ga %d.mp3" % (i + 1, i)), "wb")
+            fp.write(kolmogorov_bench.mp3_stub({"artist":u"Bj\xf6rk", "album":u"Homog\xe9nic", \
+                "tracknumber":u"%d" % (i + 1), "title":u"J\xf3ga %d" % i}))
+            fp.close()
+        # check_players(...) needs a player in the PATH
+        self.bin = os.path.join(self.home, "bin")
+        os.makedirs(self.bin)
+        fp = open(os.path.join(self.bin, "mpg123"), "w")
+        fp.write("#!/bin/sh\n")
+        fp.close()
+        os.chmod(os.path.join(self.bin, "mpg123"), 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def run_kolmogorov(self, *args):
+        env = dict(os.environ, HOME=self.home, PATH=self.bin + os.pathsep + os.environ.get("PATH", ""))
+        process = subprocess.Popen([sys.executable, kolmogorov.__file__.replace(".pyc", ".py")] + list(args), \
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def test_update_and_query(self):
+        library = kolmogorov.open_library(os.path.join(self.home, "library.db"))
+        kolmogorov.add_library_root(library, self.root)
+        self.assertEqual(kolmogorov.library_roots(library), [self.root])
+        summary = kolmogorov.update_library(library, frozenset(["mp3"]), n_of_processes=1)
+        self.assertEqual(summary, [(self.root, 3, 3, 0)])
+        file_list, base_dir, tag_info = kolmogorov.query_library(library, \
+            "artist = Bj\xc3\xb6rk order by track desc")
+        self.assertEqual(base_dir, os.path.join(self.root, "Homog\xc3\xa9nic"))
+        self.assertEqual(file_list, ["03 - J\xc3\xb3ga 2.mp3", "02 - J\xc3\xb3ga 1.mp3", "01 - J\xc3\xb3ga 0.mp3"])
+        self.assertEqual(tag_info[os.path.join(base_dir, file_list[0])]["album"], u"Homog\xe9nic")
+        self.assertEqual(len(kolmogorov.query_library(library, "path ~ J\xc3\xb3ga 1")[0]), 1)
+        kolmogorov.save_library_query(library, "bj\xc3\xb6rk", "root = " + self.root)
+        self.assertEqual(len(kolmogorov.query_library(library, "bj\xc3\xb6rk")[0]), 3)
+        # a file removed
+        os.remove(os.path.join(base_dir, file_list[0]))
+        summary = kolmogorov.update_library(library, frozenset(["mp3"]), n_of_processes=1)
+        self.assertEqual(summary, [(self.root, 2, 0, 1)])
+        library.close()
+
+    def test_command_line(self):
+        status, output = self.run_kolmogorov("-a", self.root, "-l")
+        self.assertEqual(status, 0, output)
+        self.assertTrue("root: " + self.root in output, output)
+        self.assertTrue("3 files." in output, output)
+        status, output = self.run_kolmogorov("-q", "artist = Sigur R\xc3\xb3s")
+        self.assertEqual(status, 34, output)
+        self.assertTrue("no file in the library matches" in output, output)
+        status, output = self.run_kolmogorov("-q", "artist =")
+        self.assertEqual(status, 2, output)
+        self.assertTrue("Error: bad query" in output, output)
+
+class PlaylistTest(unittest.TestCase):
+    """The compact playlist, which must behave like a list of paths."""
+    paths = ["b/Two.mp3", "a/one.mp3", "Three.mp3", "a/b/\xc3\xa9.mp3", "b/one.mp3"]
+
+    def test_list(self):
+        playlist = kolmogorov.Playlist(self.paths[:3])
+        playlist.append(self.paths[3])
+        playlist.extend(self.paths[4:])
+        self.assertEqual(len(playlist), 5)
+        self.assertEqual(list(playlist), self.paths)
+        self.assertEqual((playlist[0], playlist[-1], playlist[-5]), ("b/Two.mp3", "b/one.mp3", "b/Two.mp3"))
+        self.assertRaises(IndexError, playlist.__getitem__, 5)
+        self.assertEqual(list(playlist[1:4]), self.paths[1:4])
+        self.assertEqual(list(playlist[::-2]), self.paths[::-2])
+        self.assertEqual(list(playlist[7:]), [])
+        # directories are stored once
+        self.assertEqual(playlist.storage["dirs"], ["b/", "a/", "", "a/b/"])
+
+    def test_copies(self):
+        playlist = kolmogorov.Playlist(self.paths)
+        copy = playlist.copy()
+        part = playlist[:2]
+        taken = kolmogorov.take(playlist, [4, 0])
+        playlist.append("c/four.mp3")
+        part.append("c/five.mp3")
+        self.assertEqual(list(copy), self.paths)
+        self.assertEqual(list(part), self.paths[:2] + ["c/five.mp3"])
+        self.assertEqual(list(taken), ["b/one.mp3", "b/Two.mp3"])
+        self.assertEqual(list(playlist), self.paths + ["c/four.mp3"])
+
+    def test_pickle(self):
+        playlist = kolmogorov.Playlist(self.paths)
+        loaded = cPickle.loads(cPickle.dumps(playlist, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(list(loaded), self.paths)
+        loaded.append("a/two.mp3")
+        self.assertEqual(loaded.storage["dirs"], playlist.storage["dirs"])
+        self.assertEqual(loaded[-1], "a/two.mp3")
+
+    def test_sort(self):
+        playlist = kolmogorov.Playlist(self.paths)
+        sorted_list, tag_list, aindex, new_index = kolmogorov.sort_playlist(playlist, range(5), 0)
+        self.assertTrue(isinstance(sorted_list, kolmogorov.Playlist))
+        self.assertEqual(list(sorted_list), ["a/b/\xc3\xa9.mp3", "a/one.mp3", "b/one.mp3", "b/Two.mp3", \
+            "Three.mp3"])
+        self.assertEqual((tag_list, aindex, new_index), ([3, 1, 4, 0, 2], 3, [3, 1, 4, 0, 2]))
+        # equal keys keep their order
+        keys = [kolmogorov.tag_sort_key(af, None)[:4] for af in playlist]
+        self.assertEqual(list(kolmogorov.sort_playlist(playlist, range(5), None, keys)[0]), self.paths)
+
+class RescanTest(unittest.TestCase):
+    """Rescanning the directory of the playlist and merging the changes."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="kolmogorov_test")
+        for af in ("a/1.mp3", "a/2.mp3", "b/1.mp3", "b/c/1.mp3", "b/notes.txt"):
+            self.touch(af)
+        # the changes made by the tests must change the modification times
+        for rel_dir in ("", "a", "b", "b/c"):
+            os.utime(os.path.join(self.home, rel_dir), (1000, 1000))
+        dir_mtimes = {}
+        self.file_list = []
+        for files in kolmogorov.iter_file_list(self.home, frozenset(["mp3"]), True, 1, dir_mtimes):
+            self.file_list.extend(files)
+        self.dir_state = {"base_dir":self.home, "recursive":True, "dirs":dir_mtimes}
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def touch(self, af):
+        path = os.path.join(self.home, af)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "wb").close()
+
+    def rescan(self, dirty=None):
+        added, removed = kolmogorov.rescan_library(self.home, self.file_list, self.dir_state, \
+            frozenset(["mp3"]), 1, dirty)
+        return sorted(added), sorted(removed)
+
+    def test_rescan(self):
+        self.assertEqual(sorted(self.file_list), ["a/1.mp3", "a/2.mp3", "b/1.mp3", "b/c/1.mp3"])
+        self.assertEqual(self.rescan(), ([], []))
+        self.touch("a/3.mp3")
+        self.touch("d/e/1.mp3")
+        shutil.rmtree(os.path.join(self.home, "b", "c"))
+        os.remove(os.path.join(self.home, "a", "1.mp3"))
+        self.assertEqual(self.rescan(), (["a/3.mp3", "d/e/1.mp3"], ["a/1.mp3", "b/c/1.mp3"]))
+        self.assertEqual(sorted(self.dir_state["dirs"].keys()), ["", "a", "b", "d", "d/e"])
+        shutil.rmtree(os.path.join(self.home, "b"))
+        self.file_list = ["a/2.mp3", "a/3.mp3", "b/1.mp3", "d/e/1.mp3"]
+        self.assertEqual(self.rescan(), ([], ["b/1.mp3"]))
+
+    def test_dirty(self):
+        mtime = self.dir_state["dirs"]["a"]
+        self.touch("a/3.mp3")
+        # a change within the resolution of the modification times
+        os.utime(os.path.join(self.home, "a"), (mtime, mtime))
+        self.assertEqual(self.rescan(), ([], []))
+        self.assertEqual(self.rescan(["a", "gone"]), (["a/3.mp3"], []))
+
+    def test_merge(self):
+        play_engine = kolmogorov.new_play_engine([])
+        display_status_dict = {"file_list":["a/1.mp3", "a/2.mp3", "b/1.mp3", "b/2.mp3"], \
+            "tag_list":["a1", "a2", "b1", "b2"], "current_text_line":1, "current_cursor_line":0, \
+            "search":None, "view":None}
+        kolmogorov.merge_rescan(display_status_dict, play_engine, ["c/1.mp3", "a/1.mp3"], \
+            ["a/2.mp3", "b/1.mp3"])
+        # the cursor moves to the next file kept
+        self.assertEqual(display_status_dict["file_list"], ["a/1.mp3", "b/2.mp3", "c/1.mp3"])
+        self.assertEqual(display_status_dict["tag_list"], ["a1", "b2", None])
+        self.assertEqual(display_status_dict["current_text_line"] + \
+            display_status_dict["current_cursor_line"], 1)
+        self.assertEqual(list(play_engine["commands"]), [("playlist", display_status_dict["file_list"], \
+            [0, None, None, 1])])
+        # nothing removed: the playlist is only extended
+        file_list = display_status_dict["file_list"]
+        kolmogorov.merge_rescan(display_status_dict, play_engine, ["d/1.mp3"], [])
+        self.assertTrue(display_status_dict["file_list"] is file_list)
+        self.assertEqual(file_list[-1], "d/1.mp3")
+        self.assertEqual(len(play_engine["commands"]), 1)
+
+class M3uTest(unittest.TestCase):
+    """m3u playlists and their #EXTINF lines."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="kolmogorov_test")
+        self.filename = os.path.join(self.home, "list.m3u")
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def write(self, text):
+        fp = open(self.filename, "wb")
+        fp.write(text)
+        fp.close()
+        return kolmogorov.load_m3u(self.filename)
+
+    def test_parse_extinf(self):
+        info = kolmogorov.parse_extinf("#EXTINF:215,Bj\xc3\xb6rk - Army of Me - Remix")
+        self.assertEqual((info["artist"], info["title"], info["length"], info["album"]), \
+            (u"Bj\xf6rk", u"Army of Me - Remix", 215.0, None))
+        info = kolmogorov.parse_extinf("#EXTINF:-1,Untitled")
+        self.assertEqual((info["artist"], info["title"], info["length"]), (None, u"Untitled", None))
+        info = kolmogorov.parse_extinf("#EXTINF:12 tvg-id=x,\xffA - ")
+        self.assertEqual((info["artist"], info["title"], info["length"]), (None, u"\ufffdA -", 12.0))
+        info = kolmogorov.parse_extinf("#EXTINF:x,")
+        self.assertEqual((info["artist"], info["title"], info["length"]), (None, None, None))
+        self.assertEqual(kolmogorov.parse_extinf("#EXTINF:215"), None)
+
+    def test_relative(self):
+        file_list, base_path, tag_info = self.write("#EXTM3U\r\n\r\n#EXTINF:10,A - One\r\n" + \
+            "a/1.mp3\r\n# a comment\r\na/2.mp3\r\n")
+        self.assertEqual(file_list, ["1.mp3", "2.mp3"])
+        self.assertEqual(base_path, os.path.join(self.home, "a", ""))
+        self.assertEqual(tag_info.keys(), [os.path.join(self.home, "a", "1.mp3")])
+
+    def test_absolute(self):
+        file_list, base_path, tag_info = self.write("/music/ab/1.mp3\n/music/ac/2.mp3\n")
+        # the common prefix ends in the middle of a name
+        self.assertEqual((file_list, base_path), (["ab/1.mp3", "ac/2.mp3"], "/music/"))
+        file_list, base_path, tag_info = self.write("/a/1.mp3\n/b/2.mp3\n")
+        self.assertEqual((file_list, base_path), (["/a/1.mp3", "/b/2.mp3"], "/"))
+
+    def test_round_trip(self):
+        tag_cache = kolmogorov.load_tag_cache(os.devnull)
+        kolmogorov.store_tag_info(tag_cache, "/music/a/1.mp3", 1.0, 1, {"artist":u"Bj\xf6rk", \
+            "title":u"J\xf3ga\nRemix", "length":301.6})
+        kolmogorov.store_tag_info(tag_cache, "/music/a/2.mp3", 1.0, 1, {"artist":None, "title":u"Two", \
+            "length":None})
+        kolmogorov.store_tag_info(tag_cache, "/music/b/3.mp3", 1.0, 1, None)
+        kolmogorov.write_m3u(["a/1.mp3", "a/2.mp3", "b/3.mp3"], "/music", self.filename, tag_cache)
+        file_list, base_path, tag_info = kolmogorov.load_m3u(self.filename)
+        self.assertEqual((file_list, base_path), (["a/1.mp3", "a/2.mp3", "b/3.mp3"], "/music/"))
+        self.assertEqual(sorted(tag_info.keys()), ["/music/a/1.mp3", "/music/a/2.mp3"])
+        info = tag_info["/music/a/1.mp3"]
+        self.assertEqual((info["artist"], info["title"], info["length"]), (u"Bj\xf6rk", u"J\xf3ga Remix", 302.0))
+        info = tag_info["/music/a/2.mp3"]
+        self.assertEqual((info["artist"], info["title"], info["length"]), (None, u"Two", None))
+
+class PlayQueueTest(unittest.TestCase):
+    """The play queue and the songs played next."""
+    def test_queue(self):
+        queue = kolmogorov.new_play_queue([3, 1, 3])
+        self.assertEqual(list(queue["order"]), [3, 1])
+        self.assertEqual(kolmogorov.queue_extend(queue, [1, 7, 5]), 2)
+        self.assertEqual([kolmogorov.queue_position(queue, i) for i in (3, 1, 7, 5, 4)], [1, 2, 3, 4, None])
+        self.assertEqual(kolmogorov.queue_pop(queue), 3)
+        self.assertEqual([kolmogorov.queue_position(queue, i) for i in (1, 7, 5)], [1, 2, 3])
+        self.assertTrue(kolmogorov.queue_remove(queue, 7))
+        self.assertFalse(kolmogorov.queue_remove(queue, 7))
+        self.assertEqual([kolmogorov.queue_position(queue, i) for i in (1, 5)], [1, 2])
+        # popped indices can be queued again, at the tail
+        kolmogorov.queue_extend(queue, [3])
+        self.assertEqual([kolmogorov.queue_position(queue, i) for i in (1, 5, 3)], [1, 2, 3])
+        self.assertEqual([kolmogorov.queue_pop(queue) for i in range(4)], [1, 5, 3, None])
+        self.assertEqual(queue["seq"], {})
+
+    def test_remap(self):
+        queue = kolmogorov.new_play_queue([0, 2, 4])
+        kolmogorov.queue_pop(queue)
+        copy = kolmogorov.queue_copy(queue)
+        # the song 2 was removed, the others moved
+        kolmogorov.queue_remap(queue, [1, 0, None, 2, 3])
+        self.assertEqual(list(queue["order"]), [3])
+        self.assertEqual(kolmogorov.queue_position(queue, 3), 1)
+        self.assertEqual(list(copy["order"]), [2, 4])
+        self.assertEqual(kolmogorov.queue_position(copy, 4), 2)
+
+    def test_next_song(self):
+        status = {"file_list":["a/1.mp3", "a/2.mp3", "b/1.mp3"], "playing":1, \
+            "queue":kolmogorov.new_play_queue(), "continue":True}
+        self.assertEqual(kolmogorov.next_song(status, "/music"), "/music/b/1.mp3")
+        status["queue"] = kolmogorov.new_play_queue([0])
+        self.assertEqual(kolmogorov.next_song(status, "/music"), "/music/a/1.mp3")
+        status["queue"] = kolmogorov.new_play_queue()
+        status["continue"] = False
+        self.assertEqual(kolmogorov.next_song(status, "/music"), None)
+        status["continue"], status["playing"] = True, 2
+        self.assertEqual(kolmogorov.next_song(status, "/music"), None)
+        self.assertEqual(kolmogorov.directory_span(status["file_list"], 1), (0, 2))
+
+class LibraryQueryTest(unittest.TestCase):
+    """The grammar of library queries."""
+    def test_conditions(self):
+        self.assertEqual(kolmogorov.parse_library_query("Artist = Pink  Floyd AND year >= 1970"), \
+            ("artist = ? and year >= ?", [u"Pink Floyd", 1970], list(kolmogorov.LIBRARY_DEFAULT_ORDER)))
+        self.assertEqual(kolmogorov.parse_library_query(""), (None, [], list(kolmogorov.LIBRARY_DEFAULT_ORDER)))
+        where, parameters, order = kolmogorov.parse_library_query("album != Live")
+        self.assertEqual((where, parameters), ("(album is null or album != ?)", [u"Live"]))
+        # the wildcards of like are matched as they are
+        where, parameters, order = kolmogorov.parse_library_query("title ~ 100%_pure")
+        self.assertEqual((where, parameters), ("title like ? escape '\\'", [u"%100\\%\\_pure%"]))
+
+    def test_quoting(self):
+        where, parameters, order = kolmogorov.parse_library_query( \
+            "artist = \"Simon and Garfunkel\" and title = 'order by me' order by year")
+        self.assertEqual((where, parameters, order), ("artist = ? and title = ?", \
+            [u"Simon and Garfunkel", u"order by me"], [("year", False)]))
+        self.assertEqual(kolmogorov.parse_library_query("album = \"\"")[1], [u""])
+
+    def test_order(self):
+        self.assertEqual(kolmogorov.parse_library_query("order by Year desc, album, track DESC")[2], \
+            [("year", True), ("album", False), ("track", True)])
+        self.assertRaises(ValueError, kolmogorov.parse_library_query, "artist = X order by year order by album")
+        self.assertRaises(ValueError, kolmogorov.parse_library_query, "order by year,")
+        self.assertRaises(ValueError, kolmogorov.parse_library_query, "order by genre")
+
+    def test_errors(self):
+        for query in ("genre = rock", "artist =", "year = nineteen", "artist X", \
+                "artist = X and", "artist ! X"):
+            self.assertRaises(ValueError, kolmogorov.parse_library_query, query)
+
+    def test_not_ascii(self):
+        where, parameters, order = kolmogorov.parse_library_query("artist = Bj\xc3\xb6rk and album ~ \xc3\xa9")
+        self.assertEqual(parameters, [u"Bj\xf6rk", u"%\xe9%"])
+        # bytes which aren't UTF-8
+        self.assertEqual(kolmogorov.parse_library_query("title = \xe9t\xe9")[1], [u"\ufffdt\ufffd"])
+        # paths are matched as bytes
+        where, parameters, order = kolmogorov.parse_library_query("path ~ Bj\xc3\xb6rk")
+        self.assertEqual(str(parameters[0]), "%Bj\xc3\xb6rk%")
+
+class TagCacheTest(unittest.TestCase):
+    """The tag cache saved whole and by its journal."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="kolmogorov_test")
+        self.filename = os.path.join(self.home, "tag_cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def test_journal(self):
+        tag_cache = kolmogorov.load_tag_cache(self.filename)
+        kolmogorov.store_tag_info(tag_cache, "/music/a.mp3", 1.0, 10, {"title":u"A"})
+        kolmogorov.save_tag_cache(tag_cache)
+        kolmogorov.store_tag_info(tag_cache, "/music/b.mp3", 2.0, 20, {"title":u"B"})
+        # the file is gone: its entry is dropped, and the drop is saved
+        gone = os.path.join(self.home, "c.mp3")
+        kolmogorov.store_tag_info(tag_cache, gone, 3.0, 30, {"title":u"C"})
+        tag_cache["dirty"].discard(gone)
+        read_tag_info = kolmogorov.read_tag_info
+        kolmogorov.read_tag_info = lambda filename, reader=None: None
+        try:
+            self.assertEqual(kolmogorov.cached_tag_info(tag_cache, gone), None)
+        finally:
+            kolmogorov.read_tag_info = read_tag_info
+        self.assertFalse(tag_cache["entries"].has_key(gone))
+        self.assertTrue(gone in tag_cache["dirty"])
+        kolmogorov.append_tag_cache(tag_cache)
+        kolmogorov.store_tag_info(tag_cache, "/music/d.mp3", 4.0, 40, {"title":u"D"})
+        kolmogorov.append_tag_cache(tag_cache)
+        tag_cache["journal"].write("\x80\x02(U")
+        tag_cache["journal"].close()
+        loaded = kolmogorov.load_tag_cache(self.filename)
+        self.assertEqual(sorted(loaded["entries"].keys()), ["/music/a.mp3", "/music/b.mp3", "/music/d.mp3"])
+        self.assertEqual(loaded["n_of_records"], 3)
+        # appended after the last valid record
+        kolmogorov.store_tag_info(loaded, "/music/e.mp3", 5.0, 50, {"title":u"E"})
+        kolmogorov.append_tag_cache(loaded)
+        loaded["journal"].close()
+        self.assertEqual(len(kolmogorov.load_tag_cache(self.filename)["entries"]), 4)
+
+    def test_background(self):
+        tag_cache = kolmogorov.load_tag_cache(self.filename)
+        kolmogorov.store_tag_info(tag_cache, "/music/a.mp3", 1.0, 10, {"title":u"A"})
+        kolmogorov.store_tag_info(tag_cache, "/music/b.mp3", 2.0, 20, {"title":u"B"})
+        kolmogorov.save_tag_cache(tag_cache)
+        tag_cache["journal"].close()
+        loading = kolmogorov.load_tag_cache(self.filename, True)
+        kolmogorov.seed_tag_cache(loading, {"/music/a.mp3":{"title":u"from the playlist"}, \
+            "/music/c.mp3":{"title":u"C"}})
+        kolmogorov.store_tag_info(loading, "/music/b.mp3", 3.0, 30, {"title":u"B again"})
+        loading["loaded"].wait()
+        entries = loading["entries"]
+        self.assertEqual(entries["/music/a.mp3"][3]["title"], u"A")
+        self.assertEqual(entries["/music/c.mp3"][3]["title"], u"C")
+        self.assertEqual(entries["/music/b.mp3"][3]["title"], u"B again")
+
+    def test_seeded(self):
+        # a #EXTINF line gives the artist and the title only
+        tags = {"artist":u"Bj\xf6rk", "album":u"Post", "tracknumber":u"3", "title":u"Isobel"}
+        filename = os.path.join(self.home, "a.mp3")
+        fp = open(filename, "wb")
+        fp.write(kolmogorov_bench.mp3_stub(tags))
+        fp.close()
+        gone = os.path.join(self.home, "b.mp3")
+        tag_cache = kolmogorov.load_tag_cache(self.filename)
+        kolmogorov.seed_tag_cache(tag_cache, {filename:{"artist":u"Bj\xf6rk", "title":u"Isobel", "length":1.0}, \
+            gone:{"artist":u"Bj\xf6rk", "title":u"Hyperballad", "length":1.0}})
+        info = kolmogorov.cached_tag_info(tag_cache, filename)
+        self.assertEqual((info["album"], info["tracknumber"]), (u"Post", u"3"))
+        self.assertTrue(tag_cache["entries"][filename][0] is not None)
+        self.assertTrue(filename in tag_cache["dirty"])
+        # the placeholder, if the file is gone
+        self.assertEqual(kolmogorov.cached_tag_info(tag_cache, gone)["title"], u"Hyperballad")
+
+class SessionTest(unittest.TestCase):
+    """The session snapshot and its journal."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="kolmogorov_test")
+        self.filename = os.path.join(self.home, "session")
+        self.journal_filename = os.path.join(self.home, "session.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def write(self, queue=()):
+        session = kolmogorov.new_session("/music", kolmogorov.Playlist(["a/1.mp3", "a/2.mp3", "b/1.mp3"]))
+        session["queue"] = list(queue)
+        return session, kolmogorov.write_session(session, self.filename, self.journal_filename)
+
+    def load(self):
+        return kolmogorov.load_session(self.filename, self.journal_filename)
+
+    def test_journal(self):
+        session, journal = self.write([2])
+        self.assertTrue(kolmogorov.append_session_journal(journal, [("cursor", (0, 1)), ("playing", 1)]))
+        self.assertTrue(kolmogorov.append_session_journal(journal, [("queue", [2, 0]), ("unknown", 1)]))
+        journal.close()
+        loaded = self.load()
+        self.assertEqual(list(loaded["file_list"]), ["a/1.mp3", "a/2.mp3", "b/1.mp3"])
+        self.assertTrue(isinstance(loaded["file_list"], kolmogorov.Playlist))
+        self.assertEqual((loaded["base_dir"], loaded["cursor"], loaded["playing"], loaded["queue"]), \
+            ("/music", (0, 1), 1, [2, 0]))
+        self.assertFalse(loaded.has_key("unknown"))
+
+    def test_truncated_record(self):
+        session, journal = self.write()
+        kolmogorov.append_session_journal(journal, [("cursor", (0, 1))])
+        record = cPickle.dumps(("cursor", (0, 2)), cPickle.HIGHEST_PROTOCOL)
+        # kolmogorov died while writing the second record
+        journal.write(record[:len(record) - 3])
+        journal.close()
+        self.assertEqual(self.load()["cursor"], (0, 1))
+
+    def test_generations(self):
+        session, journal = self.write()
+        kolmogorov.append_session_journal(journal, [("cursor", (0, 1))])
+        journal.close()
+        old_journal = open(self.journal_filename, "rb").read()
+        session, journal = self.write()
+        journal.close()
+        # the journal of the previous snapshot is ignored
+        fp = open(self.journal_filename, "wb")
+        fp.write(old_journal)
+        fp.close()
+        self.assertEqual(self.load()["cursor"], (0, 0))
+        # so is a missing journal, not a broken snapshot
+        os.remove(self.journal_filename)
+        self.assertEqual(self.load()["cursor"], (0, 0))
+        fp = open(self.filename, "wb")
+        fp.write("\x80\x02}q")
+        fp.close()
+        self.assertEqual(self.load(), None)
+
+    def test_empty_playlist(self):
+        # the scan of an empty directory doesn't replace the last session
+        file_list = kolmogorov.Playlist()
+        display_status_dict = {"file_list":file_list, "current_text_line":0, "current_cursor_line":0, \
+            "tag_mode":False, "scanning":False, "rescanning":False, "dir_state":None}
+        play_engine = kolmogorov.new_play_engine(file_list)
+        writer = kolmogorov.new_session_writer(kolmogorov.new_session(self.home, file_list))
+        written = []
+        write_session = kolmogorov.write_session
+        kolmogorov.write_session = lambda session: written.append(session)
+        try:
+            kolmogorov.sync_session(writer, display_status_dict, thread.allocate_lock(), play_engine)
+            kolmogorov.sync_session(writer, display_status_dict, thread.allocate_lock(), play_engine, True)
+        finally:
+            kolmogorov.write_session = write_session
+        self.assertEqual(written, [])
+
+class TagHeaderTest(unittest.TestCase):
+    """The header-only tag reader, on files like the ones of 
+    kolmogorov_bench.make_library(...)."""
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="kolmogorov_test")
+        self.tags = {"artist":u"Bj\xf6rk", "album":u"Post", "tracknumber":u"3", "title":u"Isobel"}
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def read(self, name, data):
+        filename = os.path.join(self.home, name)
+        fp = open(filename, "wb")
+        fp.write(data)
+        fp.close()
+        return kolmogorov.read_tag_header(filename)
+
+    def assertTags(self, info):
+        for key in self.tags.keys():
+            self.assertEqual(info[key], self.tags[key])
+        self.assertEqual(info["date"], None)
+
+    def test_mpeg_header(self):
+        # MPEG-1 layer III, 128kbps, 44.1kHz, joint stereo
+        self.assertEqual(kolmogorov.parse_mpeg_header("\xff\xfb\x90\x64"), (1, 3, 128000, 44100, False, 1152, 417))
+        self.assertEqual(kolmogorov.parse_mpeg_header("\xff\xfb\x92\x64")[6], 418)
+        # MPEG-1 layer I, 128kbps, 44.1kHz: 12 slots of 4 bytes, and one
+        # more if padded
+        self.assertEqual(kolmogorov.parse_mpeg_header("\xff\xff\x40\x00"), (1, 1, 128000, 44100, False, 384, 136))
+        self.assertEqual(kolmogorov.parse_mpeg_header("\xff\xff\x42\x00")[6], 140)
+        # MPEG-2 layer III, 64kbps, 22.05kHz, mono
+        self.assertEqual(kolmogorov.parse_mpeg_header("\xff\xf3\x80\xc0"), (2, 3, 64000, 22050, True, 576, 208))
+        self.assertEqual(kolmogorov.parse_mpeg_header("\xff\xfb\xf0\x64"), None)
+        self.assertEqual(kolmogorov.parse_mpeg_header("ID3\x03"), None)
+
+    def test_mp3(self):
+        info = self.read("a.mp3", kolmogorov_bench.mp3_stub(self.tags))
+        self.assertTags(info)
+        self.assertEqual((info["mime"], info["bitrate"]), ("audio/mp3", 128000))
+        self.assertAlmostEqual(info["length"], 40*417*8/128000.0)
+
+    def test_layer_1(self):
+        info = self.read("a.mp3", ("\xff\xff\x40\x00" + "\x00"*132)*10)
+        self.assertEqual((info["mime"], info["bitrate"]), ("audio/mp1", 128000))
+        self.assertAlmostEqual(info["length"], 10*136*8/128000.0)
+
+    def test_xing_lame(self):
+        # 100 frames after the Xing one, with 576 samples of encoder delay
+        # and 1000 of padding
+        lame = "LAME3.99r" + "\x00"*12 + struct.pack(">I", (576 << 12) | 1000)[1:]
+        xing = "\xff\xfb\x90\x64" + "\x00"*32 + "Xing" + struct.pack(">III", 3, 100, 101*417) + lame
+        info = self.read("a.mp3", xing + "\x00"*(417 - len(xing)) + ("\xff\xfb\x90\x64" + "\x00"*413)*100)
+        self.assertEqual(info["mime"], "audio/mp3")
+        self.assertAlmostEqual(info["length"], (1152*100 - 1576) / 44100.0)
+        self.assertEqual(info["bitrate"], int(round(100*417*8*44100 / (1152*100.0))))
+
+    def test_ogg(self):
+        info = self.read("a.ogg", kolmogorov_bench.ogg_stub(self.tags, 88200))
+        self.assertTags(info)
+        self.assertEqual((info["mime"], info["bitrate"]), ("audio/vorbis", 128000))
+        self.assertAlmostEqual(info["length"], 2.0)
+
+    def test_flac(self):
+        info = self.read("a.flac", kolmogorov_bench.flac_stub(self.tags, 88200))
+        self.assertTags(info)
+        self.assertEqual(info["mime"], "audio/flac")
+        self.assertAlmostEqual(info["length"], 2.0)
+
+    def test_other_files(self):
+        self.assertEqual(self.read("a.mp3", "\x00"*8192), None)
+        self.assertEqual(self.read("a.wav", kolmogorov_bench.wav_stub(self.tags)), None)
+
+class SearchTest(unittest.TestCase):
+    """Filters typed in tag mode, with keys which are not ASCII."""
+    def setUp(self):
+        file_list = kolmogorov.Playlist(["a/01.mp3", "a/02.mp3", "b/S\xc3\xb3ley.mp3"])
+        tag_list = [{"artist":u"Bj\xf6rk", "album":u"Post", "tracknumber":u"1", "title":u"Army of Me"}, \
+            {"artist":u"Bjork", "album":u"Post", "tracknumber":u"2", "title":u"Hyper-ballad"}, None]
+        self.display_status_dict = {"file_list":file_list, "tag_list":tag_list, "tag_mode":True, \
+            "search_index":None, "view":None, "search":None, "current_text_line":0, \
+            "current_cursor_line":0, "message":None}
+        # the size of the screen, set by curses.initscr()
+        curses.LINES, curses.COLS = 24, 80
+
+    def type_filter(self, keys):
+        kolmogorov.start_search(self.display_status_dict, "filter")
+        for ch in keys:
+            kolmogorov.search_key(self.display_status_dict, ord(ch))
+        return self.display_status_dict["view"]["indices"]
+
+    def test_tag_mode(self):
+        self.assertEqual(self.type_filter("BJ\xc3\xb6"), [0])
+        self.assertEqual(self.type_filter("bj"), [0, 1])
+        # the first byte of a character narrows nothing yet
+        self.assertEqual(self.type_filter("bj\xc3"), [0, 1])
+        # bytes which aren't UTF-8 match no tag
+        self.assertEqual(self.type_filter("bj\xf6"), [])
+
+    def test_file_names(self):
+        self.display_status_dict["tag_mode"] = False
+        self.assertEqual(self.type_filter("\xc3\xb3l"), [2])
+        self.display_status_dict["tag_mode"] = True
+        self.assertEqual(self.type_filter("\xc3\xb3l"), [2])
+
+if __name__ == '__main__':
+    unittest.main()